@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Build a spatial cell graph over the nuclei and per-nucleus neighbourhood features.
+
+The output directory holds:
+
+- ``adjacency.npz``: (N, N) symmetric CSR adjacency (scipy.sparse.save_npz),
+  edge lengths in µm, nuclei in store order
+- ``node_features``: feature store with one row per nucleus, in the same
+  order and with the same ids as feature_extract.py and
+  morphology_features.py, ready for model_inference.py
+- ``graph.json``: graph parameters and size
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+import cell_graph
+import feature_store
+from cell_graph import ADJACENCY_FILE, GRAPH_METHODS, build_graph, iter_node_features, node_feature_names, save_graph
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from feature_store import FeatureWriter
+from nuclei_store import load_nuclei
+from slide_metadata import SlideMetadata
+from telemetry import add_telemetry_arguments, start_telemetry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Physical units of the node feature columns
+UNIT_SUFFIXES = {'knn_mean_distance': '_um', 'local_density': '_per_mm2', 'mean_edge_length': '_um'}
+
+parser = argparse.ArgumentParser(description="Spatial cell graph and neighbourhood features of segmented nuclei")
+parser.add_argument('--input', type=str, help='Path to the nuclei store directory or segmentation result file (0.dat)', required=True)
+parser.add_argument('--output', type=str, help='Output graph directory', required=True)
+parser.add_argument('--method', type=str, choices=GRAPH_METHODS, default='knn', help='Graph edges: k nearest neighbours, all pairs within --radius, or Delaunay edges up to --radius')
+parser.add_argument('--k', type=int, default=8, help='Neighbours per nucleus of the knn graph and of the composition features')
+parser.add_argument('--radius', type=float, default=50.0, help='Radius graph neighbourhood and longest Delaunay edge, in µm')
+parser.add_argument('--density_radius', type=float, default=50.0, help='Radius of the local density feature, in µm')
+parser.add_argument('--metadata', type=str, default=None, help='slide_metadata.json of the segmented image (default: the one next to the nuclei)')
+parser.add_argument('--default_mpp', type=float, default=0.5, help='MPP assumed when no slide metadata records one')
+parser.add_argument('--chunk_size', type=int, default=65536, help='Nuclei queried at once; bounds working memory')
+add_checkpoint_arguments(parser)
+add_telemetry_arguments(parser)
+
+args = parser.parse_args()
+telemetry = start_telemetry('build_cell_graph', args, method=args.method)
+
+# Distances are in µm, so graphs of slides scanned at different resolutions compare
+if args.metadata:
+    metadata = SlideMetadata.load(args.metadata)
+else:
+    input_dir = os.path.dirname(os.path.abspath(args.input))
+    metadata = SlideMetadata.find(input_dir, os.path.dirname(input_dir))
+mpp = metadata.mpp if metadata is not None else None
+if mpp is None:
+    logger.warning(f"No MPP known for {args.input}, assuming {args.default_mpp}")
+    mpp = (args.default_mpp, args.default_mpp)
+
+checkpoint = Checkpoint(
+    'cell_graph',
+    inputs=[args.input],
+    params=dict({name: getattr(args, name) for name in ['method', 'k', 'radius', 'density_radius']}, mpp=mpp),
+    code=[__file__, cell_graph.__file__, feature_store.__file__],
+    store=args.checkpoint_dir,
+    force=args.force,
+)
+if checkpoint.restore([args.output]):
+    print(f"Cell graph in {args.output} is up to date")
+    exit(0)
+
+nuclei_store = load_nuclei(args.input)
+print(f"Loaded {len(nuclei_store)} nuclei from {args.input}")
+centroid = np.asarray(nuclei_store['centroid'], dtype=np.float64) * np.asarray(mpp, dtype=np.float64)
+types = np.asarray(nuclei_store['type'])
+os.makedirs(args.output, exist_ok=True)
+
+with telemetry.step('graph') as step:
+    adjacency = build_graph(centroid, args.method, k=args.k, radius=args.radius, chunk_size=args.chunk_size)
+    save_graph(os.path.join(args.output, ADJACENCY_FILE), adjacency)
+    step.add_items(adjacency.nnz // 2, 'edges')
+print(f"{args.method} graph with {adjacency.nnz // 2} edges over {len(centroid)} nuclei")
+
+column_names = [name + UNIT_SUFFIXES.get(name, '') for name in node_feature_names()]
+ids = nuclei_store['id']
+with telemetry.step('node_features') as step, FeatureWriter(
+    os.path.join(args.output, 'node_features'), dtype='float32', column_names=column_names
+) as writer:
+    step.add_items(len(centroid), 'nuclei')
+    for start, stop, features in iter_node_features(
+        adjacency, centroid, types, k=args.k, density_radius=args.density_radius, unit_area=1e-6, chunk_size=args.chunk_size
+    ):
+        writer.write(ids[start:stop], nuclei_store['centroid'][start:stop], features)
+
+with open(os.path.join(args.output, 'graph.json'), 'w') as f:
+    json.dump({
+        'method': args.method,
+        'k': args.k,
+        'radius_um': args.radius,
+        'density_radius_um': args.density_radius,
+        'mpp': list(mpp),
+        'nodes': len(centroid),
+        'edges': int(adjacency.nnz // 2),
+        'node_features': column_names,
+    }, f, indent=4)
+checkpoint.save([args.output])
+
+print(f"Cell graph and node features saved to {args.output}")
@@ -0,0 +1,192 @@
+"""Spatial cell graphs over nucleus centroids and per-node neighbourhood features.
+
+A graph is an (N, N) symmetric scipy CSR matrix over the nuclei in store
+order; entry (i, j) is the distance between nuclei i and j. Coincident
+centroids are stored at MIN_DISTANCE so the edge survives sparse
+operations. Graphs are built with a cKDTree:
+
+- ``knn``: each nucleus linked to its k nearest others, then symmetrized
+- ``radius``: all pairs closer than a radius
+- ``delaunay``: Delaunay triangulation edges no longer than a radius, so
+  nuclei across tissue gaps are not linked
+
+kNN and radius graphs are queried in row chunks, so working memory follows
+the chunk size and the output grows with the number of edges only. The
+Delaunay triangulation is computed in one piece by Qhull.
+"""
+import numpy as np
+
+from segmentation_metrics import NUCLEUS_TYPES
+
+GRAPH_METHODS = ['knn', 'radius', 'delaunay']
+ADJACENCY_FILE = 'adjacency.npz'
+MIN_DISTANCE = 1e-3
+
+# Composition columns: one per named HoVerNet type, then everything else
+TYPE_NAMES = list(NUCLEUS_TYPES.values()) + ['other']
+
+
+def type_indices(types):
+    """Map HoVerNet type ids to column indices of TYPE_NAMES."""
+    types = np.asarray(types)
+    indices = np.full(len(types), len(NUCLEUS_TYPES), dtype=np.int64)
+    for index, type_id in enumerate(NUCLEUS_TYPES):
+        indices[types == type_id] = index
+    return indices
+
+
+def _csr(count, rows, cols, distances):
+    from scipy.sparse import csr_matrix
+
+    distances = np.maximum(distances, MIN_DISTANCE).astype(np.float32)
+    return csr_matrix((distances, (rows, cols)), shape=(count, count))
+
+
+def knn_neighbors(tree, points, rows, k):
+    """
+    The k nearest other nuclei of a chunk of nuclei.
+    :param tree: cKDTree over all centroids
+    :param points: (n, 2) centroids of the chunk
+    :param rows: (n,) store indices of the chunk, excluded from their own neighbours
+    :param k: Neighbours per nucleus; at most the number of other nuclei
+    :return: ((n, k) distances, (n, k) neighbour indices)
+    """
+    distances, neighbors = tree.query(points, k=k + 1, workers=-1)
+    distances, neighbors = distances.reshape((len(points), -1)), neighbors.reshape((len(points), -1))
+    # Drop the nucleus itself; with coincident centroids it need not come first
+    keep = np.argsort(neighbors == rows[:, None], axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(distances, keep, axis=1), np.take_along_axis(neighbors, keep, axis=1)
+
+
+def build_graph(centroid, method='knn', k=8, radius=None, chunk_size=65536):
+    """
+    Build a spatial graph over centroids.
+    :param centroid: (N, 2) centroids
+    :param method: One of GRAPH_METHODS
+    :param k: Neighbours per nucleus of the knn graph
+    :param radius: Neighbourhood radius of the radius graph, longest edge of the
+        Delaunay graph (None keeps all Delaunay edges); in centroid units
+    :param chunk_size: Nuclei queried at once
+    :return: (N, N) symmetric CSR matrix of edge lengths
+    """
+    from scipy.spatial import cKDTree
+
+    centroid = np.asarray(centroid, dtype=np.float64)
+    count = len(centroid)
+    if method not in GRAPH_METHODS:
+        raise ValueError(f"Unsupported graph method: {method}")
+    if method == 'delaunay':
+        return _delaunay_graph(centroid, radius)
+    if method == 'radius' and radius is None:
+        raise ValueError("The radius graph needs a radius")
+
+    tree = cKDTree(centroid)
+    k = min(k, count - 1)
+    rows, cols, distances = [np.zeros(0, np.int64)], [np.zeros(0, np.int64)], [np.zeros(0)]
+    for start in range(0, count if method == 'radius' or k > 0 else 0, chunk_size):
+        stop = min(start + chunk_size, count)
+        chunk_rows = np.arange(start, stop)
+        if method == 'knn':
+            chunk_distances, neighbors = knn_neighbors(tree, centroid[start:stop], chunk_rows, k)
+            rows.append(np.repeat(chunk_rows, k))
+            cols.append(neighbors.ravel())
+            distances.append(chunk_distances.ravel())
+        else:
+            pairs = cKDTree(centroid[start:stop]).sparse_distance_matrix(tree, radius, output_type='ndarray')
+            pairs = pairs[pairs['i'] + start != pairs['j']]
+            rows.append(pairs['i'] + start)
+            cols.append(pairs['j'])
+            distances.append(pairs['v'])
+    adjacency = _csr(count, np.concatenate(rows), np.concatenate(cols), np.concatenate(distances))
+    if method == 'knn':
+        # Link i and j when either is among the other's nearest neighbours
+        adjacency = adjacency.maximum(adjacency.T).tocsr()
+    return adjacency
+
+
+def _delaunay_graph(centroid, radius=None):
+    from scipy.spatial import Delaunay, QhullError
+
+    count = len(centroid)
+    if count < 3:
+        return _csr(count, np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0))
+    try:
+        triangulation = Delaunay(centroid)
+    except QhullError:
+        # Collinear or coincident centroids have no proper triangulation; joggle them
+        triangulation = Delaunay(centroid, qhull_options='QJ')
+    indptr, indices = triangulation.vertex_neighbor_vertices
+    rows = np.repeat(np.arange(count), np.diff(indptr))
+    distances = np.hypot(*(centroid[rows] - centroid[indices]).T)
+    keep = distances <= radius if radius is not None else slice(None)
+    return _csr(count, rows[keep], indices[keep], distances[keep])
+
+
+def save_graph(path, adjacency):
+    """Write a graph as a compressed scipy .npz file."""
+    from scipy.sparse import save_npz
+
+    save_npz(path, adjacency)
+
+
+def load_graph(path):
+    """Read a graph written by save_graph as CSR."""
+    from scipy.sparse import load_npz
+
+    return load_npz(path).tocsr()
+
+
+def node_feature_names():
+    return (
+        [f'knn_{name}_fraction' for name in TYPE_NAMES]
+        + ['knn_mean_distance', 'local_density', 'degree', 'mean_edge_length']
+    )
+
+
+def iter_node_features(adjacency, centroid, types, k=8, density_radius=50.0, unit_area=1.0, chunk_size=65536):
+    """
+    Per-node neighbourhood features, chunk by chunk in store order:
+
+    - knn_<type>_fraction: share of each type among the k nearest nuclei
+    - knn_mean_distance: mean distance to the k nearest nuclei
+    - local_density: other nuclei within density_radius per unit_area
+    - degree, mean_edge_length: of the node in the graph
+
+    :param adjacency: Graph from build_graph
+    :param centroid: (N, 2) centroids
+    :param types: (N,) HoVerNet type ids
+    :param k: Neighbours of the composition features
+    :param density_radius: Radius of the density features, in centroid units
+    :param unit_area: Area of one squared centroid unit in the density unit, e.g.
+        1e-6 for centroids in µm and densities per mm²
+    :param chunk_size: Nuclei per chunk
+    :return: Generator of (start, stop, (stop - start, F) float32 features)
+    """
+    from scipy.spatial import cKDTree
+
+    centroid = np.asarray(centroid, dtype=np.float64)
+    count = len(centroid)
+    type_index = type_indices(types)
+    tree = cKDTree(centroid)
+    k = min(k, count - 1)
+    circle_area = np.pi * density_radius ** 2 * unit_area
+    degree = np.diff(adjacency.indptr)
+    for start in range(0, count, chunk_size):
+        stop = min(start + chunk_size, count)
+        rows = np.arange(start, stop)
+        n = stop - start
+        if k > 0:
+            distances, neighbors = knn_neighbors(tree, centroid[start:stop], rows, k)
+            composition = np.bincount(
+                (np.arange(n)[:, None] * len(TYPE_NAMES) + type_index[neighbors]).ravel(),
+                minlength=n * len(TYPE_NAMES),
+            ).reshape((n, len(TYPE_NAMES))) / k
+            mean_distance = distances.mean(axis=1)
+        else:
+            composition = np.zeros((n, len(TYPE_NAMES)))
+            mean_distance = np.zeros(n)
+        within = tree.query_ball_point(centroid[start:stop], density_radius, return_length=True, workers=-1) - 1
+        chunk_degree = degree[start:stop]
+        edge_length = np.asarray(adjacency[start:stop].sum(axis=1)).ravel() / np.maximum(chunk_degree, 1)
+        features = np.column_stack([composition, mean_distance, within / circle_area, chunk_degree, edge_length])
+        yield start, stop, features.astype(np.float32)
@@ -0,0 +1,222 @@
+"""Stage checkpoints keyed by input content, parameters and code version.
+
+A stage wraps its expensive part in a Checkpoint:
+
+    checkpoint = Checkpoint('metrics', inputs=[dat_path], params={...},
+                            code=[__file__, segmentation_metrics.__file__], store=args.checkpoint_dir)
+    if not checkpoint.restore([metrics_path]):
+        ...compute metrics_path...
+        checkpoint.save([metrics_path])
+
+The key is a SHA-256 over the stage name, the content of every input file or
+directory, the parameters and the source of the listed code files, so editing
+the metrics code re-runs metrics but not segmentation. restore() succeeds when
+either a stamp next to the outputs records the same key and the outputs are
+untouched, or the shared store (``--checkpoint_dir``, by default
+``$TIA_PIPELINE_CACHE/checkpoints``) holds an entry for the key; its outputs
+are then copied into place. Store entries are written to a temporary
+directory and renamed, so concurrent tasks on shared storage only ever see
+complete entries.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from disk_cache import CACHE_DIR_ENV, make_key
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_BYTES = 8 << 20
+FORMAT_VERSION = 1
+
+
+def add_checkpoint_arguments(parser):
+    """Add the --checkpoint_dir/--force options shared by checkpointed stages."""
+    default = os.environ.get(CACHE_DIR_ENV)
+    parser.add_argument('--checkpoint_dir', type=str, default=default and os.path.join(default, 'checkpoints'), help=f'Shared store of stage results (default: ${CACHE_DIR_ENV}/checkpoints); only local stamps are used when unset')
+    parser.add_argument('--force', action='store_true', help='Recompute checkpointed steps even when their inputs are unchanged')
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Digests:
+    """
+    SHA-256 of files and directories, memoized by (real path, size, mtime, inode)
+    in the checkpoint store so multi-GB slides are hashed once per version.
+    """
+
+    def __init__(self, store=None):
+        self.directory = os.path.join(store, 'digests') if store else None
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def file(self, path):
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        memo = None
+        if self.directory:
+            memo = os.path.join(self.directory, make_key(path, stat.st_size, stat.st_mtime_ns, stat.st_ino))
+            try:
+                with open(memo) as f:
+                    return f.read().strip()
+            except FileNotFoundError:
+                pass
+        value = _file_digest(path)
+        if memo:
+            _write_atomic(memo, value)
+        return value
+
+    def path(self, path):
+        """Digest of a file, or of a directory's relative paths and file contents."""
+        if not os.path.isdir(path):
+            return self.file(path)
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                if name.startswith('.checkpoint.'):
+                    continue
+                digest.update(os.path.relpath(file_path, path).encode() + b'\0')
+                digest.update(self.file(file_path).encode())
+        return digest.hexdigest()
+
+
+def _write_atomic(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _signature(path):
+    """Cheap (relative path, size, mtime) listing used to notice edited outputs."""
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [['', stat.st_size, stat.st_mtime_ns]]
+    signature = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.startswith('.checkpoint.'):
+                continue
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            signature.append([os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _place(src, dst):
+    """
+    Copy a file or directory to dst, replacing what is there.
+    Copies rather than hard links, so a stage rewriting an output in place
+    cannot corrupt the store entry it was restored from.
+    """
+    _remove(dst)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+class Checkpoint:
+    """Skip a stage step whose inputs, parameters and code are unchanged."""
+
+    def __init__(self, name, inputs=(), params=None, code=(), store=None, force=False):
+        """
+        :param name: Step name, unique within the pipeline
+        :param inputs: Files or directories whose content the outputs depend on; None entries are ignored
+        :param params: JSON-serializable parameters the outputs depend on
+        :param code: Source files whose changes invalidate the outputs
+        :param store: Shared checkpoint store directory, or None for local stamps only
+        :param force: Never restore, always recompute
+        """
+        self.name = name
+        self.store = store
+        self.force = force
+        digests = Digests(store)
+        self.key = make_key(
+            FORMAT_VERSION,
+            name,
+            [digests.path(path) for path in inputs if path is not None],
+            json.dumps(params or {}, sort_keys=True, default=str),
+            [digests.file(path) for path in code],
+        )
+
+    def _stamp_path(self, outputs):
+        directory = os.path.dirname(os.path.abspath(outputs[0]))
+        return os.path.join(directory, f'.checkpoint.{self.name}.json')
+
+    def _entry_path(self):
+        return os.path.join(self.store, self.key[:2], self.key)
+
+    def restore(self, outputs):
+        """
+        Bring outputs up to date from a previous run if possible.
+        :param outputs: Output files or directories of the step
+        :return: True if the step can be skipped
+        """
+        if self.force:
+            return False
+        try:
+            with open(self._stamp_path(outputs)) as f:
+                stamp = json.load(f)
+            if stamp['key'] == self.key and stamp['outputs'] == [_signature(path) for path in outputs]:
+                logger.info(f"{self.name}: outputs are up to date, skipping")
+                return True
+        except (OSError, ValueError, KeyError):
+            pass
+
+        if self.store and os.path.isdir(self._entry_path()):
+            entry = self._entry_path()
+            sources = [os.path.join(entry, os.path.basename(os.path.normpath(path))) for path in outputs]
+            if all(os.path.lexists(source) for source in sources):
+                for source, path in zip(sources, outputs):
+                    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                    _place(source, path)
+                self._write_stamp(outputs)
+                logger.info(f"{self.name}: restored outputs from checkpoint {self.key[:12]}")
+                return True
+        return False
+
+    def _write_stamp(self, outputs):
+        stamp = {'key': self.key, 'outputs': [_signature(path) for path in outputs]}
+        _write_atomic(self._stamp_path(outputs), json.dumps(stamp))
+
+    def save(self, outputs):
+        """Record freshly computed outputs locally and in the shared store."""
+        names = [os.path.basename(os.path.normpath(path)) for path in outputs]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Checkpoint outputs need distinct names: {names}")
+        self._write_stamp(outputs)
+        if not self.store or os.path.isdir(self._entry_path()):
+            return
+        parent = os.path.dirname(self._entry_path())
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+        try:
+            for path, name in zip(outputs, names):
+                _place(path, os.path.join(tmp_path, name))
+            os.replace(tmp_path, self._entry_path())
+        except OSError:
+            # Another task stored the same key first, or the store is unavailable
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(self._entry_path()):
+                raise
+        logger.info(f"{self.name}: saved checkpoint {self.key[:12]}")
@@ -0,0 +1,192 @@
+"""Serialized classifiers applied to feature batches, and streaming slide-level pooling.
+
+Supported model files, chosen by extension:
+
+- ``.onnx``: ONNX model run with onnxruntime
+- ``.pt``, ``.pth``, ``.ts``: TorchScript, or a pickled ``torch.nn.Module``
+- anything else (``.joblib``, ``.pkl``): a scikit-learn style estimator loaded with joblib
+
+Torch and ONNX models may return a second output of per-item attention
+logits (attention-MIL heads); it is used for attention pooling when present.
+"""
+import os
+
+import numpy as np
+
+TORCH_EXTENSIONS = ('.pt', '.pth', '.ts')
+
+
+def _softmax(x):
+    x = x - x.max(axis=1, keepdims=True)
+    np.exp(x, out=x)
+    return x / x.sum(axis=1, keepdims=True)
+
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+class Classifier:
+    """A model loaded once and applied to (N, D) float32 feature batches."""
+
+    def __init__(self, path, on_gpu=False, activation='auto'):
+        """
+        :param path: Model file, see the module docstring
+        :param on_gpu: Run torch models on CUDA, or ONNX models with the CUDA provider
+        :param activation: "auto", "sigmoid", "softmax" or "none"; auto leaves
+            scikit-learn probabilities and predictions alone and applies sigmoid
+            (one output) or softmax (several outputs) to torch and ONNX logits
+            and scikit-learn decision_function margins
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Model file {path} not found.")
+        self.path = path
+        self.activation = activation
+        self.n_features = None
+        extension = os.path.splitext(path)[1].lower()
+        # What the raw model outputs are: "logit", "probability", "margin" or "prediction"
+        self.output_kind = 'logit'
+        if extension == '.onnx':
+            self.kind = 'onnx'
+            self._predict = self._load_onnx(path, on_gpu)
+        elif extension in TORCH_EXTENSIONS:
+            self.kind = 'torch'
+            self._predict = self._load_torch(path, on_gpu)
+        else:
+            self.kind = 'sklearn'
+            self._predict = self._load_sklearn(path)
+
+    def _load_onnx(self, path, on_gpu):
+        import onnxruntime
+
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if on_gpu else ['CPUExecutionProvider']
+        session = onnxruntime.InferenceSession(path, providers=providers)
+        model_input = session.get_inputs()[0]
+        if isinstance(model_input.shape[-1], int):
+            self.n_features = model_input.shape[-1]
+        return lambda features: session.run(None, {model_input.name: features})
+
+    def _load_torch(self, path, on_gpu):
+        import torch
+
+        device = torch.device('cuda' if on_gpu and torch.cuda.is_available() else 'cpu')
+        try:
+            model = torch.jit.load(path, map_location=device)
+        except RuntimeError:
+            # Not TorchScript: a whole pickled module
+            model = torch.load(path, map_location=device, weights_only=False)
+        model.eval()
+
+        def predict(features):
+            with torch.inference_mode():
+                outputs = model(torch.from_numpy(features).to(device))
+            if not isinstance(outputs, (tuple, list)):
+                outputs = [outputs]
+            return [output.float().cpu().numpy() for output in outputs]
+
+        return predict
+
+    def _load_sklearn(self, path):
+        import joblib
+
+        model = joblib.load(path)
+        self.n_features = getattr(model, 'n_features_in_', None)
+        if hasattr(model, 'predict_proba'):
+            self.output_kind = 'probability'
+            return lambda features: [model.predict_proba(features)]
+        if hasattr(model, 'decision_function'):
+            self.output_kind = 'margin'
+            return lambda features: [model.decision_function(features)]
+        self.output_kind = 'prediction'
+        return lambda features: [model.predict(features)]
+
+    @property
+    def score_kind(self):
+        """What the returned scores are: "probability" once an activation applies, else output_kind."""
+        if self.activation == 'none' or (self.activation == 'auto' and self.output_kind in ('probability', 'prediction')):
+            return self.output_kind
+        return 'probability'
+
+    def __call__(self, features):
+        """
+        Score a batch.
+        :param features: (N, D) feature array
+        :return: ((N, K) float32 scores, (N,) attention logits or None); binary
+            probabilities are reduced to the positive class, K = 1
+        """
+        outputs = self._predict(np.ascontiguousarray(features, dtype=np.float32))
+        scores = np.asarray(outputs[0], dtype=np.float32).reshape((len(features), -1))
+        attention = np.asarray(outputs[1], dtype=np.float32).reshape(-1) if len(outputs) > 1 else None
+
+        activation = self.activation
+        if activation == 'auto':
+            if self.output_kind in ('probability', 'prediction'):
+                activation = 'none'
+            else:
+                activation = 'sigmoid' if scores.shape[1] == 1 else 'softmax'
+        if activation == 'sigmoid':
+            scores = _sigmoid(scores)
+        elif activation == 'softmax':
+            scores = _softmax(scores)
+        if scores.shape[1] == 2 and activation in ('none', 'softmax'):
+            scores = scores[:, 1:]
+        return scores, attention
+
+
+class ScorePooling:
+    """
+    Slide-level pooling of per-item scores, updated batch by batch.
+    Attention pooling keeps a running log-sum-exp, so memory does not grow
+    with the number of items.
+    """
+
+    def __init__(self, temperature=1.0):
+        """
+        :param temperature: Softmax temperature of attention weights derived
+            from the scores when the model has no attention output
+        """
+        self.temperature = temperature
+        self.count = 0
+        self._sum = None
+        self._max = None
+        self._attention_max = -np.inf
+        self._attention_norm = 0.0
+        self._attention_sum = None
+
+    def update(self, scores, attention=None):
+        """
+        :param scores: (N, K) scores of a batch
+        :param attention: (N,) attention logits, or None to attend to the highest score
+        """
+        if len(scores) == 0:
+            return
+        scores = np.asarray(scores, dtype=np.float64)
+        if attention is None:
+            attention = scores.max(axis=1) / self.temperature
+        attention = np.asarray(attention, dtype=np.float64)
+        if self._sum is None:
+            self._sum = np.zeros(scores.shape[1])
+            self._max = np.full(scores.shape[1], -np.inf)
+            self._attention_sum = np.zeros(scores.shape[1])
+        self.count += len(scores)
+        self._sum += scores.sum(axis=0)
+        self._max = np.maximum(self._max, scores.max(axis=0))
+
+        # Rescale the running sums whenever the maximum logit grows
+        batch_max = attention.max()
+        new_max = max(self._attention_max, batch_max)
+        rescale = np.exp(self._attention_max - new_max) if np.isfinite(self._attention_max) else 0.0
+        weights = np.exp(attention - new_max)
+        self._attention_norm = self._attention_norm * rescale + weights.sum()
+        self._attention_sum = self._attention_sum * rescale + weights @ scores
+        self._attention_max = new_max
+
+    def result(self):
+        """Dict of mean, max and attention pooled scores, one value per output."""
+        if not self.count:
+            return {'mean': None, 'max': None, 'attention': None}
+        return {
+            'mean': (self._sum / self.count).tolist(),
+            'max': self._max.tolist(),
+            'attention': (self._attention_sum / self._attention_norm).tolist(),
+        }
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Recompute the nuclei store and segmentation_metrics.json from an existing 0.dat.
+
+Both steps are checkpointed (see checkpoint.py): re-running after a change
+to the metrics code only recomputes the metrics, and re-running with
+unchanged inputs and code returns immediately.
+"""
+import argparse
+import json
+import logging
+import os
+
+import nuclei_store
+import segmentation_metrics
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from slide_metadata import SlideMetadata
+
+logger = logging.getLogger(__name__)
+
+
+def compute_metrics_stage(dat_path, output_dir, telemetry, checkpoint_dir=None, force=False, metadata=None):
+    """
+    Write output_dir/nuclei_store and output_dir/segmentation_metrics.json for a 0.dat file.
+    :param dat_path: HoVerNet 0.dat file
+    :param output_dir: Directory receiving the store and the metrics
+    :param telemetry: Telemetry of the calling stage
+    :param checkpoint_dir: Shared checkpoint store, or None for local stamps only
+    :param force: Recompute even when the checkpoints are current
+    :param metadata: SlideMetadata of the segmented image (default: slide_metadata.json
+        next to 0.dat); areas and densities stay in pixels without an MPP
+    :return: Metrics dict
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if metadata is None:
+        metadata = SlideMetadata.find(output_dir, os.path.dirname(os.path.abspath(dat_path)))
+    mpp = metadata.mpp if metadata is not None else None
+    tissue_area_mm2 = metadata.tissue_area_mm2 if metadata is not None else None
+    store_path = os.path.join(output_dir, 'nuclei_store')
+    store_checkpoint = Checkpoint(
+        'nuclei_store', inputs=[dat_path], code=[nuclei_store.__file__, segmentation_metrics.__file__],
+        store=checkpoint_dir, force=force,
+    )
+    with telemetry.step('write_store') as step:
+        if not store_checkpoint.restore([store_path]):
+            import joblib
+
+            nuclei_predictions = joblib.load(dat_path)
+            logger.info(f"Number of detected nuclei: {len(nuclei_predictions)}")
+            # Convert to the columnar nuclei store read by downstream stages
+            nuclei_store.write_nuclei_store(nuclei_predictions, store_path)
+            del nuclei_predictions
+            store_checkpoint.save([store_path])
+        store = nuclei_store.NucleiStore.open(store_path)
+        step.add_items(len(store), 'nuclei')
+    logger.info(f"Nuclei store saved to {store_path}")
+
+    # Calculate the metrics and save to a JSON file
+    metrics_output_path = os.path.join(output_dir, 'segmentation_metrics.json')
+    metrics_checkpoint = Checkpoint(
+        'metrics', inputs=[store_path], code=[segmentation_metrics.__file__],
+        params={'mpp': mpp, 'tissue_area_mm2': tissue_area_mm2},
+        store=checkpoint_dir, force=force,
+    )
+    with telemetry.step('metrics'):
+        if metrics_checkpoint.restore([metrics_output_path]):
+            with open(metrics_output_path) as f:
+                return json.load(f)
+        metrics = segmentation_metrics.calculate_metrics(store.columns(), mpp=mpp, tissue_area_mm2=tissue_area_mm2)
+        with open(metrics_output_path, 'w') as f:
+            json.dump(metrics, f, indent=4)
+        metrics_checkpoint.save([metrics_output_path])
+    logger.info(f"Segmentation metrics saved to {metrics_output_path}")
+    return metrics
+
+
+if __name__ == '__main__':
+    from telemetry import add_telemetry_arguments, start_telemetry
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Recompute segmentation metrics from an existing 0.dat")
+    parser.add_argument('--input', type=str, help='Path to the nuclei segmentation result file (0.dat)', required=True)
+    parser.add_argument('--output_dir', type=str, help='Directory for nuclei_store and segmentation_metrics.json (default: next to 0.dat)')
+    parser.add_argument('--metadata', type=str, help='slide_metadata.json of the segmented image (default: the one next to 0.dat)')
+    parser.add_argument('--mask', type=str, help='Tissue mask PNG, for densities per mm² of tissue')
+    add_checkpoint_arguments(parser)
+    add_telemetry_arguments(parser)
+    args = parser.parse_args()
+    telemetry = start_telemetry('compute_metrics', args)
+
+    output_dir = args.output_dir or os.path.dirname(os.path.abspath(args.input))
+    metadata = SlideMetadata.load(args.metadata) if args.metadata else SlideMetadata.find(os.path.dirname(os.path.abspath(args.input)))
+    if metadata is not None and args.mask:
+        from mask_utils import load_mask
+
+        metadata = metadata.with_tissue_area(float(load_mask(args.mask).mean()))
+    metrics = compute_metrics_stage(args.input, output_dir, telemetry, args.checkpoint_dir, args.force, metadata)
+    print(f"{metrics['total_nuclei']} nuclei, metrics saved to {os.path.join(output_dir, 'segmentation_metrics.json')}")
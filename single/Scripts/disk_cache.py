@@ -0,0 +1,104 @@
+"""Size-bounded on-disk cache of NumPy arrays shared between pipeline tasks.
+
+Entries are ``<key>.npz`` files written to a temporary name and moved into
+place with ``os.replace``, so concurrent Nextflow tasks on shared storage only
+ever see complete entries. Eviction is least-recently-used by mtime, which
+``get`` refreshes on every hit. Two tasks missing the same key at once both
+compute and store it; the last rename wins and both results are identical.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Default cache location for all stages, e.g. a directory on shared storage
+CACHE_DIR_ENV = 'TIA_PIPELINE_CACHE'
+
+
+def make_key(*parts):
+    """Hash strings, numbers and arrays into a hex cache key."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(str((part.dtype.str, part.shape)).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes=64 * 2**20):
+        """
+        :param directory: Cache directory, created if missing
+        :param max_bytes: Total size the cache is trimmed to after each write
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def get(self, key):
+        """Return the cached dict of arrays for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            logger.warning(f"Dropping unreadable cache entry {path}: {e}")
+            self._remove(path)
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        """Atomically store a dict of arrays under key, then enforce the size bound."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self, stale_tmp_seconds=3600):
+        """Delete least recently used entries until the cache fits max_bytes."""
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith('.npz'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            elif entry.name.endswith('.tmp') and now - stat.st_mtime > stale_tmp_seconds:
+                # Left behind by a task that was killed mid-write
+                self._remove(entry.path)
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,21 +1,75 @@
-from tiatoolbox.tools.patchextraction import PatchExtractor
-from tiatoolbox.wsicore.wsireader import WSIReader
+from mask_utils import load_mask
+from prefetch import RegionPrefetcher, add_prefetch_arguments
+from telemetry import add_telemetry_arguments, start_telemetry
+from tile_store import EXTENSIONS, TileStoreWriter
+from wsi_cache import add_cache_arguments, open_wsi
 import argparse
+import os
 
 parser = argparse.ArgumentParser(description="Tile Extraction")
 parser.add_argument('--input', type=str, help='Path to WSI file')
 #parser.add_argument('--heatmap', type=str, help='Path to heatmap image')
-parser.add_argument('--output', type=str, help='Output directory to save extracted tiles')
+parser.add_argument('--output', type=str, help='Output tile store directory (or directory of PNGs with --format png)')
+parser.add_argument('--mask', type=str, help='Path to tissue mask PNG from tissue_mask.py', default=None)
+parser.add_argument('--min_tissue', type=float, default=0.5, help='Minimum tissue fraction for a tile to be extracted')
+parser.add_argument('--format', type=str, choices=['tar', 'png'], default='tar', help='Sharded tar tile store or legacy one PNG per tile')
+parser.add_argument('--encoding', type=str, choices=sorted(EXTENSIONS), default='png', help='Encoding of tiles inside the tar shards')
+parser.add_argument('--quality', type=int, default=90, help='JPEG quality for --encoding jpeg')
+parser.add_argument('--tiles_per_shard', type=int, default=4096, help='Number of tiles per tar shard')
+parser.add_argument('--workers', type=int, default=4, help='Number of threads encoding tiles')
+add_cache_arguments(parser)
+add_prefetch_arguments(parser)
+add_telemetry_arguments(parser)
 
 args = parser.parse_args()
+telemetry = start_telemetry('extract_tiles', args)
+os.makedirs(args.output, exist_ok=True)
 
 # Load the WSI
-wsi = WSIReader.open(args.input)
+wsi = open_wsi(args.input, args.cache_dir, args.cache_max_mb)
 
-# Extract high-density tiles based on a fixed grid
-patch_extractor = PatchExtractor(tile_shape=(512, 512), stride_shape=(256, 256))
-tiles = patch_extractor.extract(wsi)
+# Load the tissue mask; the extractor scales it to the slide and skips tiles
+# whose tissue fraction is below --min_tissue
+mask = load_mask(args.mask).astype('uint8') if args.mask else None
+
+# Extract tiles on a fixed grid, restricted to tissue when a mask is given
+from tiatoolbox.tools.patchextraction import get_patch_extractor
+
+patch_extractor = get_patch_extractor(
+    method_name="slidingwindow",
+    input_img=wsi.reader,
+    input_mask=mask,
+    patch_size=(512, 512),
+    stride=(256, 256),
+    resolution=0,
+    units="level",
+    min_mask_ratio=args.min_tissue if mask is not None else 0,
+)
+
+# coordinate_list holds the (x_start, y_start, x_end, y_end) of the kept tiles;
+# they are read and decoded on --read_workers threads ahead of encoding
+prefetcher = RegionPrefetcher.for_path(args.input, workers=args.read_workers, read_ahead=args.read_ahead)
+coordinates = patch_extractor.coordinate_list
+tiles = zip(
+    prefetcher.read_rects([(int(x), int(y)) for x, y, _, _ in coordinates], tuple(patch_extractor.patch_size), resolution=0, units="level"),
+    coordinates,
+)
 
 # Save the tiles
-for i, tile in enumerate(tiles):
-    tile.save(f'{args.output}/tile_{i}.png')
+telemetry.add_items(len(patch_extractor.coordinate_list), 'tiles')
+if args.format == 'png':
+    from PIL import Image
+
+    for i, (tile, _) in enumerate(tiles):
+        Image.fromarray(tile).save(f'{args.output}/tile_{i}.png')
+else:
+    with TileStoreWriter(
+        args.output,
+        encoding=args.encoding,
+        quality=args.quality,
+        tiles_per_shard=args.tiles_per_shard,
+        workers=args.workers,
+    ) as writer:
+        count = writer.write_all(tiles)
+    print(f"Saved {count} tiles in {len(writer.shards)} shards to {args.output}")
+prefetcher.close()
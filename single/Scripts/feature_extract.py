@@ -2,59 +2,122 @@
 
 import os
 import argparse
-import joblib
-import numpy as np
-import pandas as pd
+import logging
+import time
+from functools import partial
 from pathlib import Path
-from tiatoolbox.models import DeepFeatureExtractor
-from tiatoolbox.models.architecture.vanilla import CNNBackbone
+import feature_store
+import patch_features
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from feature_store import CsvFeatureWriter, FeatureWriter
+from model_client import ModelClient, default_server
+from nuclei_store import load_nuclei
+from prefetch import add_prefetch_arguments
+from patch_features import NucleusPatchDataset, extract_batch, iter_patch_features, load_backbone
+from slide_metadata import STAGE_MPP, SlideMetadata
+from telemetry import add_telemetry_arguments, start_telemetry
+
+logging.basicConfig(level=logging.INFO)
+
+BACKBONE = "resnet50"
 
 # Command-line arguments
 parser = argparse.ArgumentParser(description="Deep Feature Extraction for Nuclei Segmentation Results")
-parser.add_argument('--input', type=str, help='Path to the nuclei segmentation result file (0.dat)', required=True)
-parser.add_argument('--output', type=str, help='Path to save extracted features as CSV', required=True)
+parser.add_argument('--input', type=str, help='Path to the nuclei store directory or segmentation result file (0.dat)', required=True)
+parser.add_argument('--image', type=str, help='Path to the WSI or normalized image the nuclei were segmented on', required=True)
+parser.add_argument('--output', type=str, help='Path of the feature store directory (or CSV file with --format csv)', required=True)
+parser.add_argument('--format', type=str, choices=['npy', 'csv'], default='npy', help='Chunked NPY feature store or legacy CSV')
+parser.add_argument('--dtype', type=str, choices=['float16', 'float32'], default='float16', help='Storage dtype of the feature vectors')
 parser.add_argument('--gpu', action='store_true', help='Use GPU for processing')
+parser.add_argument('--batch_size', type=int, default=64, help='Number of patches per forward pass')
+parser.add_argument('--patch_size', type=int, default=224, help='Patch size in pixels around each nucleus centroid')
+parser.add_argument('--patch_mpp', type=float, default=None, help='Resolution patches are read at in microns per pixel (default: 0.5, never finer than the image; 0 reads baseline pixels)')
+parser.add_argument('--metadata', type=str, default=None, help='slide_metadata.json of --image (default: the one next to the nuclei, else read from the image)')
+parser.add_argument('--num_loader_workers', type=int, default=min(8, os.cpu_count() or 1), help='Number of processes reading patches')
+parser.add_argument('--server', type=str, default=default_server(), help='URL of a running model_server.py (default: $TIA_MODEL_SERVER); runs the model in-process when unset')
+add_checkpoint_arguments(parser)
+add_prefetch_arguments(parser)
+add_telemetry_arguments(parser)
 
 args = parser.parse_args()
+telemetry = start_telemetry('feature_extract', args)
 
-# Load nuclei segmentation result from the .dat file
-if os.path.exists(args.input):
-    nuclei_result = joblib.load(args.input)
-    print(f"Loaded segmentation result from {args.input}")
-    print(nuclei_result)
+# The nuclei centroids are baseline pixels of --image, whose MPP sets the patch scale
+if args.metadata:
+    metadata = SlideMetadata.load(args.metadata)
 else:
-    raise FileNotFoundError(f"Nuclei segmentation result file {args.input} not found.")
-
-# Initialize ResNet50 model for feature extraction
-model = CNNBackbone("resnet50")
-extractor = DeepFeatureExtractor(batch_size=16, model=model, num_loader_workers=4)
-
-# Placeholder for features
-features_list = []
-
-# Loop through each instance (nucleus) in the segmentation result
-for instance_id, instance_data in nuclei_result.items():
-    # Extract the bounding box of the nucleus and the instance mask
-    instance_mask = instance_data["mask"]
-    
-    # Resize the mask to match the input size for ResNet (224x224)
-    resized_instance = np.resize(instance_mask, (224, 224, 3))  # Assuming it's a 3-channel mask
-    
-    # Run the ResNet model to extract features
-    extracted_features = extractor.model.predict(resized_instance)
-    
-    # Flatten the feature vector and add it to the list
-    features_list.append(extracted_features.flatten())
-
-# Convert features to a DataFrame
-df = pd.DataFrame(features_list)
-print(df)
+    input_dir = os.path.dirname(os.path.abspath(args.input))
+    metadata = SlideMetadata.find(input_dir, os.path.dirname(input_dir))
+if metadata is None:
+    from tiatoolbox.wsicore.wsireader import WSIReader
+
+    metadata = SlideMetadata.from_reader(WSIReader.open(args.image))
+patch_mpp = None if args.patch_mpp == 0 else metadata.read_mpp(args.patch_mpp or STAGE_MPP['features'])
+print(f"Reading {args.patch_size}px patches at {patch_mpp or 'baseline'} mpp (image baseline {metadata.mpp} mpp)")
+
+# Skip extraction when these nuclei and this image were processed with the same settings before
+checkpoint = Checkpoint(
+    'feature_extract',
+    inputs=[args.input, args.image],
+    params={'backbone': BACKBONE, 'patch_size': args.patch_size, 'patch_mpp': patch_mpp, 'format': args.format, 'dtype': args.dtype},
+    code=[__file__, patch_features.__file__, feature_store.__file__],
+    store=args.checkpoint_dir,
+    force=args.force,
+)
+if checkpoint.restore([args.output]):
+    print(f"Features in {args.output} are up to date")
+    exit(0)
+
+# Load nuclei segmentation result from the nuclei store (or convert a .dat file)
+nuclei_store = load_nuclei(args.input)
+print(f"Loaded {len(nuclei_store)} nuclei from {args.input}")
+
+# Initialize ResNet50 model for feature extraction, or use the warm model server
+on_gpu = False
+if args.server:
+    client = ModelClient(args.server)
+
+    def extract(patches):
+        return client.features(patches.numpy())
+
+    print(f"Running feature extraction on model server {args.server}")
+else:
+    import torch
+
+    on_gpu = args.gpu and torch.cuda.is_available()
+    with telemetry.step('load_model'):
+        model, device = load_backbone(BACKBONE, on_gpu=on_gpu)
+    extract = partial(extract_batch, model, device)
+    print(f"Running feature extraction on {device}")
 
 # Ensure the output directory exists
 output_path = Path(args.output)
 output_dir = output_path.parent
 output_dir.mkdir(parents=True, exist_ok=True)
 
-# Save extracted features to CSV
-df.to_csv(args.output, index=False)
+if args.format == 'csv':
+    writer = CsvFeatureWriter(args.output, dtype=args.dtype)
+else:
+    writer = FeatureWriter(args.output, dtype=args.dtype)
+
+# Crop a patch around every nucleus centroid, run the model in batches and
+# write each batch out with the nucleus id and centroid as it arrives
+ids = nuclei_store['id']
+centroids = nuclei_store['centroid']
+dataset = NucleusPatchDataset(
+    args.image, centroids, patch_size=args.patch_size, patch_mpp=patch_mpp, image_mpp=metadata.mpp,
+    read_workers=args.read_workers, read_ahead=args.read_ahead,
+)
+start_time = time.perf_counter()
+with telemetry.step('extract') as step, writer:
+    step.add_items(len(dataset), 'patches')
+    for start, batch_features in iter_patch_features(
+        dataset, extract, batch_size=args.batch_size, num_workers=args.num_loader_workers, pin_memory=on_gpu
+    ):
+        stop = start + len(batch_features)
+        writer.write(ids[start:stop], centroids[start:stop], batch_features)
+elapsed = time.perf_counter() - start_time
+checkpoint.save([args.output])
+
+print(f"Extracted features for {len(dataset)} nuclei, {len(dataset) / max(elapsed, 1e-9):.1f} patches/sec")
 print(f"Feature extraction completed. Results saved to {args.output}")
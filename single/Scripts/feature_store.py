@@ -0,0 +1,207 @@
+"""Chunked, columnar on-disk storage for per-nucleus feature vectors.
+
+A feature store is a directory of parts written as rows arrive:
+
+- ``part-NNNNN.features.npy`` (rows, dim) in float16 or float32
+- ``part-NNNNN.ids.npy`` nucleus ids as strings
+- ``part-NNNNN.centroids.npy`` (rows, 2) float64
+- ``manifest.json`` listing the parts, written last
+
+Readers memory-map one part at a time, so files larger than RAM can be
+streamed in batches.
+"""
+import json
+import os
+
+import numpy as np
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+
+
+class FeatureWriter:
+    """Buffer feature rows and flush them to fixed-size parts."""
+
+    def __init__(self, path, dtype='float16', rows_per_part=65536, column_names=None):
+        """
+        :param path: Output feature store directory
+        :param dtype: Storage dtype of the feature matrix
+        :param rows_per_part: Rows per part file; bounds the writer's memory
+        :param column_names: Optional names of the feature columns
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.rows_per_part = rows_per_part
+        self.column_names = list(column_names) if column_names is not None else None
+        self.parts = []
+        self.dim = None
+        self._buffer = []
+        self._buffered = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, ids, centroids, features):
+        """Append a batch of rows."""
+        features = np.asarray(features)
+        if self.dim is None:
+            self.dim = features.shape[1]
+        elif features.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim} features per row, got {features.shape[1]}")
+        self._buffer.append((
+            np.asarray(ids).astype(str),
+            np.asarray(centroids, dtype=np.float64).reshape((-1, 2)),
+            features.astype(self.dtype),
+        ))
+        self._buffered += len(features)
+        while self._buffered >= self.rows_per_part:
+            self._flush(self.rows_per_part)
+
+    def _flush(self, rows):
+        ids, centroids, features = (np.concatenate(column) for column in zip(*self._buffer))
+        name = f'part-{len(self.parts):05d}'
+        np.save(os.path.join(self.path, f'{name}.ids.npy'), ids[:rows])
+        np.save(os.path.join(self.path, f'{name}.centroids.npy'), centroids[:rows])
+        np.save(os.path.join(self.path, f'{name}.features.npy'), features[:rows])
+        self.parts.append({'name': name, 'rows': int(rows)})
+        self._buffer = [(ids[rows:], centroids[rows:], features[rows:])] if len(ids) > rows else []
+        self._buffered = len(ids) - rows
+
+    def close(self):
+        """Flush remaining rows and write the manifest."""
+        if self._buffered:
+            self._flush(self._buffered)
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'rows': sum(part['rows'] for part in self.parts),
+            'dim': self.dim or 0,
+            'dtype': self.dtype.name,
+            'column_names': self.column_names,
+            'parts': self.parts,
+        }
+        tmp_path = os.path.join(self.path, f'{MANIFEST}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+class CsvFeatureWriter:
+    """Same interface as FeatureWriter, appending rows to a CSV file."""
+
+    def __init__(self, path, dtype='float32', column_names=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.column_names = column_names
+        self._header = True
+
+    def write(self, ids, centroids, features):
+        import pandas as pd
+
+        centroids = np.asarray(centroids).reshape((-1, 2))
+        df = pd.DataFrame(np.asarray(features, dtype=self.dtype), columns=self.column_names)
+        df.insert(0, 'centroid_y', centroids[:, 1])
+        df.insert(0, 'centroid_x', centroids[:, 0])
+        df.insert(0, 'id', np.asarray(ids).astype(str))
+        df.to_csv(self.path, mode='w' if self._header else 'a', header=self._header, index=False)
+        self._header = False
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class FeatureReader:
+    """Lazy reader for a feature store directory."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    @property
+    def dim(self):
+        return self.manifest['dim']
+
+    @property
+    def column_names(self):
+        return self.manifest.get('column_names')
+
+    def _load(self, part, column):
+        return np.load(os.path.join(self.path, f"{part['name']}.{column}.npy"), mmap_mode='r')
+
+    def iter_batches(self, batch_size=None, dtype=np.float32):
+        """
+        Yield dicts of 'ids', 'centroids' and 'features' batches.
+        :param batch_size: Rows per batch (default: one part per batch)
+        :param dtype: Dtype the features are converted to
+        """
+        for part in self.manifest['parts']:
+            ids = self._load(part, 'ids')
+            centroids = self._load(part, 'centroids')
+            features = self._load(part, 'features')
+            step = batch_size or part['rows']
+            for start in range(0, part['rows'], step):
+                stop = start + step
+                yield {
+                    'ids': np.asarray(ids[start:stop]),
+                    'centroids': np.asarray(centroids[start:stop]),
+                    'features': np.asarray(features[start:stop], dtype=dtype),
+                }
+
+    def read_all(self, dtype=np.float32):
+        """Load the whole store into memory; only for small stores."""
+        batches = list(self.iter_batches(dtype=dtype))
+        if not batches:
+            return {'ids': np.zeros(0, dtype=str), 'centroids': np.zeros((0, 2)),
+                    'features': np.zeros((0, self.dim), dtype=dtype)}
+        return {key: np.concatenate([batch[key] for batch in batches]) for key in batches[0]}
+
+
+def iter_joined_batches(readers, batch_size=None, dtype=np.float32):
+    """
+    Batches of several feature stores describing the same rows, e.g. deep,
+    morphology and cell graph features of one nuclei store, with the features
+    concatenated column-wise. Parts of different sizes are re-aligned.
+    :param readers: FeatureReaders with the same ids in the same order
+    :param batch_size: Rows per batch of each store (default: one part per batch)
+    :param dtype: Dtype the features are converted to
+    """
+    if len({len(reader) for reader in readers}) > 1:
+        raise ValueError(f"Feature stores have different row counts: {[len(reader) for reader in readers]}")
+    iterators = [reader.iter_batches(batch_size=batch_size, dtype=dtype) for reader in readers]
+    pending = [None] * len(readers)
+    while True:
+        for i, iterator in enumerate(iterators):
+            while pending[i] is None or not len(pending[i]['ids']):
+                pending[i] = next(iterator, None)
+                if pending[i] is None:
+                    return
+        rows = min(len(batch['ids']) for batch in pending)
+        heads = [{key: value[:rows] for key, value in batch.items()} for batch in pending]
+        pending = [{key: value[rows:] for key, value in batch.items()} for batch in pending]
+        for reader, head in zip(readers[1:], heads[1:]):
+            if not np.array_equal(head['ids'], heads[0]['ids']):
+                raise ValueError(f"Rows of {reader.path} do not match {readers[0].path}")
+        yield {
+            'ids': heads[0]['ids'],
+            'centroids': heads[0]['centroids'],
+            'features': np.concatenate([head['features'] for head in heads], axis=1),
+        }
+
+
+def is_feature_store(path):
+    """True if path is a feature store directory."""
+    return os.path.isfile(os.path.join(path, MANIFEST))
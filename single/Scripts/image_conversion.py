@@ -1,12 +1,12 @@
-import tifffile
-from PIL import Image
-import joblib
 import os
+import tempfile
 import numpy as np
 
 def load_metadata(metadata_path):
     """Load metadata from a pickle file."""
     if os.path.exists(metadata_path):
+        import joblib
+
         with open(metadata_path, 'rb') as f:
             metadata = joblib.load(f)
             print(f"Loaded metadata from {metadata_path}")
@@ -14,16 +14,19 @@ def load_metadata(metadata_path):
     else:
         raise FileNotFoundError(f"Metadata file {metadata_path} not found.")
 
-def convert_png_to_tiff(input_path, output_path, metadata=None, mpp=None):
+def convert_png_to_tiff(input_path, output_path, metadata=None, mpp=None, tile_size=512):
     """
-    Convert a PNG image to TIFF and optionally embed metadata.
+    Convert a PNG image to a tiled, pyramidal TIFF and optionally embed its MPP.
     :param input_path: Path to the input PNG image
     :param output_path: Path to save the output TIFF image
     :param metadata: Metadata dictionary from which MPP can be extracted
     :param mpp: Tuple specifying Microns Per Pixel (MPP) for X and Y axes
+    :param tile_size: Tile edge in pixels, must be a multiple of 16
     :return: Path to the saved TIFF image
     """
     if input_path.endswith(".png"):
+        from PIL import Image
+
         print("Converting PNG to TIFF...")
         img = Image.open(input_path)
         img = img.convert("RGB")  # Ensure it's in the correct mode (RGB)
@@ -38,16 +41,112 @@ def convert_png_to_tiff(input_path, output_path, metadata=None, mpp=None):
         # Prepare the TIFF output path
         tiff_output_path = output_path.replace(".png", ".tiff")
         
-        # Prepare the metadata description
-        description = None
-        if mpp:
-            description = f'mpp_x={mpp[0]}, mpp_y={mpp[1]}'
+        if mpp is not None:
             print(f"Embedding MPP into TIFF: {mpp}")
         
-        # Save the image as TIFF with embedded metadata
-        tifffile.imwrite(tiff_output_path, image_data, description=description)
+        # Save the image as a tiled pyramid so readers can access regions partially
+        write_pyramidal_tiff(
+            tiff_output_path,
+            iter_array_tiles(image_data, tile_size),
+            image_data.shape,
+            tile_size=tile_size,
+            mpp=mpp,
+        )
 
         print(f"Converted image saved at: {tiff_output_path}")
         return tiff_output_path
     else:
         return input_path
+
+def pyramid_shapes(shape, tile_size):
+    """
+    Compute the (height, width) of every level of a 2x downsampled pyramid.
+    :param shape: Shape of the full resolution image
+    :param tile_size: Tile size; the pyramid stops once a level fits in one tile
+    :return: List of (height, width) tuples, full resolution first
+    """
+    shapes = [(int(shape[0]), int(shape[1]))]
+    while max(shapes[-1]) > tile_size:
+        height, width = shapes[-1]
+        shapes.append(((height + 1) // 2, (width + 1) // 2))
+    return shapes
+
+def iter_array_tiles(array, tile_size):
+    """Yield zero-padded tiles of an (H, W, C) array in row-major order."""
+    height, width = array.shape[:2]
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tile = np.zeros((tile_size, tile_size, array.shape[2]), dtype=array.dtype)
+            region = array[y:y + tile_size, x:x + tile_size]
+            tile[:region.shape[0], :region.shape[1]] = region
+            yield tile
+
+def _downsample_into(tiles, shape, tile_size, target):
+    """Pass tiles through unchanged while writing their 2x downsample into target."""
+    half = tile_size // 2
+    n_cols = -(-shape[1] // tile_size)
+    for i, tile in enumerate(tiles):
+        row, col = divmod(i, n_cols)
+        small = tile.reshape(half, 2, half, 2, -1).mean(axis=(1, 3))
+        region = target[row * half:(row + 1) * half, col * half:(col + 1) * half]
+        region[...] = small[:region.shape[0], :region.shape[1]]
+        yield tile
+
+def write_pyramidal_tiff(output_path, tiles, shape, tile_size=512, mpp=None, compression='zlib'):
+    """
+    Stream tiles into a tiled, pyramidal OME-TIFF.
+    Only one tile per level is held in memory; reduced levels are accumulated
+    in disk-backed scratch arrays next to the output and written afterwards.
+    :param output_path: Path to save the output TIFF image
+    :param tiles: Iterable of (tile_size, tile_size, 3) uint8 tiles in row-major order
+    :param shape: (height, width, 3) of the full resolution image
+    :param tile_size: Tile edge in pixels, must be a multiple of 16
+    :param mpp: Tuple specifying Microns Per Pixel (MPP) for X and Y axes
+    :param compression: Tile compression passed to tifffile
+    :return: Path to the saved TIFF image
+    """
+    import tifffile
+
+    shapes = pyramid_shapes(shape, tile_size)
+    options = dict(
+        tile=(tile_size, tile_size),
+        photometric='rgb',
+        compression=compression,
+        dtype=np.uint8,
+    )
+    metadata = {'axes': 'YXS'}
+    if mpp is not None:
+        metadata.update(
+            PhysicalSizeX=float(mpp[0]), PhysicalSizeXUnit='µm',
+            PhysicalSizeY=float(mpp[1]), PhysicalSizeYUnit='µm',
+        )
+
+    scratch_root = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.TemporaryDirectory(dir=scratch_root) as scratch, \
+            tifffile.TiffWriter(output_path, bigtiff=True, ome=True) as tif:
+        for level, level_shape in enumerate(shapes):
+            if level + 1 < len(shapes):
+                next_level = np.lib.format.open_memmap(
+                    os.path.join(scratch, f'level_{level + 1}.npy'),
+                    mode='w+', dtype=np.uint8, shape=(*shapes[level + 1], 3),
+                )
+                tiles = _downsample_into(tiles, level_shape, tile_size, next_level)
+
+            kwargs = {}
+            if mpp is not None:
+                scale = 2 ** level
+                kwargs.update(
+                    resolution=(1e4 / (mpp[0] * scale), 1e4 / (mpp[1] * scale)),
+                    resolutionunit='CENTIMETER',
+                )
+            if level == 0:
+                tif.write(tiles, shape=(*level_shape, 3), subifds=len(shapes) - 1,
+                          metadata=metadata, **kwargs, **options)
+            else:
+                tif.write(tiles, shape=(*level_shape, 3), subfiletype=1, **kwargs, **options)
+
+            if level + 1 < len(shapes):
+                tiles = iter_array_tiles(next_level, tile_size)
+
+    print(f"Pyramidal TIFF saved at: {output_path} ({len(shapes)} levels)")
+    return output_path
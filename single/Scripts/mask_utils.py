@@ -0,0 +1,63 @@
+"""Tissue mask helpers shared by the segmentation and tiling stages."""
+import numpy as np
+
+
+def load_mask(mask_path):
+    """Load a tissue mask image (e.g. from tissue_mask.py) as a boolean array."""
+    from PIL import Image
+
+    with Image.open(mask_path) as mask_image:
+        return np.asarray(mask_image.convert('L')) > 0
+
+
+def tissue_fractions(mask, shape, grid, tile_size):
+    """
+    Fraction of tissue under each tile of a grid.
+    :param mask: Low resolution boolean tissue mask covering the whole image
+    :param shape: (height, width) of the image the grid refers to
+    :param grid: List of (x, y) tile origins in that image
+    :param tile_size: Tile edge in pixels
+    :return: Array with one fraction per tile
+    """
+    scale_y = mask.shape[0] / shape[0]
+    scale_x = mask.shape[1] / shape[1]
+    fractions = np.zeros(len(grid))
+    for i, (x, y) in enumerate(grid):
+        y0, x0 = int(y * scale_y), int(x * scale_x)
+        y1 = max(int(np.ceil((y + tile_size) * scale_y)), y0 + 1)
+        x1 = max(int(np.ceil((x + tile_size) * scale_x)), x0 + 1)
+        region = mask[y0:y1, x0:x1]
+        fractions[i] = region.mean() if region.size else 0.0
+    return fractions
+
+
+def filter_mask_by_tissue(mask, shape, tile_size, min_tissue):
+    """
+    Clear every tile of the mask whose tissue fraction is below min_tissue.
+    :param mask: Boolean tissue mask covering the whole image
+    :param shape: (height, width) of the image at the working resolution
+    :param tile_size: Tile edge in pixels at the working resolution
+    :param min_tissue: Minimum tissue fraction for a tile to be kept
+    :return: (filtered mask, fraction of tiles kept)
+    """
+    height, width = shape[:2]
+    grid = [(x, y) for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+    fractions = tissue_fractions(mask, shape, grid, tile_size)
+
+    filtered = mask.copy()
+    scale_y = mask.shape[0] / height
+    scale_x = mask.shape[1] / width
+    for (x, y), fraction in zip(grid, fractions):
+        if fraction < min_tissue:
+            filtered[int(y * scale_y):int((y + tile_size) * scale_y),
+                     int(x * scale_x):int((x + tile_size) * scale_x)] = False
+    kept = float((fractions >= min_tissue).mean()) if len(grid) else 0.0
+    return filtered, kept
+
+
+def save_mask(mask, mask_path):
+    """Save a boolean mask as an 8-bit PNG."""
+    from PIL import Image
+
+    Image.fromarray(mask.astype(np.uint8) * 255).save(mask_path)
+    return mask_path
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import os
+import shards
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from compute_metrics import compute_metrics_stage
+from shards import load_shard_info, merge_shard_predictions
+from slide_metadata import METADATA_FILE, SlideMetadata
+from telemetry import add_telemetry_arguments, start_telemetry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description="Merge sharded nuclei segmentation results")
+parser.add_argument('--inputs', type=str, nargs='+', help='Output directories of the shard runs of nuclei_segmentation.py', required=True)
+parser.add_argument('--output_dir', type=str, help='Directory to save the merged results', required=True)
+add_checkpoint_arguments(parser)
+add_telemetry_arguments(parser)
+args = parser.parse_args()
+telemetry = start_telemetry('merge_shards', args)
+
+import joblib
+
+# Check that every shard of the plan is present exactly once
+shard_infos = [load_shard_info(shard_dir) for shard_dir in args.inputs]
+num_shards = shard_infos[0]['num_shards']
+indices_by_input = [info['index'] for info in shard_infos]
+indices = sorted(indices_by_input)
+if indices != list(range(num_shards)):
+    raise ValueError(f"Expected shards 0..{num_shards - 1}, got {indices}")
+
+
+def iter_shards():
+    # Load one shard at a time to keep only the merged result in memory
+    for shard_dir, info in zip(args.inputs, shard_infos):
+        shard_predictions = joblib.load(os.path.join(shard_dir, '0.dat'))
+        logger.info(f"Shard {info['index']}: {len(shard_predictions)} nuclei in region {info['region']}")
+        yield info, shard_predictions
+
+
+# Skip the merge when the same shards were merged before
+os.makedirs(args.output_dir, exist_ok=True)
+inst_map_path = os.path.join(args.output_dir, '0.dat')
+metadata_path = os.path.join(args.output_dir, METADATA_FILE)
+merge_checkpoint = Checkpoint(
+    'merge_shards', inputs=[shard_dir for _, shard_dir in sorted(zip(indices_by_input, args.inputs))],
+    code=[__file__, shards.__file__], store=args.checkpoint_dir, force=args.force,
+)
+if not merge_checkpoint.restore([inst_map_path, metadata_path]):
+    with telemetry.step('merge') as step:
+        nuclei_predictions = merge_shard_predictions(iter_shards())
+        step.add_items(len(nuclei_predictions), 'nuclei')
+    logger.info(f"Merged {num_shards} shards into {len(nuclei_predictions)} nuclei")
+
+    # Save in the same layout as a single-process run
+    joblib.dump(nuclei_predictions, inst_map_path)
+    del nuclei_predictions
+    # Every shard was segmented on the same image
+    SlideMetadata.load(os.path.join(args.inputs[0], METADATA_FILE)).save(metadata_path)
+    merge_checkpoint.save([inst_map_path, metadata_path])
+    logger.info(f"Merged segmentation results saved to {inst_map_path}")
+
+# Convert to the nuclei store, calculate the metrics and save to a JSON file
+compute_metrics_stage(inst_map_path, args.output_dir, telemetry, args.checkpoint_dir, args.force)
@@ -0,0 +1,65 @@
+"""Client for model_server.py."""
+import io
+import json
+import os
+import urllib.request
+
+import numpy as np
+
+SERVER_ENV = 'TIA_MODEL_SERVER'
+
+
+def default_server():
+    """Server URL from the environment, or None to run models in-process."""
+    return os.environ.get(SERVER_ENV) or None
+
+
+class ModelClient:
+    def __init__(self, url, timeout=None):
+        """
+        :param url: Base URL of a running model_server.py, e.g. http://127.0.0.1:8765
+        :param timeout: Request timeout in seconds (default: wait indefinitely)
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _post(self, endpoint, body, content_type):
+        request = urllib.request.Request(
+            f'{self.url}/{endpoint}', data=body, headers={'Content-Type': content_type}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read()
+
+    def health(self):
+        with urllib.request.urlopen(f'{self.url}/health', timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def features(self, patches):
+        """
+        Deep features for a batch of patches.
+        :param patches: (B, H, W, 3) uint8 array
+        :return: (B, D) float32 array
+        """
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(patches, dtype=np.uint8))
+        body = self._post('features', buffer.getvalue(), 'application/octet-stream')
+        return np.load(io.BytesIO(body), allow_pickle=False)
+
+    def segment(self, input_path, save_dir, mode='tile', mask=None, mpp=None):
+        """
+        Run HoVerNet on an image; the result is written to save_dir/0.dat.
+        :param input_path: Image or WSI path readable by the server
+        :param save_dir: Output directory readable and writable by the server
+        :param mode: "wsi" or "tile"
+        :param mask: Optional tissue mask path
+        :param mpp: Baseline (x, y) MPP of the WSI (default: as recorded in the slide)
+        """
+        request = {
+            'input': os.path.abspath(input_path),
+            'save_dir': os.path.abspath(save_dir),
+            'mode': mode,
+            'mask': os.path.abspath(mask) if mask else None,
+            'mpp': [float(v) for v in mpp] if mpp is not None else None,
+        }
+        body = self._post('segment', json.dumps(request).encode(), 'application/json')
+        return json.loads(body)
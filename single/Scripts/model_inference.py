@@ -1,24 +1,102 @@
-import pandas as pd
 import argparse
+import json
+import os
+import numpy as np
+from classifier import Classifier, ScorePooling
+from feature_store import CsvFeatureWriter, FeatureReader, FeatureWriter, is_feature_store, iter_joined_batches
+from telemetry import add_telemetry_arguments, start_telemetry
 
 parser = argparse.ArgumentParser(description="Model Inference")
-parser.add_argument('--input', type=str, help='Path to extracted features')
-parser.add_argument('--output', type=str, help='Path to save model prediction')
+parser.add_argument('--input', type=str, nargs='+', help='Path to extracted features (feature store directory or CSV); several feature stores of the same nuclei, e.g. deep, morphology and cell graph features, are joined column-wise')
+parser.add_argument('--output', type=str, help='Path to save the slide-level prediction (JSON)')
+parser.add_argument('--model', type=str, required=True, help='Serialized classifier: scikit-learn (.joblib/.pkl), TorchScript/torch (.pt) or ONNX (.onnx)')
+parser.add_argument('--scores', type=str, default=None, help='Also write per-item scores: a feature store directory, or CSV when ending in .csv')
+parser.add_argument('--batch_size', type=int, default=8192, help='Feature rows per model call; bounds memory use')
+parser.add_argument('--pooling', type=str, choices=['mean', 'max', 'attention'], default='mean', help='Slide-level pooling the prediction is based on')
+parser.add_argument('--temperature', type=float, default=1.0, help='Softmax temperature of score-derived attention weights')
+parser.add_argument('--activation', type=str, choices=['auto', 'sigmoid', 'softmax', 'none'], default='auto', help='Activation applied to the model outputs')
+parser.add_argument('--threshold', type=float, default=None, help='Decision threshold of a single pooled score (default: 0.5 for probabilities, 0 for raw margins or logits)')
+parser.add_argument('--labels', type=str, nargs='+', default=['Non-cancerous', 'Cancerous'], help='Slide labels, by class index')
+parser.add_argument('--gpu', action='store_true', help='Use GPU for torch and ONNX models')
+add_telemetry_arguments(parser)
 
 args = parser.parse_args()
+if len(args.input) > 1 and not all(is_feature_store(path) for path in args.input):
+    parser.error('several --input paths must all be feature stores')
+telemetry = start_telemetry('model_inference', args)
 
-# Load features
-features = pd.read_csv(args.input)
 
-# Perform model inference (simplified as a threshold here)
-nuclei_count = features['nuclei_count'].values[0]
+def iter_csv_batches(path, batch_size):
+    """Feature batches of a CSV written by CsvFeatureWriter, read in chunks."""
+    import pandas as pd
 
-# Placeholder model inference (e.g., thresholding)
-if nuclei_count > 1000:
-    prediction = 'Cancerous'
+    for chunk in pd.read_csv(path, chunksize=batch_size):
+        feature_columns = [c for c in chunk.columns if c not in ('id', 'centroid_x', 'centroid_y')]
+        yield {
+            'ids': chunk['id'].astype(str).to_numpy() if 'id' in chunk else np.arange(len(chunk)).astype(str),
+            'centroids': chunk[['centroid_x', 'centroid_y']].to_numpy(dtype=np.float64),
+            'features': chunk[feature_columns].to_numpy(dtype=np.float32),
+        }
+
+
+with telemetry.step('load_model'):
+    classifier = Classifier(args.model, on_gpu=args.gpu, activation=args.activation)
+print(f"Loaded {classifier.kind} model from {args.model}, scoring {classifier.score_kind} values")
+threshold = args.threshold
+if threshold is None:
+    threshold = 0.5 if classifier.score_kind in ('probability', 'prediction') else 0.0
+
+# Stream the features; only one batch of features and scores is in memory at a time
+if is_feature_store(args.input[0]):
+    readers = [FeatureReader(path) for path in args.input]
+    dim = sum(reader.dim for reader in readers)
+    if classifier.n_features is not None and dim != classifier.n_features:
+        raise ValueError(f"Model expects {classifier.n_features} features, {' + '.join(args.input)} has {dim}")
+    batches = iter_joined_batches(readers, batch_size=args.batch_size) if len(readers) > 1 else readers[0].iter_batches(batch_size=args.batch_size)
 else:
-    prediction = 'Non-cancerous'
+    batches = iter_csv_batches(args.input[0], args.batch_size)
+
+pooling = ScorePooling(temperature=args.temperature)
+score_writer = None
+with telemetry.step('inference') as step:
+    for batch in batches:
+        scores, attention = classifier(batch['features'])
+        pooling.update(scores, attention)
+        if args.scores:
+            if score_writer is None:
+                column_names = ['score'] if scores.shape[1] == 1 else [f'score_{k}' for k in range(scores.shape[1])]
+                if args.scores.endswith('.csv'):
+                    score_writer = CsvFeatureWriter(args.scores, column_names=column_names)
+                else:
+                    score_writer = FeatureWriter(args.scores, dtype='float32', column_names=column_names)
+            score_writer.write(batch['ids'], batch['centroids'], scores)
+        step.add_items(len(scores), 'items')
+    if score_writer is not None:
+        score_writer.close()
+
+# Slide-level prediction from the pooled scores
+pooled = pooling.result()
+slide_scores = pooled[args.pooling]
+if slide_scores is None:
+    prediction = None
+elif len(slide_scores) == 1:
+    prediction = args.labels[int(slide_scores[0] >= threshold)]
+else:
+    index = int(np.argmax(slide_scores))
+    prediction = args.labels[index] if index < len(args.labels) else str(index)
+
+result = {
+    'prediction': prediction,
+    'pooling': args.pooling,
+    'slide_scores': slide_scores,
+    'score_kind': classifier.score_kind,
+    'threshold': threshold,
+    'pooled': pooled,
+    'items': pooling.count,
+    'model': os.path.abspath(args.model),
+}
 
 # Save the prediction
 with open(args.output, 'w') as f:
-    f.write(prediction)
+    json.dump(result, f, indent=2)
+print(f"Slide prediction {prediction} from {pooling.count} items saved to {args.output}")
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""Long-lived localhost inference worker that keeps HoVerNet and ResNet50 warm.
+
+Start one per node, then point nuclei_segmentation.py and feature_extract.py
+at it with ``--server http://127.0.0.1:8765`` (or ``$TIA_MODEL_SERVER``).
+
+Endpoints:
+
+- ``POST /features``: body is an ``.npy`` array of (B, H, W, 3) uint8 patches,
+  response is an ``.npy`` array of (B, D) float32 features
+- ``POST /segment``: JSON ``{"input", "save_dir", "mode", "mask", "mpp"}``;
+  the HoVerNet prediction for ``input`` is written to ``save_dir/0.dat``. A
+  WSI is read with ``mpp`` as its baseline resolution when given, as the
+  in-process segmentation does
+- ``GET /health``
+
+Concurrent requests are queued and coalesced into larger batches so the
+device stays busy; feature requests are only stacked with others of the same
+patch shape, so one client's patch size cannot fail another's request; paths in ``/segment`` must be visible to the server,
+which is the case for a per-node worker.
+"""
+import argparse
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class DynamicBatcher:
+    """Coalesce concurrent requests into batches processed on one thread."""
+
+    def __init__(self, process_batch, max_items, max_wait, size=lambda item: 1):
+        """
+        :param process_batch: Callable mapping a list of items to a list of results
+        :param max_items: Stop collecting once this many items (by size) are queued
+        :param max_wait: Seconds to wait for more requests after the first one
+        :param size: Weight of an item towards max_items
+        """
+        self.process_batch = process_batch
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self.size = size
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, item):
+        """Queue an item and block until its result is ready."""
+        future = concurrent.futures.Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            total = self.size(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while total < self.max_items:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                total += self.size(batch[-1][0])
+            try:
+                results = self.process_batch([item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                logger.exception("Batch failed")
+                for _, future in batch:
+                    future.set_exception(e)
+
+
+class FeatureModel:
+    """ResNet50 backbone serving arbitrary-sized patch batches."""
+
+    def __init__(self, on_gpu, max_batch):
+        from patch_features import load_backbone
+
+        self.model, self.device = load_backbone('resnet50', on_gpu=on_gpu)
+        self.max_batch = max_batch
+
+    def __call__(self, patch_batches):
+        # Requests from different clients may use different patch sizes; only
+        # stack those with the same shape
+        results = [None] * len(patch_batches)
+        for shape in {batch.shape[1:] for batch in patch_batches}:
+            group = [i for i, batch in enumerate(patch_batches) if batch.shape[1:] == shape]
+            for i, features in zip(group, self._extract([patch_batches[i] for i in group])):
+                results[i] = features
+        return results
+
+    def _extract(self, patch_batches):
+        from patch_features import extract_batch
+
+        patches = np.concatenate(patch_batches)
+        features = np.concatenate([
+            extract_batch(self.model, self.device, patches[start:start + self.max_batch])
+            for start in range(0, len(patches), self.max_batch)
+        ])
+        splits = np.cumsum([len(batch) for batch in patch_batches])[:-1]
+        return np.split(features, splits)
+
+
+class SegmentationModel:
+    """HoVerNet segmentor running several requested images per predict call."""
+
+    def __init__(self, on_gpu, batch_size):
+        from tiatoolbox.models.engine.nucleus_instance_segmentor import NucleusInstanceSegmentor
+
+        self.on_gpu = on_gpu
+        self.segmentor = NucleusInstanceSegmentor(
+            pretrained_model="hovernet_fast-pannuke",
+            num_loader_workers=2,
+            num_postproc_workers=2,
+            batch_size=batch_size,
+            auto_generate_mask=False
+        )
+
+    def __call__(self, requests):
+        # One predict call per (mode, masked) group, since masks apply to all images or none
+        results = [None] * len(requests)
+        groups = {(request['mode'], bool(request.get('mask'))) for request in requests}
+        for mode, masked in groups:
+            group = [i for i, request in enumerate(requests)
+                     if (request['mode'], bool(request.get('mask'))) == (mode, masked)]
+            self._predict(mode, [requests[i] for i in group], masked)
+            for i in group:
+                results[i] = {'save_dir': requests[i]['save_dir']}
+        return results
+
+    @staticmethod
+    def _image(mode, request):
+        if mode != 'wsi' or request.get('mpp') is None:
+            return request['input']
+        from tiatoolbox.wsicore.wsireader import WSIReader
+
+        # Same resolution as in-process segmentation, which opens the WSI with the slide MPP
+        return WSIReader.open(request['input'], mpp=tuple(request['mpp']))
+
+    def _predict(self, mode, requests, masked):
+        with tempfile.TemporaryDirectory() as scratch:
+            save_dir = os.path.join(scratch, 'out')
+            self.segmentor.predict(
+                imgs=[self._image(mode, request) for request in requests],
+                masks=[request['mask'] for request in requests] if masked else None,
+                save_dir=save_dir,
+                mode=mode,
+                on_gpu=self.on_gpu,
+                crash_on_exception=True
+            )
+            # Predictions are numbered by input order; hand each one back as 0.dat
+            for i, request in enumerate(requests):
+                os.makedirs(request['save_dir'], exist_ok=True)
+                shutil.move(os.path.join(save_dir, f'{i}.dat'), os.path.join(request['save_dir'], '0.dat'))
+
+
+def make_handler(batchers):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._reply(200, json.dumps({'models': sorted(batchers)}).encode(), 'application/json')
+            else:
+                self._reply(404, b'not found', 'text/plain')
+
+        def do_POST(self):
+            endpoint = self.path.strip('/')
+            if endpoint not in batchers:
+                self._reply(404, b'not found', 'text/plain')
+                return
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            try:
+                if endpoint == 'features':
+                    features = batchers[endpoint].submit(np.load(io.BytesIO(body), allow_pickle=False))
+                    buffer = io.BytesIO()
+                    np.save(buffer, features)
+                    self._reply(200, buffer.getvalue(), 'application/octet-stream')
+                else:
+                    result = batchers[endpoint].submit(json.loads(body))
+                    self._reply(200, json.dumps(result).encode(), 'application/json')
+            except Exception as e:
+                self._reply(500, str(e).encode(), 'text/plain')
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Persistent inference server for HoVerNet and ResNet50")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--models', type=str, nargs='+', choices=['features', 'segment'], default=['features', 'segment'], help='Models to keep loaded')
+    parser.add_argument('--gpu', action='store_true', help='Use GPU for processing')
+    parser.add_argument('--max_batch', type=int, default=256, help='Maximum patches per ResNet50 forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=10, help='How long to wait for concurrent requests to batch together')
+    parser.add_argument('--segment_batch', type=int, default=4, help='Maximum images per HoVerNet predict call')
+    parser.add_argument('--hovernet_batch', type=int, default=4, help='Patches per HoVerNet forward pass')
+    args = parser.parse_args()
+
+    batchers = {}
+    if 'features' in args.models:
+        batchers['features'] = DynamicBatcher(
+            FeatureModel(args.gpu, args.max_batch), args.max_batch, args.max_wait_ms / 1000, size=len
+        )
+    if 'segment' in args.models:
+        batchers['segment'] = DynamicBatcher(
+            SegmentationModel(args.gpu, batch_size=args.hovernet_batch), args.segment_batch, args.max_wait_ms / 1000
+        )
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batchers))
+    logger.info(f"Model server with {sorted(batchers)} listening on http://{args.host}:{args.port}")
+    server.serve_forever()
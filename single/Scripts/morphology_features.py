@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Per-nucleus morphology table computed in bulk from the nuclei store.
+
+Writes one row per nucleus, in nuclei store order with the same ids and
+centroids as feature_extract.py, so the table lines up with the deep
+features. Shape columns come from the contours alone; intensity columns are
+added when --image is given. Areas and lengths are in µm² and µm when the
+slide MPP is known, in pixels otherwise.
+"""
+import argparse
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import feature_store
+import morphology
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from feature_store import CsvFeatureWriter, FeatureWriter
+from morphology import INTENSITY_COLUMNS, intensity_features, shape_features
+from nuclei_store import load_nuclei
+from prefetch import RegionPrefetcher, add_prefetch_arguments
+from slide_metadata import SlideMetadata
+from telemetry import add_telemetry_arguments, start_telemetry
+
+logging.basicConfig(level=logging.INFO)
+
+parser = argparse.ArgumentParser(description="Per-nucleus morphology features from nucleus contours")
+parser.add_argument('--input', type=str, help='Path to the nuclei store directory or segmentation result file (0.dat)', required=True)
+parser.add_argument('--image', type=str, default=None, help='WSI or normalized image the nuclei were segmented on; adds intensity columns')
+parser.add_argument('--output', type=str, help='Path of the morphology feature store directory (or CSV file with --format csv)', required=True)
+parser.add_argument('--format', type=str, choices=['npy', 'csv'], default='npy', help='Chunked NPY feature store or CSV')
+parser.add_argument('--metadata', type=str, default=None, help='slide_metadata.json of the segmented image (default: the one next to the nuclei)')
+parser.add_argument('--chunk_size', type=int, default=262144, help='Nuclei processed at once; bounds memory use')
+parser.add_argument('--tile_size', type=int, default=1024, help='Edge in pixels of the image tiles intensities are sampled from')
+add_checkpoint_arguments(parser)
+add_prefetch_arguments(parser)
+add_telemetry_arguments(parser)
+
+args = parser.parse_args()
+telemetry = start_telemetry('morphology_features', args)
+
+# Physical units need the MPP of the image the contours refer to
+if args.metadata:
+    metadata = SlideMetadata.load(args.metadata)
+else:
+    input_dir = os.path.dirname(os.path.abspath(args.input))
+    metadata = SlideMetadata.find(input_dir, os.path.dirname(input_dir))
+mpp = metadata.mpp if metadata is not None else None
+if mpp is None:
+    print("No slide MPP found, areas and perimeters are in pixels")
+column_names = ['area_um2', 'perimeter_um'] if mpp is not None else ['area_px', 'perimeter_px']
+column_names += ['eccentricity', 'solidity'] + (INTENSITY_COLUMNS if args.image else [])
+
+checkpoint = Checkpoint(
+    'morphology_features',
+    inputs=[args.input, args.image],
+    params={'format': args.format, 'mpp': mpp, 'tile_size': args.tile_size},
+    code=[__file__, morphology.__file__, feature_store.__file__],
+    store=args.checkpoint_dir,
+    force=args.force,
+)
+if checkpoint.restore([args.output]):
+    print(f"Morphology features in {args.output} are up to date")
+    exit(0)
+
+nuclei_store = load_nuclei(args.input)
+print(f"Loaded {len(nuclei_store)} nuclei from {args.input}")
+
+Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+if args.format == 'csv':
+    writer = CsvFeatureWriter(args.output, column_names=column_names)
+else:
+    writer = FeatureWriter(args.output, dtype='float32', column_names=column_names)
+
+# Image tiles are read and sampled on --read_workers threads
+prefetcher = None
+if args.image:
+    prefetcher = RegionPrefetcher.for_path(args.image, mpp=mpp, workers=args.read_workers, read_ahead=args.read_ahead)
+
+ids = nuclei_store['id']
+centroids = nuclei_store['centroid']
+contour = nuclei_store['contour']
+offsets = nuclei_store['contour_offsets']
+with telemetry.step('morphology') as step, writer:
+    step.add_items(len(nuclei_store), 'nuclei')
+    for start in range(0, len(nuclei_store), args.chunk_size):
+        stop = min(start + args.chunk_size, len(nuclei_store))
+        chunk_offsets = np.asarray(offsets[start:stop + 1])
+        chunk_contour = np.asarray(contour[chunk_offsets[0]:chunk_offsets[-1]])
+        chunk_offsets = chunk_offsets - chunk_offsets[0]
+
+        shape = shape_features(chunk_contour, chunk_offsets)
+        area, perimeter = shape['area'], shape['perimeter']
+        if mpp is not None:
+            area = area * mpp[0] * mpp[1]
+            perimeter = perimeter * (mpp[0] + mpp[1]) / 2
+        columns = [area, perimeter, shape['eccentricity'], shape['solidity']]
+        if prefetcher is not None:
+            intensity = intensity_features(prefetcher, chunk_contour, chunk_offsets, tile_size=args.tile_size)
+            columns += [intensity[name] for name in INTENSITY_COLUMNS]
+        writer.write(ids[start:stop], centroids[start:stop], np.stack(columns, axis=1))
+if prefetcher is not None:
+    prefetcher.close()
+checkpoint.save([args.output])
+
+print(f"Morphology features for {len(nuclei_store)} nuclei saved to {args.output}")
@@ -1,205 +1,201 @@
 import argparse
 import os
-import joblib
-import matplotlib.pyplot as plt
-from tiatoolbox.models.engine.nucleus_instance_segmentor import NucleusInstanceSegmentor
-from tiatoolbox.utils.visualization import overlay_prediction_contours
-from tiatoolbox.wsicore.wsireader import WSIReader
-from skimage import measure
 import logging
-import torch
-import json
+import shutil
 import numpy as np
-from scipy.spatial import distance
-
-logging.basicConfig(level=logging.DEBUG)
+import mask_utils
+import shards
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from compute_metrics import compute_metrics_stage
+from mask_utils import filter_mask_by_tissue, load_mask, save_mask
+from model_client import ModelClient, default_server
+from shards import SHARD_FILE, mask_bounds, plan_shards, restrict_mask, save_shard_info
+from slide_metadata import METADATA_FILE, SlideMetadata
+from telemetry import add_telemetry_arguments, start_telemetry
+
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+PRETRAINED_MODEL = "hovernet_fast-pannuke"
+
 # Parsing input arguments
 parser = argparse.ArgumentParser(description="Nuclei Segmentation using HoVerNet")
 parser.add_argument('--input', type=str, help='Path to normalized image or WSI', required=True)
 parser.add_argument('--output_dir', type=str, help='Directory to save output results', required=True)
-parser.add_argument('--metadata', type=str, help='Path to metadata.pkl file', required=False)
-parser.add_argument('--mode', type=str, default="tile", choices=["wsi", "tile"], help='Processing mode: "wsi" or "tile"')
+parser.add_argument('--metadata', type=str, help='Path to slide_metadata.json (or legacy metadata.pkl) of the input', required=False)
+parser.add_argument('--mode', type=str, default="tile", choices=["wsi", "tile"], help='Processing mode: "wsi" reads pyramidal slides and TIFFs region by region, "tile" decodes the whole image')
 parser.add_argument('--gpu', action='store_true', help='Use GPU for processing')
+parser.add_argument('--mask', type=str, help='Path to tissue mask PNG from tissue_mask.py', required=False)
+parser.add_argument('--min_tissue', type=float, default=0.1, help='Minimum tissue fraction for a tile to be segmented')
+parser.add_argument('--mask_tile_size', type=int, default=256, help='Tile size in pixels for the tissue fraction check')
+parser.add_argument('--num_shards', type=int, default=1, help='Split the tissue area into this many overlapping shards')
+parser.add_argument('--shard_index', type=int, default=0, help='Shard processed by this run (0-based); merge with merge_shards.py')
+parser.add_argument('--shard_overlap', type=int, default=128, help='Overlap margin between shards in pixels')
+parser.add_argument('--server', type=str, default=default_server(), help='URL of a running model_server.py (default: $TIA_MODEL_SERVER); loads HoVerNet in-process when unset')
 parser.add_argument('--default_mpp', type=float, help="Default MPP if not found in metadata", default=0.5)
+add_checkpoint_arguments(parser)
+add_telemetry_arguments(parser)
 args = parser.parse_args()
+if not 0 <= args.shard_index < args.num_shards:
+    parser.error('--shard_index must be in [0, --num_shards)')
+telemetry = start_telemetry('nuclei_segmentation', args, mode=args.mode, shard_index=args.shard_index, num_shards=args.num_shards)
 
+# Heavy imports are deferred until after argument parsing so --help stays fast
 if not args.gpu:
+    import torch
+
     args.gpu = torch.cuda.is_available()
 logger.info(f"Using GPU for processing: {args.gpu}")
 
 logger.debug(f"Input arguments: {args}")
 
-# Load metadata
+# Load metadata of the input image, falling back to the image itself
 if args.metadata:
     logger.info(f"Loading metadata from {args.metadata}")
-    metadata = joblib.load(args.metadata)
+    metadata = SlideMetadata.load(args.metadata).with_mpp(args.default_mpp)
 else:
-    metadata = {}
-    logger.warning("No metadata provided, using default MPP.")
-
-mpp = metadata.get('mpp', args.default_mpp)
-
-# Ensure MPP is valid and calculate a single MPP value
-if isinstance(mpp, tuple) and len(mpp) == 2:
-    mpp_value = sum(mpp) / len(mpp)
-elif isinstance(mpp, (int, float)):
-    mpp_value = float(mpp)
-else:
-    mpp_value = args.default_mpp
-    logger.warning(f"Invalid MPP in metadata, using default MPP: {mpp_value}")
-
-logger.info(f"Microns per pixel (MPP) used: {mpp_value}")
-
-# Initialize NucleusInstanceSegmentor
-logger.info("Initializing NucleusInstanceSegmentor")
-segmentor = NucleusInstanceSegmentor(
-    pretrained_model="hovernet_fast-pannuke",
-    num_loader_workers=2,
-    num_postproc_workers=2,
-    batch_size=4,
-    auto_generate_mask=False
+    from tiatoolbox.wsicore.wsireader import WSIReader
+
+    metadata = SlideMetadata.from_reader(WSIReader.open(args.input), default_mpp=args.default_mpp)
+if metadata.mpp_source == 'default':
+    logger.warning(f"No MPP in metadata, using default MPP: {args.default_mpp}")
+if args.mask:
+    # Travels with 0.dat so densities are per mm² of tissue
+    metadata = metadata.with_tissue_area(float(load_mask(args.mask).mean()))
+
+logger.info(f"Microns per pixel (MPP) used: {metadata.mpp_value}")
+
+# Skip prediction when this input, mask and configuration were segmented before
+inst_map_path = os.path.join(args.output_dir, '0.dat')
+metadata_path = os.path.join(args.output_dir, METADATA_FILE)
+predict_outputs = [inst_map_path, metadata_path] + ([os.path.join(args.output_dir, SHARD_FILE)] if args.num_shards > 1 else [])
+predict_params = {
+    name: getattr(args, name)
+    for name in ['mode', 'min_tissue', 'mask_tile_size', 'num_shards', 'shard_index', 'shard_overlap', 'default_mpp']
+}
+predict_checkpoint = Checkpoint(
+    'nuclei_segmentation',
+    inputs=[args.input, args.mask],
+    params=dict(predict_params, pretrained_model=PRETRAINED_MODEL, server=bool(args.server), mpp=metadata.mpp),
+    code=[__file__, shards.__file__, mask_utils.__file__],
+    store=args.checkpoint_dir,
+    force=args.force,
 )
-
-# Process depending on the mode (wsi or tile)
-if args.mode == "wsi":
-    logger.info(f"Running segmentation on WSI: {args.input}")
-    try:
-        wsi = WSIReader.open(args.input)
-        output = segmentor.predict(
-            imgs=[wsi],
-            save_dir=args.output_dir,
-            mode='wsi',
-            on_gpu=args.gpu,
-            crash_on_exception=False
-        )
-    except Exception as e:
-        logger.error(f"Segmentation failed for WSI: {e}")
-        exit(1)
-else:
-    logger.info(f"Running segmentation on Tile: {args.input}")
-    try:
-        output = segmentor.predict(
-            imgs=[args.input],
-            save_dir=args.output_dir,
-            mode='tile',
-            on_gpu=args.gpu,
-            crash_on_exception=False
+if not predict_checkpoint.restore(predict_outputs):
+    # Initialize NucleusInstanceSegmentor unless a model server keeps one warm
+    if not args.server:
+        from tiatoolbox.models.engine.nucleus_instance_segmentor import NucleusInstanceSegmentor
+
+        logger.info("Initializing NucleusInstanceSegmentor")
+        with telemetry.step('load_model'):
+            segmentor = NucleusInstanceSegmentor(
+                pretrained_model=PRETRAINED_MODEL,
+                num_loader_workers=2,
+                num_postproc_workers=2,
+                batch_size=4,
+                auto_generate_mask=False
+            )
+
+    # Restrict segmentation to tiles with enough tissue, and to one shard of the
+    # tissue area when running sharded
+    masks = None
+    tissue_mask = None
+    shard = None
+    if args.mask or args.num_shards > 1:
+        from tiatoolbox.wsicore.wsireader import WSIReader
+
+        wsi = WSIReader.open(args.input, mpp=metadata.mpp)
+        width, height = (int(v) for v in wsi.slide_dimensions(resolution=0, units="level"))
+
+    if args.mask:
+        tissue_mask, kept = filter_mask_by_tissue(
+            load_mask(args.mask), (height, width), args.mask_tile_size, args.min_tissue
         )
-    except Exception as e:
-        logger.error(f"Segmentation failed for Tile: {e}")
-        exit(1)
-
-logger.debug(f"Segmentation output: {output}")
-
-# Get the correct path to the output file
-output_dir_for_image = args.output_dir
-logger.info(f"Segmentation results saved in: {output_dir_for_image}")
-
-# Define the path to the instance map file
-inst_map_path = os.path.join(output_dir_for_image, '0.dat')
-
-# Load the segmentation results
-logger.info(f"Loading segmentation results from {inst_map_path}")
-nuclei_predictions = joblib.load(inst_map_path)
-
-logger.info(f"Number of detected nuclei: {len(nuclei_predictions)}")
-
-# Calculate metrics
-def calculate_metrics(nuclei_predictions):
-    total_area = 0
-    total_aspect_ratio = 0
-    total_nuclei = len(nuclei_predictions)
-    total_probability = 0
-    nearest_neighbor_distances = []
-    nuclei_with_overlaps = 0
-
-    type_distribution = {
-        'neoplastic_epithelial': 0,
-        'inflammatory': 0,
-        'connective': 0,
-        'dead_cells': 0,
-        'other': 0
-    }
-
-    confidences = []
-    centroids = []
-    
-    # Gather centroids for nearest neighbor calculation
-    for _, nucleus in nuclei_predictions.items():
-        centroids.append(np.array(nucleus['centroid']))
-
-    # Calculate metrics for each nucleus
-    for _, nucleus in nuclei_predictions.items():
-        box_area = (nucleus['box'][2] - nucleus['box'][0]) * (nucleus['box'][3] - nucleus['box'][1])
-        total_area += box_area
-
-        # Calculate aspect ratio
-        width = nucleus['box'][2] - nucleus['box'][0]
-        height = nucleus['box'][3] - nucleus['box'][1]
-        aspect_ratio = width / height
-        total_aspect_ratio += aspect_ratio
-
-        # Confidence score
-        confidences.append(nucleus.get('prob', 0))
-
-        # Check for overlaps (bounding boxes overlap)
-        for _, other_nucleus in nuclei_predictions.items():
-            if np.array_equal(nucleus['box'], other_nucleus['box']):
-                continue  # Skip comparison with itself
-            if np.any(np.intersect1d(nucleus['box'], other_nucleus['box'])):
-                nuclei_with_overlaps += 1
-                break  # Count overlap only once per nucleus
-
-        # Nearest neighbor distance
-        distances = distance.cdist([nucleus['centroid']], centroids, 'euclidean')
-        nearest_distance = np.partition(distances.flatten(), 1)[1]  # Skip distance to itself
-        nearest_neighbor_distances.append(nearest_distance)
-
-        # Nucleus type classification
-        nucleus_type = nucleus.get('type', None)
-        if nucleus_type == 1:
-            type_distribution['neoplastic_epithelial'] += 1
-        elif nucleus_type == 2:
-            type_distribution['inflammatory'] += 1
-        elif nucleus_type == 3:
-            type_distribution['connective'] += 1
-        elif nucleus_type == 4:
-            type_distribution['dead_cells'] += 1
+        logger.info(f"Tissue mask keeps {kept:.1%} of {args.mask_tile_size}px tiles (min tissue {args.min_tissue})")
+
+    if args.num_shards > 1:
+        if tissue_mask is None:
+            tissue_mask = np.ones((-(-height // 32), -(-width // 32)), dtype=bool)
+        plan = plan_shards(mask_bounds(tissue_mask, (height, width)), (height, width), args.num_shards, args.shard_overlap)
+        shard = plan[args.shard_index]
+        tissue_mask = restrict_mask(tissue_mask, (height, width), shard['region'])
+        logger.info(f"Segmenting shard {args.shard_index + 1}/{args.num_shards}, region {shard['region']}")
+
+    if tissue_mask is not None:
+        # Saved next to output_dir, which the segmentor insists on creating itself
+        masks = [save_mask(tissue_mask, f"{os.path.normpath(args.output_dir)}_tissue_mask.png")]
+
+    # The segmentor refuses an existing save_dir, and output_dir still holds the
+    # results of an earlier run; predict next to it and move the new results in
+    save_dir = f"{os.path.normpath(args.output_dir)}.predict"
+    shutil.rmtree(save_dir, ignore_errors=True)
+
+    # Process depending on the mode (wsi or tile)
+    with telemetry.step('predict'):
+        if args.server:
+            logger.info(f"Sending {args.mode} segmentation of {args.input} to model server {args.server}")
+            try:
+                output = ModelClient(args.server).segment(
+                    args.input,
+                    args.output_dir,
+                    mode=args.mode,
+                    mask=masks[0] if masks else None,
+                    mpp=metadata.mpp
+                )
+            except Exception as e:
+                logger.error(f"Segmentation failed on model server: {e}")
+                exit(1)
+        elif args.mode == "wsi":
+            logger.info(f"Running segmentation on WSI: {args.input}")
+            try:
+                from tiatoolbox.wsicore.wsireader import WSIReader
+
+                # HoVerNet reads at its own input resolution; the MPP lets the
+                # reader pick the coarsest level that provides it
+                wsi = WSIReader.open(args.input, mpp=metadata.mpp)
+                output = segmentor.predict(
+                    imgs=[wsi],
+                    masks=masks,
+                    save_dir=save_dir,
+                    mode='wsi',
+                    on_gpu=args.gpu,
+                    crash_on_exception=False
+                )
+            except Exception as e:
+                logger.error(f"Segmentation failed for WSI: {e}")
+                exit(1)
         else:
-            type_distribution['other'] += 1
-
-    avg_area = total_area / total_nuclei if total_nuclei > 0 else 0
-    avg_aspect_ratio = total_aspect_ratio / total_nuclei if total_nuclei > 0 else 0
-    avg_probability = np.mean(confidences)
-    avg_nearest_neighbor_distance = np.mean(nearest_neighbor_distances)
-
-    # Assuming a given area of the tile (in mm²), calculate density
-    tile_area = 1  # In mm², adjust according to your actual data
-    nuclei_density = total_nuclei / tile_area
-
-    metrics = {
-        'total_nuclei': total_nuclei,
-        'nucleus_type_distribution': type_distribution,
-        'average_nucleus_area': avg_area,
-        'average_aspect_ratio': avg_aspect_ratio,
-        'nearest_neighbor_distance': avg_nearest_neighbor_distance,
-        'nuclei_density': nuclei_density,
-        'confidence_score_distribution': {
-            'average_confidence': avg_probability,
-            'low_confidence_count': len([c for c in confidences if c < 0.5])
-        },
-        'nuclei_with_overlaps': nuclei_with_overlaps
-    }
-
-    return metrics
-
-
-# Calculate the metrics and save to a JSON file
-metrics = calculate_metrics(nuclei_predictions)
-metrics_output_path = os.path.join(output_dir_for_image, 'segmentation_metrics.json')
-with open(metrics_output_path, 'w') as f:
-    json.dump(metrics, f, indent=4)
-
-logger.info(f"Segmentation metrics saved to {metrics_output_path}")
+            logger.info(f"Running segmentation on Tile: {args.input}")
+            try:
+                output = segmentor.predict(
+                    imgs=[args.input],
+                    masks=masks,
+                    save_dir=save_dir,
+                    mode='tile',
+                    on_gpu=args.gpu,
+                    crash_on_exception=False
+                )
+            except Exception as e:
+                logger.error(f"Segmentation failed for Tile: {e}")
+                exit(1)
+        if not args.server:
+            os.makedirs(args.output_dir, exist_ok=True)
+            for name in os.listdir(save_dir):
+                os.replace(os.path.join(save_dir, name), os.path.join(args.output_dir, name))
+            os.rmdir(save_dir)
+
+    # The coordinates in 0.dat are baseline pixels of the input
+    metadata.save(metadata_path)
+    if shard is not None:
+        save_shard_info(args.output_dir, shard, args.num_shards)
+    predict_checkpoint.save(predict_outputs)
+
+# Sharded runs stop here; merge_shards.py de-duplicates and computes metrics
+if args.num_shards > 1:
+    logger.info(f"Shard {args.shard_index} saved in: {args.output_dir}")
+    exit(0)
+
+logger.info(f"Segmentation results saved in: {args.output_dir}")
+
+# Convert to the nuclei store, calculate the metrics and save to a JSON file
+compute_metrics_stage(inst_map_path, args.output_dir, telemetry, args.checkpoint_dir, args.force, metadata=metadata)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""Columnar, memory-mappable store for HoVerNet nucleus predictions.
+
+A store is a directory of ``.npy`` files plus ``meta.json``:
+
+- ``id``: instance ids from 0.dat, as strings
+- ``box`` (N, 4) int32, ``centroid`` (N, 2) float64, ``type`` (N,) int16, ``prob`` (N,) float32
+- ``contour`` (M, 2) int32: all contour points concatenated
+- ``contour_offsets`` (N + 1,) int64: contour i is ``contour[offsets[i]:offsets[i + 1]]``
+
+Nuclei are sorted by centroid y, so region queries only touch the rows of
+the requested band when the columns are memory-mapped.
+"""
+import argparse
+import bisect
+import json
+import os
+import shutil
+
+import numpy as np
+
+FORMAT_VERSION = 1
+COLUMNS = ['id', 'box', 'centroid', 'type', 'prob', 'contour', 'contour_offsets']
+
+
+def write_nuclei_store(nuclei_predictions, store_path):
+    """
+    Write a dict of per-nucleus dicts (the 0.dat layout) as a columnar store.
+    :param nuclei_predictions: Dict loaded from 0.dat
+    :param store_path: Output store directory, replaced if it exists
+    :return: Path to the store
+    """
+    from segmentation_metrics import nuclei_to_columns
+
+    columns = nuclei_to_columns(nuclei_predictions)
+    ids = list(nuclei_predictions.keys())
+    contours = [np.asarray(nucleus['contour']).reshape((-1, 2)) for nucleus in nuclei_predictions.values()]
+
+    order = np.lexsort((columns['centroid'][:, 0], columns['centroid'][:, 1]))
+    lengths = np.array([len(contours[i]) for i in order], dtype=np.int64)
+    offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    arrays = {
+        'id': np.array([str(ids[i]) for i in order], dtype=str),
+        'box': columns['box'][order].astype(np.int32),
+        'centroid': columns['centroid'][order],
+        'type': columns['type'][order].astype(np.int16),
+        'prob': columns['prob'][order].astype(np.float32),
+        'contour': (np.concatenate([contours[i] for i in order]).astype(np.int32)
+                    if len(order) else np.zeros((0, 2), dtype=np.int32)),
+        'contour_offsets': offsets,
+    }
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'count': len(order),
+        'id_type': 'int' if ids and all(isinstance(i, (int, np.integer)) for i in ids) else 'str',
+    }
+
+    # Write next to the destination and swap in, so readers never see a partial store
+    store_path = str(store_path).rstrip(os.sep)
+    tmp_path = f'{store_path}.tmp-{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+def convert_dat_to_store(dat_path, store_path):
+    """Convert a HoVerNet 0.dat file into a nuclei store."""
+    import joblib
+
+    return write_nuclei_store(joblib.load(dat_path), store_path)
+
+
+class NucleiStore:
+    """Read access to a nuclei store, memory-mapped by default."""
+
+    def __init__(self, arrays, meta):
+        self._arrays = arrays
+        self.meta = meta
+
+    @classmethod
+    def open(cls, store_path, mmap=True):
+        """Open a store directory; columns are memory-mapped unless mmap is False."""
+        with open(os.path.join(store_path, 'meta.json')) as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        arrays = {
+            name: np.load(os.path.join(store_path, f'{name}.npy'), mmap_mode=mmap_mode)
+            for name in COLUMNS
+        }
+        return cls(arrays, meta)
+
+    @classmethod
+    def from_dict(cls, nuclei_predictions):
+        """Build an in-memory store from a 0.dat dict."""
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = write_nuclei_store(nuclei_predictions, os.path.join(tmp, 'nuclei'))
+            return cls.open(path, mmap=False)
+
+    def __len__(self):
+        return self.meta['count']
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def columns(self, indices=None):
+        """Box, centroid, type and prob columns, optionally for a subset of rows."""
+        names = ['box', 'centroid', 'type', 'prob']
+        if indices is None:
+            return {name: self._arrays[name] for name in names}
+        return {name: self._arrays[name][indices] for name in names}
+
+    def select(self, bounds=None, types=None):
+        """
+        Indices of nuclei whose centroid lies in a region and/or of given types.
+        :param bounds: (x0, y0, x1, y1) in slide pixels, end-exclusive
+        :param types: Iterable of type ids to keep
+        :return: Sorted int64 index array
+        """
+        start, stop = 0, len(self)
+        if bounds is not None:
+            x0, y0, x1, y1 = bounds
+            # Binary search on the sorted y column only reads O(log N) rows
+            y = self._arrays['centroid'][:, 1]
+            start = bisect.bisect_left(y, y0)
+            stop = bisect.bisect_left(y, y1, lo=start)
+        indices = np.arange(start, stop, dtype=np.int64)
+        if bounds is not None:
+            x = self._arrays['centroid'][start:stop, 0]
+            indices = indices[(x >= x0) & (x < x1)]
+        if types is not None:
+            indices = indices[np.isin(self._arrays['type'][indices], list(types))]
+        return indices
+
+    def contour(self, index):
+        """Contour points of one nucleus as an (K, 2) array."""
+        offsets = self._arrays['contour_offsets']
+        return self._arrays['contour'][offsets[index]:offsets[index + 1]]
+
+    def ids(self, indices=None):
+        """Instance ids restored to their 0.dat key type."""
+        ids = self._arrays['id'] if indices is None else self._arrays['id'][indices]
+        if self.meta.get('id_type') == 'int':
+            return [int(i) for i in ids]
+        return [str(i) for i in ids]
+
+    def to_dict(self, indices=None):
+        """Rebuild the 0.dat dict of per-nucleus dicts, optionally for a subset."""
+        if indices is None:
+            indices = np.arange(len(self))
+        result = {}
+        for key, i in zip(self.ids(indices), indices):
+            result[key] = {
+                'box': np.asarray(self._arrays['box'][i]),
+                'centroid': np.asarray(self._arrays['centroid'][i]),
+                'contour': np.asarray(self.contour(i)),
+                'prob': float(self._arrays['prob'][i]),
+                'type': int(self._arrays['type'][i]),
+            }
+        return result
+
+
+def load_nuclei(path):
+    """Open a nuclei store directory, or convert a 0.dat file in memory."""
+    if os.path.isdir(path):
+        return NucleiStore.open(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Nuclei segmentation result {path} not found.")
+    import joblib
+
+    return NucleiStore.from_dict(joblib.load(path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a HoVerNet 0.dat file into a columnar nuclei store")
+    parser.add_argument('--input', type=str, help='Path to the nuclei segmentation result file (0.dat)', required=True)
+    parser.add_argument('--output', type=str, help='Path of the nuclei store directory to write', required=True)
+    args = parser.parse_args()
+
+    store_path = convert_dat_to_store(args.input, args.output)
+    print(f"Nuclei store with {len(NucleiStore.open(store_path))} nuclei saved to {store_path}")
@@ -0,0 +1,157 @@
+"""Batched deep feature extraction on per-nucleus image patches."""
+import logging
+import os
+import time
+
+import numpy as np
+
+from prefetch import RegionPrefetcher
+
+logger = logging.getLogger(__name__)
+
+# ImageNet statistics expected by the torchvision ResNet50 weights
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+class NucleusPatchDataset:
+    """
+    Map-style dataset of square patches centred on nucleus centroids.
+    Readers are opened lazily so each DataLoader worker gets its own handles;
+    the patches of a batch are read concurrently on read_workers threads.
+    """
+
+    def __init__(self, image_path, centroids, patch_size=224, patch_mpp=None, image_mpp=None, read_workers=4, read_ahead=16):
+        """
+        :param image_path: WSI or normalized image the centroids refer to
+        :param centroids: (N, 2) array of (x, y) in baseline pixels
+        :param patch_size: Patch edge in output pixels
+        :param patch_mpp: Resolution patches are read at, or None for baseline pixels
+        :param image_mpp: (x, y) baseline MPP of the image; required with patch_mpp
+        :param read_workers: Threads reading the patches of a batch, or 0 to read them one by one
+        :param read_ahead: Maximum number of patches read but not yet collated
+        """
+        self.image_path = image_path
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+        self.patch_size = patch_size
+        self.patch_mpp = patch_mpp if patch_mpp is not None and image_mpp is not None else None
+        self.image_mpp = image_mpp
+        self.read_workers = read_workers
+        self.read_ahead = read_ahead
+        self._prefetcher = None
+
+    def __len__(self):
+        return len(self.centroids)
+
+    @property
+    def prefetcher(self):
+        if self._prefetcher is None:
+            self._prefetcher = RegionPrefetcher.for_path(
+                self.image_path, mpp=self.image_mpp, workers=self.read_workers, read_ahead=self.read_ahead
+            )
+        return self._prefetcher
+
+    def read_patch(self, reader, index):
+        """Read the patch of one nucleus with a given reader."""
+        if self.patch_mpp is None:
+            resolution, units, scale = 0, 'level', np.ones(2)
+        else:
+            # Read from the coarsest pyramid level that provides patch_mpp
+            resolution, units = self.patch_mpp, 'mpp'
+            scale = self.patch_mpp / np.asarray(self.image_mpp, dtype=np.float64)
+        x, y = np.round(self.centroids[index] - self.patch_size * scale / 2).astype(int)
+        patch = reader.read_rect(
+            location=(int(x), int(y)),
+            size=(self.patch_size, self.patch_size),
+            resolution=resolution,
+            units=units,
+        )
+        return np.ascontiguousarray(patch[..., :3], dtype=np.uint8)
+
+    def __getitem__(self, index):
+        return self.read_patch(self.prefetcher.reader, index)
+
+    def __getitems__(self, indices):
+        # Batched fetch used by torch >= 2.0 DataLoaders: a worker reads the
+        # whole batch concurrently instead of one patch after the other
+        return list(self.prefetcher.map(self.read_patch, indices))
+
+    def __getstate__(self):
+        # Reader handles and threads are not picklable; workers reopen the image
+        state = self.__dict__.copy()
+        state['_prefetcher'] = None
+        return state
+
+
+def load_backbone(backbone='resnet50', on_gpu=False, num_threads=None):
+    """
+    Load a tiatoolbox CNN backbone ready for inference.
+    :param backbone: torchvision backbone name
+    :param on_gpu: Move the model to CUDA
+    :param num_threads: CPU threads for intra-op parallelism (default: all cores)
+    :return: (model, device)
+    """
+    import torch
+    from tiatoolbox.models.architecture.vanilla import CNNBackbone
+
+    device = torch.device('cuda' if on_gpu else 'cpu')
+    if not on_gpu:
+        torch.set_num_threads(num_threads or os.cpu_count())
+    model = CNNBackbone(backbone).to(device).eval()
+    return model, device
+
+
+def extract_batch(model, device, patches):
+    """
+    Deep features for a batch of patches.
+    :param model: Backbone returned by load_backbone
+    :param device: Torch device of the model
+    :param patches: (B, H, W, 3) uint8 tensor or array
+    :return: (B, D) float32 array
+    """
+    import torch
+
+    batch = torch.as_tensor(patches).to(device, non_blocking=True)
+    mean = torch.as_tensor(IMAGENET_MEAN, device=device)
+    std = torch.as_tensor(IMAGENET_STD, device=device)
+    with torch.inference_mode():
+        batch = (batch.float() / 255.0 - mean) / std
+        features = model(batch.permute(0, 3, 1, 2).contiguous())
+    return features.float().cpu().numpy()
+
+
+def iter_patch_features(dataset, extract, batch_size=64, num_workers=4, pin_memory=False, log_every=50):
+    """
+    Stream features for every patch of a dataset in dataset order.
+    :param dataset: NucleusPatchDataset
+    :param extract: Callable mapping a (B, H, W, 3) uint8 tensor to (B, D) features,
+        e.g. extract_batch bound to a local model or a model server client
+    :param batch_size: Patches per forward pass
+    :param num_workers: DataLoader worker processes reading patches
+    :param pin_memory: Pin host memory for faster GPU transfers
+    :param log_every: Log throughput every this many batches
+    :return: Generator of (start_index, features) per batch
+    """
+    from torch.utils.data import DataLoader
+
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        persistent_workers=False,
+    )
+    start_time = time.perf_counter()
+    done = 0
+    for batch_index, patches in enumerate(loader):
+        features = extract(patches)
+        yield done, features
+        done += len(features)
+        if log_every and (batch_index + 1) % log_every == 0:
+            rate = done / (time.perf_counter() - start_time)
+            logger.info(f"{done}/{len(dataset)} patches ({rate:.1f} patches/sec)")
+
+    elapsed = time.perf_counter() - start_time
+    rate = done / elapsed if elapsed > 0 else 0.0
+    logger.info(f"Extracted {done} patches in {elapsed:.1f}s ({rate:.1f} patches/sec)")
@@ -0,0 +1,120 @@
+"""Read-ahead of slide regions on a thread pool.
+
+Stages otherwise pull pixels with synchronous ``read_rect`` calls, so the
+CPU or GPU sits idle while a tile is fetched from (network) storage and
+decoded. RegionPrefetcher keeps the next ``read_ahead`` reads in flight on
+``workers`` threads while the caller processes the current region:
+
+    with RegionPrefetcher.for_path(slide_path, workers=4, read_ahead=16) as prefetcher:
+        for tile in prefetcher.read_rects(locations, (512, 512)):
+            ...
+
+Regions come back in request order, and at most read_ahead decoded regions
+wait in memory, so a slow consumer applies backpressure to the readers.
+Every thread opens its own reader, as not all tiatoolbox backends can be
+shared between threads.
+"""
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def add_prefetch_arguments(parser):
+    """Add the --read_workers/--read_ahead options shared by stages reading slide regions."""
+    parser.add_argument('--read_workers', type=int, default=4, help='Threads reading and decoding slide regions ahead of processing (0 reads synchronously)')
+    parser.add_argument('--read_ahead', type=int, default=16, help='Regions read ahead of processing; bounds the decoded regions held in memory')
+
+
+def imap_ordered(executor, fn, items, window):
+    """
+    Map fn over items on an executor, yielding results in input order.
+    At most window tasks are in flight so finished results cannot pile up
+    while the consumer waits on a slow one. Tasks not yet started are
+    cancelled when the consumer stops early.
+    """
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class RegionPrefetcher:
+    """Ordered, bounded read-ahead of regions through per-thread slide readers."""
+
+    def __init__(self, open_reader, workers=4, read_ahead=16):
+        """
+        :param open_reader: Callable returning a new reader; called once per reading thread
+        :param workers: Reading threads, or 0 to read synchronously in the calling thread
+        :param read_ahead: Maximum number of regions read but not yet consumed
+        """
+        self.open_reader = open_reader
+        self.workers = max(0, workers)
+        self.read_ahead = max(1, read_ahead, self.workers)
+        self._local = threading.local()
+        self._executor = None
+
+    @classmethod
+    def for_path(cls, path, mpp=None, **kwargs):
+        """
+        Prefetcher over tiatoolbox readers of a slide.
+        :param path: Slide or image path
+        :param mpp: (x, y) MPP overriding the slide's own, for images without one
+        :param kwargs: workers and read_ahead
+        """
+
+        def open_reader():
+            from tiatoolbox.wsicore.wsireader import WSIReader
+
+            return WSIReader.open(path, mpp=mpp)
+
+        return cls(open_reader, **kwargs)
+
+    @property
+    def reader(self):
+        """The reader of the current thread, opened on first use."""
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            reader = self._local.reader = self.open_reader()
+        return reader
+
+    def _call(self, fn, item):
+        return fn(self.reader, item)
+
+    def map(self, fn, items):
+        """
+        Apply fn(reader, item) to every item ahead of the consumer.
+        :param fn: Reading function, called on a reading thread with that thread's reader
+        :param items: Iterable of items, e.g. region locations; consumed lazily
+        :return: Generator of results in item order
+        """
+        if not self.workers:
+            return (fn(self.reader, item) for item in items)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prefetch')
+        return imap_ordered(self._executor, lambda item: self._call(fn, item), items, window=self.read_ahead)
+
+    def read_rects(self, locations, size, resolution=0, units='level', **kwargs):
+        """Prefetched read_rect of every location, with the same size and resolution."""
+        return self.map(
+            lambda reader, location: reader.read_rect(location, size, resolution=resolution, units=units, **kwargs),
+            locations,
+        )
+
+    def close(self):
+        """Stop the reading threads, dropping reads not yet started."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
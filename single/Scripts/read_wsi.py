@@ -1,18 +1,25 @@
-from tiatoolbox.wsicore.wsireader import WSIReader
+from telemetry import add_telemetry_arguments, start_telemetry
+from wsi_cache import add_cache_arguments, open_wsi
 import argparse
-import matplotlib.pyplot as plt
 
 parser = argparse.ArgumentParser(description="Read WSI")
 parser.add_argument('--input', type=str, help='Path to WSI file')
 parser.add_argument('--output', type=str, help='Path to save output thumbnail')
+add_cache_arguments(parser)
+add_telemetry_arguments(parser)
 
 args = parser.parse_args()
+telemetry = start_telemetry('read_wsi', args)
 
-# Load the WSI
-wsi = WSIReader.open(args.input)
+# Load the WSI; the thumbnail is shared with later stages through the cache
+wsi = open_wsi(args.input, args.cache_dir, args.cache_max_mb)
 
 # Generate a thumbnail
-thumbnail = wsi.slide_thumbnail(1.0)
+with telemetry.step('thumbnail'):
+    thumbnail = wsi.slide_thumbnail(1.0)
 
 # Save the thumbnail
-plt.imsave(args.output, thumbnail)
+import matplotlib.pyplot as plt
+
+with telemetry.step('save'):
+    plt.imsave(args.output, thumbnail)
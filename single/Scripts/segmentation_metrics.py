@@ -0,0 +1,151 @@
+"""Vectorized nucleus segmentation metrics over columnar nucleus arrays."""
+import numpy as np
+
+# HoVerNet PanNuke type ids reported in the type distribution; anything else is 'other'
+NUCLEUS_TYPES = {
+    1: 'neoplastic_epithelial',
+    2: 'inflammatory',
+    3: 'connective',
+    4: 'dead_cells',
+}
+
+
+def nuclei_to_columns(nuclei_predictions):
+    """
+    Convert the HoVerNet dict of per-nucleus dicts into columnar arrays.
+    :param nuclei_predictions: Dict loaded from 0.dat
+    :return: Dict with 'box' (N, 4), 'centroid' (N, 2), 'type' (N,) and 'prob' (N,)
+    """
+    nuclei = list(nuclei_predictions.values())
+    n = len(nuclei)
+    box = np.array([nucleus['box'] for nucleus in nuclei], dtype=np.float64).reshape((n, 4))
+    centroid = np.array([nucleus['centroid'] for nucleus in nuclei], dtype=np.float64).reshape((n, 2))
+    nucleus_type = np.fromiter(
+        (nucleus.get('type') or 0 for nucleus in nuclei), dtype=np.int64, count=n
+    )
+    prob = np.fromiter(
+        (nucleus.get('prob') or 0 for nucleus in nuclei), dtype=np.float64, count=n
+    )
+    return {'box': box, 'centroid': centroid, 'type': nucleus_type, 'prob': prob}
+
+
+def overlapping_boxes(box, chunk_size=1_000_000):
+    """
+    Flag boxes that intersect at least one other box.
+    Sweep-line over boxes sorted by x0: the candidates for box i are the boxes
+    starting inside [x0_i, x1_i), which are then tested on the y axis.
+    Candidate pairs are generated in chunks to keep memory bounded.
+    :param box: (N, 4) array of [x0, y0, x1, y1] with exclusive x1/y1
+    :param chunk_size: Maximum number of candidate pairs tested at once
+    :return: Boolean array, True where the box overlaps another box
+    """
+    n = len(box)
+    flags = np.zeros(n, dtype=bool)
+    if n < 2:
+        return flags
+
+    order = np.argsort(box[:, 0], kind='stable')
+    x0, y0, x1, y1 = (box[order, i] for i in range(4))
+    # Box j > i in sweep order is a candidate while x0_j < x1_i
+    stop = np.searchsorted(x0, x1, side='left')
+    counts = np.maximum(stop - np.arange(n) - 1, 0)
+
+    sorted_flags = np.zeros(n, dtype=bool)
+    cumulative = np.cumsum(counts)
+    start = 0
+    while start < n:
+        # Take as many sweep positions as fit in one chunk of pairs (at least one)
+        limit = (cumulative[start - 1] if start else 0) + chunk_size
+        end = max(int(np.searchsorted(cumulative, limit, side='right')), start + 1)
+        first = np.repeat(np.arange(start, end), counts[start:end])
+        if first.size:
+            # Offsets 1..count for each i, built without a Python loop
+            group_start = np.repeat(np.cumsum(counts[start:end]) - counts[start:end], counts[start:end])
+            second = first + 1 + np.arange(first.size) - group_start
+            hit = (y0[second] < y1[first]) & (y0[first] < y1[second])
+            sorted_flags[first[hit]] = True
+            sorted_flags[second[hit]] = True
+        start = end
+
+    flags[order] = sorted_flags
+    return flags
+
+
+def nearest_neighbor_distances(centroid):
+    """Distance from each centroid to its nearest other centroid, via a KD-tree."""
+    from scipy.spatial import cKDTree
+
+    if len(centroid) < 2:
+        return np.zeros(len(centroid))
+    distances, _ = cKDTree(centroid).query(centroid, k=2, workers=-1)
+    return distances[:, 1]
+
+
+def calculate_metrics(columns, mpp=None, tissue_area_mm2=None):
+    """
+    Summary metrics of a segmentation result.
+    The top-level keys are those of the original schema, in pixels. The
+    density is per mm² of tissue, or of the area spanned by the nuclei when no
+    tissue area is known; without an MPP it falls back to the original
+    assumption of a 1 mm² image. The ``physical`` section records the MPP, the
+    area the density refers to and the µm and µm² measures (None without an MPP).
+    :param columns: Columnar nuclei as returned by nuclei_to_columns
+    :param mpp: (x, y) microns per pixel of the nucleus coordinates, or None
+    :param tissue_area_mm2: Tissue area of the segmented image in mm², or None
+    :return: Dict in the segmentation_metrics.json schema
+    """
+    box = columns['box']
+    total_nuclei = len(box)
+
+    width = box[:, 2] - box[:, 0]
+    height = box[:, 3] - box[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        aspect_ratio = width / height
+
+    type_counts = np.bincount(np.asarray(columns['type'], dtype=np.int64).clip(0), minlength=5)
+    type_distribution = {name: int(type_counts[type_id]) for type_id, name in NUCLEUS_TYPES.items()}
+    type_distribution['other'] = total_nuclei - sum(type_distribution.values())
+
+    confidences = np.asarray(columns['prob'], dtype=np.float64)
+    centroid = np.asarray(columns['centroid'], dtype=np.float64)
+    nearest = nearest_neighbor_distances(centroid)
+
+    area = width * height
+    pixel_area_um2 = None if mpp is None else float(mpp[0]) * float(mpp[1])
+    density_area_mm2, density_area_source = 1.0, 'assumed_1mm2'
+    if tissue_area_mm2:
+        density_area_mm2, density_area_source = float(tissue_area_mm2), 'tissue_mask'
+    elif pixel_area_um2 is not None and total_nuclei > 1:
+        extent = centroid.max(axis=0) - centroid.min(axis=0)
+        if extent[0] * extent[1] > 0:
+            density_area_mm2, density_area_source = float(extent[0] * extent[1]) * pixel_area_um2 * 1e-6, 'nuclei_extent'
+
+    metrics = {
+        'total_nuclei': total_nuclei,
+        'nucleus_type_distribution': type_distribution,
+        'average_nucleus_area': float(area.mean()) if total_nuclei else 0,
+        'average_aspect_ratio': float(aspect_ratio.mean()) if total_nuclei else 0,
+        'nearest_neighbor_distance': float(nearest.mean()) if total_nuclei else float('nan'),
+        'nuclei_density': total_nuclei / density_area_mm2,
+        'confidence_score_distribution': {
+            'average_confidence': float(confidences.mean()) if total_nuclei else float('nan'),
+            'low_confidence_count': int((confidences < 0.5).sum())
+        },
+        'nuclei_with_overlaps': int(overlapping_boxes(box).sum()),
+        'physical': {
+            'mpp': None,
+            'density_area_mm2': density_area_mm2,
+            'density_area_source': density_area_source,
+            'average_nucleus_area_um2': None,
+            'nearest_neighbor_distance_um': None,
+        },
+    }
+    if mpp is not None:
+        # µm = pixels × sqrt of the pixel area, exact for square pixels
+        metrics['physical'].update(
+            mpp=[float(mpp[0]), float(mpp[1])],
+            average_nucleus_area_um2=float(area.mean()) * pixel_area_um2 if total_nuclei else 0,
+            nearest_neighbor_distance_um=metrics['nearest_neighbor_distance'] * pixel_area_um2 ** 0.5,
+        )
+
+    return metrics
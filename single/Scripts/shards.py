@@ -0,0 +1,121 @@
+"""Split a slide into overlapping shards for segmentation and merge the results.
+
+Each shard segments its ``region`` (its ``core`` grown by an overlap margin)
+and owns the nuclei whose centroid falls inside its ``core``. Cores
+partition the slide, so after filtering by ownership every nucleus that
+straddles a shard boundary is kept exactly once, from a shard that saw it
+whole.
+"""
+import json
+import os
+
+import numpy as np
+
+SHARD_FILE = 'shard.json'
+
+
+def _grid_shape(num_shards, width, height):
+    """Factor num_shards into (rows, cols) closest to the aspect ratio of the area."""
+    best = None
+    for rows in range(1, num_shards + 1):
+        if num_shards % rows:
+            continue
+        cols = num_shards // rows
+        cost = abs(np.log((cols / rows) / (width / max(height, 1))))
+        if best is None or cost < best[0]:
+            best = (cost, rows, cols)
+    return best[1], best[2]
+
+
+def plan_shards(bounds, image_shape, num_shards, overlap):
+    """
+    Split bounds into a grid of shards.
+    :param bounds: (x0, y0, x1, y1) area to segment, e.g. the tissue bounding box
+    :param image_shape: (height, width) of the image in baseline pixels
+    :param num_shards: Number of shards
+    :param overlap: Margin in pixels added around each core
+    :return: List of dicts with 'index', 'core' and 'region' boxes
+    """
+    height, width = image_shape[:2]
+    x0, y0, x1, y1 = bounds
+    rows, cols = _grid_shape(num_shards, x1 - x0, y1 - y0)
+    xs = np.linspace(x0, x1, cols + 1).round().astype(int)
+    ys = np.linspace(y0, y1, rows + 1).round().astype(int)
+    # Outer cores reach the image edge so no nucleus is left unowned
+    xs[0], xs[-1], ys[0], ys[-1] = 0, width, 0, height
+
+    plan = []
+    for row in range(rows):
+        for col in range(cols):
+            core = (int(xs[col]), int(ys[row]), int(xs[col + 1]), int(ys[row + 1]))
+            region = (
+                max(core[0] - overlap, 0), max(core[1] - overlap, 0),
+                min(core[2] + overlap, width), min(core[3] + overlap, height),
+            )
+            plan.append({'index': len(plan), 'core': core, 'region': region})
+    return plan
+
+
+def mask_bounds(mask, image_shape):
+    """Bounding box (x0, y0, x1, y1) in image pixels of the nonzero part of a mask."""
+    height, width = image_shape[:2]
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return 0, 0, width, height
+    scale_y = height / mask.shape[0]
+    scale_x = width / mask.shape[1]
+    return (
+        int(cols[0] * scale_x), int(rows[0] * scale_y),
+        min(int(np.ceil((cols[-1] + 1) * scale_x)), width),
+        min(int(np.ceil((rows[-1] + 1) * scale_y)), height),
+    )
+
+
+def restrict_mask(mask, image_shape, region):
+    """Copy of a low resolution mask with everything outside region cleared."""
+    height, width = image_shape[:2]
+    scale_y = mask.shape[0] / height
+    scale_x = mask.shape[1] / width
+    x0, y0, x1, y1 = region
+    restricted = np.zeros_like(mask)
+    ys = slice(int(y0 * scale_y), int(np.ceil(y1 * scale_y)))
+    xs = slice(int(x0 * scale_x), int(np.ceil(x1 * scale_x)))
+    restricted[ys, xs] = mask[ys, xs]
+    return restricted
+
+
+def save_shard_info(output_dir, shard, num_shards):
+    """Record which shard an output directory holds."""
+    with open(os.path.join(output_dir, SHARD_FILE), 'w') as f:
+        json.dump(dict(shard, num_shards=num_shards), f, indent=4)
+
+
+def load_shard_info(output_dir):
+    with open(os.path.join(output_dir, SHARD_FILE)) as f:
+        return json.load(f)
+
+
+def owned_nuclei(nuclei_predictions, core):
+    """Subset of a 0.dat dict whose centroids fall inside the shard core."""
+    x0, y0, x1, y1 = core
+    return {
+        key: nucleus for key, nucleus in nuclei_predictions.items()
+        if x0 <= nucleus['centroid'][0] < x1 and y0 <= nucleus['centroid'][1] < y1
+    }
+
+
+def merge_shard_predictions(shard_results):
+    """
+    Merge per-shard 0.dat dicts, keeping each nucleus only in its owning shard.
+    :param shard_results: Iterable of (shard info, 0.dat dict)
+    :return: Merged dict in the 0.dat layout
+    """
+    merged = {}
+    for shard, nuclei_predictions in shard_results:
+        for key, nucleus in owned_nuclei(nuclei_predictions, shard['core']).items():
+            # Tile-mode ids restart at 0 in every shard; prefix only on collision
+            if key in merged:
+                key = f"{shard['index']}_{key}"
+            merged[key] = nucleus
+    return merged
@@ -0,0 +1,153 @@
+"""Typed slide metadata that travels with every intermediate image.
+
+stain_normalization.py writes ``slide_metadata.json`` next to the normalized
+image and nuclei_segmentation.py copies it next to ``0.dat``, so every stage
+knows the physical pixel size of the pixels it is handed. SlideMetadata.load
+also reads the legacy ``metadata.pkl`` (a pickled ``WSIMeta.as_dict()``).
+"""
+import json
+import os
+from dataclasses import asdict, dataclass, replace
+from typing import Optional, Tuple
+
+METADATA_FILE = 'slide_metadata.json'
+
+# Resolution, in microns per pixel, each stage reads at. Stages never read
+# finer than this, and never finer than the slide itself.
+STAGE_MPP = {
+    'tissue_mask': 8.0,
+    # hovernet_fast-pannuke is trained on 40x PanNuke patches
+    'segmentation': 0.25,
+    'features': 0.5,
+}
+
+
+def _pair(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return (float(value), float(value))
+    return tuple(float(v) for v in value)
+
+
+@dataclass(frozen=True)
+class SlideMetadata:
+    """
+    Geometry of one image of a slide at its baseline resolution.
+    ``source`` keeps the metadata of the image this one was derived from,
+    e.g. the original slide of a normalized TIFF.
+    """
+
+    dimensions: Tuple[int, int]
+    mpp: Optional[Tuple[float, float]] = None
+    mpp_source: str = 'slide'
+    objective_power: Optional[float] = None
+    level_downsamples: Tuple[float, ...] = (1.0,)
+    vendor: Optional[str] = None
+    tissue_area_mm2: Optional[float] = None
+    source: Optional[dict] = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build from a dict written by save() or a legacy WSIMeta.as_dict()."""
+        dimensions = data.get('dimensions') or data.get('slide_dimensions')
+        mpp = _pair(data.get('mpp'))
+        return cls(
+            dimensions=tuple(int(v) for v in dimensions),
+            mpp=mpp,
+            mpp_source=data.get('mpp_source', 'slide') if mpp is not None else 'unknown',
+            objective_power=data.get('objective_power'),
+            level_downsamples=tuple(float(v) for v in data.get('level_downsamples') or (1.0,)),
+            vendor=data.get('vendor'),
+            tissue_area_mm2=data.get('tissue_area_mm2'),
+            source=data.get('source'),
+        )
+
+    @classmethod
+    def from_reader(cls, reader, default_mpp=None):
+        """
+        Read the metadata of an opened WSIReader.
+        :param reader: tiatoolbox WSIReader
+        :param default_mpp: MPP assumed when the slide does not record one
+        """
+        metadata = cls.from_dict(reader.info.as_dict())
+        if metadata.mpp is None and default_mpp is not None:
+            metadata = replace(metadata, mpp=_pair(default_mpp), mpp_source='default')
+        return metadata
+
+    @classmethod
+    def load(cls, path):
+        """Load slide_metadata.json, or a legacy metadata.pkl."""
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Metadata file {path} not found.")
+        if path.endswith('.json'):
+            with open(path) as f:
+                return cls.from_dict(json.load(f))
+        import joblib
+
+        return cls.from_dict(joblib.load(path))
+
+    @classmethod
+    def find(cls, *directories):
+        """Load the slide_metadata.json of the first directory that has one, else None."""
+        for directory in directories:
+            path = os.path.join(directory, METADATA_FILE)
+            if os.path.isfile(path):
+                return cls.load(path)
+        return None
+
+    def save(self, path):
+        """Write as JSON; path may be a directory, which receives slide_metadata.json."""
+        if os.path.isdir(path):
+            path = os.path.join(path, METADATA_FILE)
+        with open(path, 'w') as f:
+            json.dump(asdict(self), f, indent=4)
+        return path
+
+    def derive(self, dimensions, mpp):
+        """Metadata of an image resampled from this one, e.g. a normalized TIFF."""
+        return SlideMetadata(
+            dimensions=tuple(int(v) for v in dimensions),
+            mpp=_pair(mpp),
+            mpp_source=self.mpp_source,
+            objective_power=None,
+            vendor=self.vendor,
+            tissue_area_mm2=self.tissue_area_mm2,
+            source=json.loads(json.dumps(asdict(self))),
+        )
+
+    def with_mpp(self, default_mpp):
+        """This metadata, assuming default_mpp if the slide has no MPP."""
+        if self.mpp is not None or default_mpp is None:
+            return self
+        return replace(self, mpp=_pair(default_mpp), mpp_source='default')
+
+    def with_tissue_area(self, tissue_fraction):
+        """This metadata with the tissue area of a mask covering tissue_fraction of the image."""
+        return replace(self, tissue_area_mm2=self.area_mm2(tissue_fraction * self.dimensions[0] * self.dimensions[1]))
+
+    @property
+    def mpp_value(self):
+        """Mean of the x and y MPP, or None when unknown."""
+        return None if self.mpp is None else (self.mpp[0] + self.mpp[1]) / 2
+
+    @property
+    def pixel_area_um2(self):
+        return None if self.mpp is None else self.mpp[0] * self.mpp[1]
+
+    def area_mm2(self, pixels):
+        """Area of a number of baseline pixels in mm², or None when the MPP is unknown."""
+        return None if self.mpp is None else float(pixels) * self.pixel_area_um2 * 1e-6
+
+    def read_mpp(self, target_mpp):
+        """
+        Resolution to read at for a stage needing target_mpp: the target,
+        but never finer than the baseline. None when the MPP is unknown.
+        """
+        if self.mpp is None:
+            return None
+        return max(float(target_mpp), min(self.mpp))
+
+    def stage_mpp(self, stage):
+        """read_mpp for one of the stages in STAGE_MPP."""
+        return self.read_mpp(STAGE_MPP[stage])
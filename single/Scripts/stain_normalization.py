@@ -1,85 +1,210 @@
-#!/usr/bin/env python 
+#!/usr/bin/env python
 
 import argparse
-import matplotlib.pyplot as plt
+import contextlib
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from PIL import Image
 import numpy as np
-import pickle
-from tiatoolbox import data, logger
-from tiatoolbox.tools import stainnorm
-from tiatoolbox.wsicore.wsireader import WSIReader
+import image_conversion
+import tiled_normalization
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from image_conversion import iter_array_tiles, write_pyramidal_tiff
+from prefetch import RegionPrefetcher, add_prefetch_arguments, imap_ordered
+from slide_metadata import METADATA_FILE, SlideMetadata
+from tiled_normalization import (
+    STAIN_METHODS,
+    as_uint8_rgb,
+    fit_source_params,
+    fit_target_params,
+    get_stain_normalizer,
+    init_tile_worker,
+    normalize_tile,
+    normalize_tile_at,
+    read_tile,
+    sample_tissue_tiles,
+    tile_grid,
+)
+from telemetry import add_telemetry_arguments, start_telemetry
+from wsi_cache import add_cache_arguments, open_wsi
+
+# Full mode holds the whole slide in one array, so it reads no finer than this
+FULL_MODE_MPP = 1.0
 
 # Parse command-line arguments
-parser = argparse.ArgumentParser(description="Stain Normalization with PNG output and metadata storage")
+parser = argparse.ArgumentParser(description="Stain Normalization with pyramidal TIFF output and metadata storage")
 parser.add_argument('--input', type=str, required=True, help='Path to input WSI file')
-parser.add_argument('--output', type=str, required=True, help='Path to save normalized WSI image as PNG')
+parser.add_argument('--output', type=str, required=True, help='Path to save normalized WSI image as pyramidal TIFF (legacy PNG when it ends in .png in full mode)')
 parser.add_argument('--reference', type=str, help='Path to reference image for stain normalization', default=None)
-parser.add_argument('--method', type=str, choices=['vahadane', 'macenko', 'reinhard', 'ruifrok'], default='vahadane', help='Stain normalization method to use')
+parser.add_argument('--method', type=str, choices=STAIN_METHODS, default='vahadane', help='Stain normalization method to use')
+parser.add_argument('--mode', type=str, choices=['full', 'tiled'], default='full', help='"full" normalizes the slide in one array, "tiled" streams tiles into a pyramidal TIFF')
+parser.add_argument('--resolution', type=float, default=None, help=f'Output resolution in microns per pixel (default: the resolution nuclei segmentation reads at in tiled mode, {FULL_MODE_MPP} in full mode; never finer than the slide)')
+parser.add_argument('--default_mpp', type=float, default=0.5, help='MPP assumed when the slide does not record one')
+parser.add_argument('--tile_size', type=int, default=512, help='Tile size in pixels of the output TIFF (multiple of 16)')
+parser.add_argument('--workers', type=int, default=1, help='Number of parallel tile workers in tiled mode')
+parser.add_argument('--pool', type=str, choices=['process', 'thread'], default='process', help='Worker pool type for --workers > 1')
+parser.add_argument('--sample_tiles', type=int, default=32, help='Number of tissue tiles used to fit the slide stains in tiled mode')
+add_cache_arguments(parser)
+add_checkpoint_arguments(parser)
+add_prefetch_arguments(parser)
+add_telemetry_arguments(parser)
 
 args = parser.parse_args()
+if args.tile_size % 16:
+    parser.error('--tile_size must be a multiple of 16')
+telemetry = start_telemetry('stain_normalization', args, method=args.method, mode=args.mode)
 
 # Set up logging
-logger.setLevel('INFO')
-
-# Load the WSI and extract metadata
-wsi_reader = WSIReader.open(args.input)
-metadata = wsi_reader.info.as_dict()  # Save metadata to reapply later
-
-# Extract full-resolution WSI or appropriate resolution based on requirements
-slide_image = wsi_reader.read_region(location=(0, 0), level=0, size=wsi_reader.slide_dimensions(resolution= 1.0, units="mpp")[0]) # Changed from .5 to 2.0
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Load the WSI (low resolution reads go through the shared cache) and extract metadata
+wsi_reader = open_wsi(args.input, args.cache_dir, args.cache_max_mb)
+metadata = SlideMetadata.from_reader(wsi_reader.reader, default_mpp=args.default_mpp)
+if metadata.mpp_source == 'default':
+    logger.warning(f"No MPP in {args.input}, assuming {args.default_mpp}")
+    wsi_reader = open_wsi(args.input, args.cache_dir, args.cache_max_mb, mpp=metadata.mpp)
+
+# Write only as fine as the next stages need; reading at this resolution lets
+# the reader pick the coarsest pyramid level that still covers it. Full mode
+# stays coarse, as reading a 40x slide at segmentation resolution in one
+# array is what tiled mode exists to avoid
+if args.resolution:
+    resolution = args.resolution
+elif args.mode == 'tiled':
+    resolution = metadata.stage_mpp('segmentation')
+else:
+    resolution = metadata.read_mpp(FULL_MODE_MPP)
+logger.info(f"Normalizing at {resolution} mpp (slide baseline {metadata.mpp} mpp)")
 
-# Create a writable copy of the image
-slide_image_writable = np.array(slide_image)  # Convert to NumPy array
-if not slide_image_writable.flags.writeable:
-    slide_image_writable = np.copy(slide_image_writable)  # Ensure writable
+# Ensure the output directory exists
+output_path = Path(args.output)
+output_dir = output_path.parent
+output_dir.mkdir(parents=True, exist_ok=True)
+if args.mode == 'full' and output_path.suffix.lower() == '.png':
+    normalized_output_path = output_path
+else:
+    normalized_output_path = output_path.with_suffix('.tif')
+metadata_path = output_dir / METADATA_FILE
+
+# Skip the stage when this slide was normalized with the same settings before
+checkpoint = Checkpoint(
+    'stain_normalization',
+    inputs=[args.input, args.reference],
+    params=dict({name: getattr(args, name) for name in ['method', 'mode', 'tile_size', 'sample_tiles']}, resolution=resolution, mpp=metadata.mpp),
+    code=[__file__, tiled_normalization.__file__, image_conversion.__file__],
+    store=args.checkpoint_dir,
+    force=args.force,
+)
+if checkpoint.restore([str(normalized_output_path), str(metadata_path)]):
+    logger.info(f"Normalized image {normalized_output_path} is up to date")
+    exit(0)
 
 # Load or set the reference image
 if args.reference:
+    import matplotlib.pyplot as plt
+
     reference_image = plt.imread(args.reference)
     logger.info(f"Using provided reference image: {args.reference}")
 else:
+    from tiatoolbox import data
+
     reference_image = data.stain_norm_target()
     logger.info("Using default reference image from tiatoolbox.")
+reference_image = as_uint8_rgb(reference_image)
 
 # Initialize the stain normalizer
-if args.method == 'vahadane':
-    stain_normalizer = stainnorm.VahadaneNormalizer()
-elif args.method == 'macenko':
-    stain_normalizer = stainnorm.MacenkoNormalizer()
-elif args.method == 'reinhard':
-    stain_normalizer = stainnorm.ReinhardNormalizer()
-elif args.method == 'ruifrok':
-    stain_normalizer = stainnorm.RuifrokNormalizer()
+stain_normalizer = get_stain_normalizer(args.method)
+
+# Fit the normalizer to the reference image, reusing a cached fit when available
+cache = wsi_reader.cache
+with telemetry.step('fit_target'):
+    target_params = fit_target_params(stain_normalizer, args.method, reference_image, cache=cache)
+
+if args.mode == 'tiled':
+    # Fit the slide stains once on a sample of tissue tiles, then stream every
+    # tile through the same fixed transform so peak memory follows tile size
+    width, height = (int(v) for v in wsi_reader.slide_dimensions(resolution=resolution, units="mpp"))
+    grid = tile_grid((height, width), args.tile_size)
+    # Tiles are read and decoded on --read_workers threads ahead of normalization
+    prefetcher = RegionPrefetcher.for_path(args.input, mpp=metadata.mpp, workers=args.read_workers, read_ahead=args.read_ahead)
+    with telemetry.step('fit_source') as step:
+        tissue_mask = wsi_reader.tissue_mask_array(resolution=wsi_reader.info.level_count - 1, units='level')
+        sample_image = sample_tissue_tiles(
+            wsi_reader.reader, tissue_mask, (height, width), grid, args.tile_size, resolution, args.sample_tiles,
+            prefetcher=prefetcher,
+        )
+        params = {'method': args.method}
+        params.update(target_params)
+        params.update(fit_source_params(stain_normalizer, args.method, sample_image))
+        step.add_items(len(sample_image) // args.tile_size, 'tiles')
+    logger.info(f"Fitted {args.method} parameters on {len(sample_image) // args.tile_size} tissue tiles")
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(prefetcher)
+        stack.enter_context(telemetry.step('normalize')).add_items(len(grid), 'tiles')
+        if args.workers > 1:
+            # Workers receive the fitted parameters once via the initializer;
+            # tiles come back in grid order for the sequential TIFF writer
+            pool_class = ProcessPoolExecutor if args.pool == 'process' else ThreadPoolExecutor
+            executor = stack.enter_context(pool_class(
+                max_workers=args.workers,
+                initializer=init_tile_worker,
+                initargs=(args.input, params, args.tile_size, resolution, metadata.mpp),
+            ))
+            tiles = imap_ordered(executor, normalize_tile_at, grid, window=4 * args.workers)
+            logger.info(f"Normalizing {len(grid)} tiles on {args.workers} {args.pool} workers")
+        else:
+            tiles = (
+                normalize_tile(tile, params)
+                for tile in prefetcher.map(lambda reader, location: read_tile(reader, location, args.tile_size, resolution), grid)
+            )
+        write_pyramidal_tiff(
+            str(normalized_output_path),
+            tiles,
+            (height, width, 3),
+            tile_size=args.tile_size,
+            mpp=(resolution, resolution),
+        )
 else:
-    raise ValueError(f"Unsupported stain normalization method: {args.method}")
-
-# Fit the normalizer to the reference image
-stain_normalizer.fit(reference_image)
-
-# Perform stain normalization on the slide image
-normalized_image = stain_normalizer.transform(slide_image_writable)
-
-# Ensure the output directory exists
-output_path = Path(args.output)
-output_dir = output_path.parent
-output_dir.mkdir(parents=True, exist_ok=True)
-
-# Convert to RGB format if necessary (to ensure compatibility with PNG format)
-if normalized_image.shape[-1] == 4:  # RGBA to RGB if needed
-    normalized_image = normalized_image[:, :, :3]
-
-# Convert normalized_image (NumPy array) to PIL Image for saving as PNG
-normalized_image_pil = Image.fromarray((normalized_image * 255).astype(np.uint8))
-
-# Save the normalized image as PNG
-png_output_path = output_path.with_suffix('.png')
-normalized_image_pil.save(png_output_path)
-
-# Store the metadata for later use (e.g., segmentation)
-metadata_path = output_dir / 'metadata.pkl'
-with open(metadata_path, 'wb') as f:
-    pickle.dump(metadata, f)
-
-logger.info(f"Stain normalization completed. Normalized PNG image saved to {png_output_path}")
+    # Read the whole slide at the output resolution, from the coarsest level that covers it
+    width, height = metadata.dimensions
+    with telemetry.step('read'):
+        slide_image = wsi_reader.reader.read_bounds((0, 0, width, height), resolution=resolution, units="mpp")
+
+    # Create a writable copy of the image
+    slide_image_writable = np.array(slide_image)  # Convert to NumPy array
+    if not slide_image_writable.flags.writeable:
+        slide_image_writable = np.copy(slide_image_writable)  # Ensure writable
+
+    # Perform stain normalization on the slide image
+    with telemetry.step('normalize'):
+        normalized_image = stain_normalizer.transform(slide_image_writable)
+
+    # Convert to RGB format if necessary (to ensure compatibility with PNG format)
+    if normalized_image.shape[-1] == 4:  # RGBA to RGB if needed
+        normalized_image = normalized_image[:, :, :3]
+
+    normalized_image = as_uint8_rgb(normalized_image)
+
+    if output_path.suffix.lower() == '.png':
+        # Legacy hand-off: a PNG can only be decoded as a whole by later stages
+        from PIL import Image
+
+        Image.fromarray(normalized_image).save(normalized_output_path)
+    else:
+        write_pyramidal_tiff(
+            str(normalized_output_path),
+            iter_array_tiles(normalized_image, args.tile_size),
+            normalized_image.shape,
+            tile_size=args.tile_size,
+            mpp=(resolution, resolution),
+        )
+
+# Store the metadata of the normalized image for later use (e.g., segmentation)
+normalized_shape = (height, width) if args.mode == 'tiled' else normalized_image.shape[:2]
+metadata.derive((normalized_shape[1], normalized_shape[0]), (resolution, resolution)).save(str(metadata_path))
+checkpoint.save([str(normalized_output_path), str(metadata_path)])
+
+logger.info(f"Stain normalization completed. Normalized image saved to {normalized_output_path}")
 logger.info(f"Metadata saved to {metadata_path}")
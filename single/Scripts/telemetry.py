@@ -0,0 +1,231 @@
+"""Per-stage resource telemetry shared by the pipeline scripts.
+
+Every script calls start_telemetry once after parsing its arguments and
+wraps its expensive parts in ``telemetry.step(...)``. Each finished step and
+finally the whole run is appended as one JSON line to ``--telemetry``:
+
+    {"stage": "nuclei_segmentation", "step": "predict", "wall_s": 812.4,
+     "cpu_s": 3010.2, "peak_rss_mb": 9120.5, "gpu_peak_mb": 6321.0,
+     "read_bytes": ..., "write_bytes": ..., "items": {"nuclei": 48211}, ...}
+
+CPU time includes reaped child processes (DataLoader and pool workers). Peak
+RSS is per step where the kernel allows resetting the high-water mark and
+the process lifetime peak otherwise. GPU memory is only reported when the
+script has already imported torch. ``--profile`` additionally writes a
+cProfile dump of the run for snakeviz, pstats or flameprof.
+"""
+import atexit
+import contextlib
+import json
+import logging
+import os
+import resource
+import socket
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_ENV = 'TIA_TELEMETRY'
+
+
+def add_telemetry_arguments(parser):
+    """Add the --telemetry/--profile options shared by every stage."""
+    parser.add_argument('--telemetry', type=str, default=os.environ.get(TELEMETRY_ENV), help=f'Append per-step resource records to this JSONL file (default: ${TELEMETRY_ENV})')
+    parser.add_argument('--profile', type=str, default=None, help='Write a cProfile dump of the run to this file')
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, children.ru_utime + children.ru_stime
+
+
+def _io_bytes():
+    """Bytes passed through read/write calls so far, or None off Linux."""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _peak_rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    """Reset the kernel's RSS high-water mark; False when not permitted."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _gpu_torch():
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch
+    return None
+
+
+class Step:
+    """Counters of one running step."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = {}
+        self.peak_rss = 0
+        self.gpu_peak = None
+        self.start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = _cpu_seconds()
+        self._io = _io_bytes()
+
+    def add_items(self, count, kind='items'):
+        """Count processed items (tiles, nuclei, patches, ...) towards this step."""
+        self.items[kind] = self.items.get(kind, 0) + int(count)
+
+
+class Telemetry:
+    """Stack of nested steps for one stage, written as JSON lines."""
+
+    def __init__(self, stage, path=None, profile_path=None, context=None):
+        """
+        :param stage: Stage name, usually the script name
+        :param path: JSONL file to append records to; records are only logged when None
+        :param profile_path: Optional cProfile output file
+        :param context: Extra fields stored with every record (input path, ...)
+        """
+        self.stage = stage
+        self.path = path
+        self.profile_path = profile_path
+        self.context = dict(context or {})
+        self.context.update(host=socket.gethostname(), pid=os.getpid())
+        self.records = []
+        self._stack = []
+        self._closed = False
+        self._profiler = None
+        if profile_path:
+            import cProfile
+
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._begin('total')
+
+    def _begin(self, name):
+        if self._stack:
+            # Fold the parent's peak so far in before the high-water mark is reset
+            parent = self._stack[-1]
+            parent.peak_rss = max(parent.peak_rss, _peak_rss_bytes())
+        _reset_peak_rss()
+        torch = _gpu_torch()
+        if torch is not None:
+            if self._stack:
+                parent.gpu_peak = max(parent.gpu_peak or 0, torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+        step = Step(name)
+        self._stack.append(step)
+        return step
+
+    def _end(self, step):
+        assert self._stack[-1] is step, "Telemetry steps must be closed in order"
+        self._stack.pop()
+        cpu, children_cpu = _cpu_seconds()
+        step.peak_rss = max(step.peak_rss, _peak_rss_bytes())
+        torch = _gpu_torch()
+        if torch is not None:
+            step.gpu_peak = max(step.gpu_peak or 0, torch.cuda.max_memory_allocated())
+
+        record = {
+            'stage': self.stage,
+            'step': '/'.join([s.name for s in self._stack[1:]] + [step.name]),
+            'start': round(step.start, 3),
+            'wall_s': round(time.perf_counter() - step._wall, 4),
+            'cpu_s': round(cpu - step._cpu[0], 4),
+            'children_cpu_s': round(children_cpu - step._cpu[1], 4),
+            'peak_rss_mb': round(step.peak_rss / 2**20, 1),
+            'gpu_peak_mb': None if step.gpu_peak is None else round(step.gpu_peak / 2**20, 1),
+            'read_bytes': None,
+            'write_bytes': None,
+            'items': step.items,
+        }
+        io_bytes = _io_bytes()
+        if io_bytes is not None and step._io is not None:
+            record['read_bytes'] = io_bytes[0] - step._io[0]
+            record['write_bytes'] = io_bytes[1] - step._io[1]
+        record.update(self.context)
+
+        if self._stack:
+            # Parents include their children's peaks and item counts
+            parent = self._stack[-1]
+            parent.peak_rss = max(parent.peak_rss, step.peak_rss)
+            if step.gpu_peak is not None:
+                parent.gpu_peak = max(parent.gpu_peak or 0, step.gpu_peak)
+            for kind, count in step.items.items():
+                parent.add_items(count, kind)
+        self.records.append(record)
+        self._write(record)
+        return record
+
+    def _write(self, record):
+        if self.path:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    @contextlib.contextmanager
+    def step(self, name):
+        """Measure the enclosed block as a sub-step of the current step."""
+        step = self._begin(name)
+        try:
+            yield step
+        finally:
+            self._end(step)
+
+    def add_items(self, count, kind='items'):
+        """Count processed items towards the innermost running step."""
+        self._stack[-1].add_items(count, kind)
+
+    def close(self):
+        """Close any open steps and the stage itself, then dump the profile."""
+        if self._closed:
+            return
+        self._closed = True
+        while self._stack:
+            record = self._end(self._stack[-1])
+        logger.info(
+            f"{self.stage}: {record['wall_s']:.1f}s wall, {record['cpu_s'] + record['children_cpu_s']:.1f}s CPU, "
+            f"peak RSS {record['peak_rss_mb']:.0f} MB, items {record['items']}"
+        )
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            logger.info(f"Profile saved to {self.profile_path}")
+
+
+def start_telemetry(stage, args, **context):
+    """
+    Start measuring a stage from its parsed arguments and record it at exit.
+    :param stage: Stage name
+    :param args: Namespace with the options of add_telemetry_arguments
+    :param context: Extra fields stored with every record
+    :return: Telemetry
+    """
+    if getattr(args, 'input', None) is not None:
+        context.setdefault('input', str(args.input))
+    telemetry = Telemetry(stage, args.telemetry, args.profile, context)
+    atexit.register(telemetry.close)
+    return telemetry
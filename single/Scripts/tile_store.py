@@ -0,0 +1,195 @@
+"""Sharded tar container for image tiles with a random-access index.
+
+A tile store is a directory of:
+
+- ``shard-NNNNN.tar``: encoded tiles (``NNNNNNNN.png``, ``.jpg`` or ``.npy``)
+- ``coords.npy`` (N, 4) int64: (x_start, y_start, x_end, y_end) of every tile
+- ``shard.npy``, ``offset.npy``, ``size.npy``: where tile i's bytes live in its shard
+- ``manifest.json`` listing the shards, written last
+
+The shards are plain tar files, so they can be streamed with standard tools,
+while the index lets loaders read any tile with a single positioned read.
+"""
+import io
+import json
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from prefetch import imap_ordered
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+EXTENSIONS = {'png': 'png', 'jpeg': 'jpg', 'npy': 'npy'}
+
+
+def encode_tile(tile, encoding='png', quality=90):
+    """
+    Encode a tile to bytes.
+    :param tile: (H, W, C) uint8 array
+    :param encoding: "png", "jpeg" or "npy" (uncompressed)
+    :param quality: JPEG quality
+    :return: Encoded bytes
+    """
+    buffer = io.BytesIO()
+    if encoding == 'npy':
+        np.save(buffer, np.ascontiguousarray(tile), allow_pickle=False)
+    else:
+        from PIL import Image
+
+        options = {'quality': quality} if encoding == 'jpeg' else {}
+        Image.fromarray(np.asarray(tile)[..., :3]).save(buffer, format=encoding.upper(), **options)
+    return buffer.getvalue()
+
+
+def decode_tile(data, encoding='png'):
+    """Decode bytes written by encode_tile back to a uint8 array."""
+    if encoding == 'npy':
+        return np.load(io.BytesIO(data), allow_pickle=False)
+    from PIL import Image
+
+    return np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+
+
+class TileStoreWriter:
+    """Stream tiles into tar shards, encoding them on a thread pool."""
+
+    def __init__(self, path, encoding='png', quality=90, tiles_per_shard=4096, workers=4):
+        """
+        :param path: Output tile store directory
+        :param encoding: Tile encoding, see encode_tile
+        :param quality: JPEG quality
+        :param tiles_per_shard: Tiles per tar shard
+        :param workers: Threads encoding tiles; at most 4x this many tiles are in memory
+        """
+        if encoding not in EXTENSIONS:
+            raise ValueError(f"Unknown tile encoding: {encoding}")
+        self.path = path
+        self.encoding = encoding
+        self.quality = quality
+        self.tiles_per_shard = tiles_per_shard
+        self.workers = max(1, workers)
+        self.shards = []
+        self._coords = []
+        self._shard = []
+        self._offset = []
+        self._size = []
+        self._tar = None
+        os.makedirs(path, exist_ok=True)
+
+    def _encode(self, item):
+        tile, coords = item
+        return encode_tile(tile, self.encoding, self.quality), coords
+
+    def write_all(self, tiles):
+        """
+        Encode and append tiles in order.
+        :param tiles: Iterable of (tile, (x_start, y_start, x_end, y_end)) pairs
+        :return: Number of tiles written
+        """
+        written = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for data, coords in imap_ordered(executor, self._encode, tiles, window=4 * self.workers):
+                self._append(data, coords)
+                written += 1
+        return written
+
+    def _append(self, data, coords):
+        if self._tar is None or self.shards[-1]['tiles'] >= self.tiles_per_shard:
+            self._close_shard()
+            name = f'shard-{len(self.shards):05d}.tar'
+            self._tar = tarfile.open(os.path.join(self.path, name), 'w', format=tarfile.USTAR_FORMAT)
+            self.shards.append({'name': name, 'tiles': 0})
+
+        info = tarfile.TarInfo(f'{len(self._coords):08d}.{EXTENSIONS[self.encoding]}')
+        info.size = len(data)
+        # Short USTAR names always take a single 512-byte header block
+        self._offset.append(self._tar.offset + tarfile.BLOCKSIZE)
+        self._tar.addfile(info, io.BytesIO(data))
+        self._coords.append(coords)
+        self._shard.append(len(self.shards) - 1)
+        self._size.append(len(data))
+        self.shards[-1]['tiles'] += 1
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def close(self):
+        """Close the last shard and write the index and manifest."""
+        self._close_shard()
+        np.save(os.path.join(self.path, 'coords.npy'), np.asarray(self._coords, dtype=np.int64).reshape((-1, 4)))
+        np.save(os.path.join(self.path, 'shard.npy'), np.asarray(self._shard, dtype=np.int32))
+        np.save(os.path.join(self.path, 'offset.npy'), np.asarray(self._offset, dtype=np.int64))
+        np.save(os.path.join(self.path, 'size.npy'), np.asarray(self._size, dtype=np.int64))
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'tiles': len(self._coords),
+            'encoding': self.encoding,
+            'shards': self.shards,
+        }
+        tmp_path = os.path.join(self.path, f'{MANIFEST}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_shard()
+
+
+class TileStore:
+    """
+    Random-access reader over a tile store.
+    Usable as a map-style dataset; shard handles are opened lazily per process.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.path = path
+        self.encoding = self.manifest['encoding']
+        self.coords = np.load(os.path.join(path, 'coords.npy'), mmap_mode='r')
+        self._shard = np.load(os.path.join(path, 'shard.npy'), mmap_mode='r')
+        self._offset = np.load(os.path.join(path, 'offset.npy'), mmap_mode='r')
+        self._size = np.load(os.path.join(path, 'size.npy'), mmap_mode='r')
+        self._files = {}
+
+    def __len__(self):
+        return int(self.manifest['tiles'])
+
+    def read_bytes(self, index):
+        """Encoded bytes of tile index."""
+        shard = int(self._shard[index])
+        if shard not in self._files:
+            name = self.manifest['shards'][shard]['name']
+            self._files[shard] = os.open(os.path.join(self.path, name), os.O_RDONLY)
+        return os.pread(self._files[shard], int(self._size[index]), int(self._offset[index]))
+
+    def __getitem__(self, index):
+        return decode_tile(self.read_bytes(index), self.encoding)
+
+    def close(self):
+        for fd in self._files.values():
+            os.close(fd)
+        self._files = {}
+
+    def __getstate__(self):
+        # File descriptors and memory maps are per process; workers reopen the store
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+
+def is_tile_store(path):
+    """True if path is a tile store directory."""
+    return os.path.isfile(os.path.join(path, MANIFEST)) and os.path.isfile(os.path.join(path, 'coords.npy'))
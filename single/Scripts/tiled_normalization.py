@@ -0,0 +1,221 @@
+"""Tile-wise stain normalization helpers for stain_normalization.py.
+
+tiatoolbox normalizers re-estimate the source stains on every ``transform``
+call, which would make each tile normalize differently. Here the source
+statistics are fitted once on a sample of tissue tiles and every tile is then
+transformed with the same fixed parameters held in a plain dict of arrays.
+"""
+import logging
+import threading
+
+import numpy as np
+
+from mask_utils import tissue_fractions
+
+logger = logging.getLogger(__name__)
+
+STAIN_METHODS = ['vahadane', 'macenko', 'reinhard', 'ruifrok']
+
+# Per-worker state; thread-local so the same initializer serves thread pools
+_worker = threading.local()
+
+
+def get_stain_normalizer(method):
+    """Create the tiatoolbox stain normalizer for a method name."""
+    from tiatoolbox.tools import stainnorm
+
+    if method == 'vahadane':
+        return stainnorm.VahadaneNormalizer()
+    elif method == 'macenko':
+        return stainnorm.MacenkoNormalizer()
+    elif method == 'reinhard':
+        return stainnorm.ReinhardNormalizer()
+    elif method == 'ruifrok':
+        return stainnorm.RuifrokNormalizer()
+    raise ValueError(f"Unsupported stain normalization method: {method}")
+
+
+def as_uint8_rgb(image):
+    """Convert an image read by matplotlib/PIL to a uint8 RGB array."""
+    image = np.asarray(image)[..., :3]
+    if image.dtype != np.uint8:
+        image = (np.clip(image, 0, 1) * 255).astype(np.uint8)
+    return image
+
+
+def get_target_params(normalizer, method):
+    """
+    Return the target statistics of a fitted normalizer.
+    :param normalizer: Normalizer already fitted on the reference image
+    :param method: Stain normalization method name
+    :return: Dict of NumPy arrays
+    """
+    if method == 'reinhard':
+        return {
+            'target_means': np.ravel(normalizer.target_means).astype(np.float64),
+            'target_stds': np.ravel(normalizer.target_stds).astype(np.float64),
+        }
+    return {
+        'stain_matrix_target': np.asarray(normalizer.stain_matrix_target, dtype=np.float64),
+        'max_c_target': np.asarray(normalizer.maxC_target, dtype=np.float64).reshape((1, 2)),
+    }
+
+
+def set_target_params(normalizer, method, params):
+    """Restore target statistics from get_target_params onto a fresh normalizer."""
+    if method == 'reinhard':
+        normalizer.target_means = tuple(params['target_means'])
+        normalizer.target_stds = tuple(params['target_stds'])
+    else:
+        normalizer.stain_matrix_target = params['stain_matrix_target']
+        normalizer.maxC_target = params['max_c_target']
+
+
+def fit_target_params(normalizer, method, reference_image, cache=None):
+    """
+    Fit the normalizer on the reference image, or load the fit from a cache.
+    :param normalizer: Stain normalizer for the method
+    :param method: Stain normalization method name
+    :param reference_image: uint8 RGB reference image
+    :param cache: Optional DiskCache keyed by reference content and method
+    :return: Target parameters as returned by get_target_params
+    """
+    import tiatoolbox
+    from disk_cache import make_key
+
+    key = make_key('stain-target', method, tiatoolbox.__version__, reference_image)
+    params = cache.get(key) if cache is not None else None
+    if params is not None:
+        logger.info(f"Loaded cached {method} fit for reference {key[:12]}")
+        set_target_params(normalizer, method, params)
+        return params
+
+    normalizer.fit(reference_image)
+    params = get_target_params(normalizer, method)
+    if cache is not None:
+        cache.put(key, params)
+    return params
+
+
+def fit_source_params(normalizer, method, sample_image):
+    """
+    Fit the source statistics once on a sample of slide tiles.
+    :param normalizer: Stain normalizer for the method
+    :param method: Stain normalization method name
+    :param sample_image: uint8 RGB image made of stacked tissue tiles
+    :return: Dict of NumPy arrays
+    """
+    if method == 'reinhard':
+        means, stds = normalizer.get_mean_std(sample_image)
+        return {
+            'source_means': np.ravel(means).astype(np.float64),
+            'source_stds': np.ravel(stds).astype(np.float64),
+        }
+    stain_matrix_source = normalizer.extractor.get_stain_matrix(sample_image)
+    source_concentrations = normalizer.get_concentrations(sample_image, stain_matrix_source)
+    max_c_source = np.percentile(source_concentrations, 99, axis=0).reshape((1, 2))
+    return {
+        # Least-squares projection of optical density onto the source stains
+        'source_projection': np.linalg.pinv(stain_matrix_source.T).T,
+        'max_c_source': max_c_source,
+    }
+
+
+def normalize_tile(tile, params):
+    """
+    Normalize one tile with fixed, pre-fitted parameters.
+    :param tile: uint8 RGB tile
+    :param params: Dict with 'method' plus target and source parameters
+    :return: Normalized uint8 RGB tile
+    """
+    if params['method'] == 'reinhard':
+        from tiatoolbox.tools.stainnorm import ReinhardNormalizer
+
+        channels = ReinhardNormalizer.lab_split(tile)
+        normalized = [
+            ((channel - mean) * (target_std / std) + target_mean).astype(np.float32)
+            for channel, mean, std, target_mean, target_std in zip(
+                channels, params['source_means'], params['source_stds'],
+                params['target_means'], params['target_stds'],
+            )
+        ]
+        return ReinhardNormalizer.merge_back(*normalized)
+
+    od = np.maximum(-np.log(np.maximum(tile, 1).reshape((-1, 3)) / 255.0), 1e-6)
+    concentrations = od @ params['source_projection']
+    concentrations *= params['max_c_target'] / params['max_c_source']
+    normalized = 255 * np.exp(-1 * concentrations @ params['stain_matrix_target'])
+    return np.clip(normalized, 0, 255).reshape(tile.shape).astype(np.uint8)
+
+
+def tile_grid(shape, tile_size):
+    """Return the (x, y) origins of a row-major tile grid covering (height, width)."""
+    height, width = shape[:2]
+    return [(x, y) for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+
+def read_tile(wsi_reader, location, tile_size, resolution, units='mpp'):
+    """Read one tile whose location is given in the output resolution."""
+    tile = wsi_reader.read_rect(
+        location=location,
+        size=(tile_size, tile_size),
+        resolution=resolution,
+        units=units,
+        coord_space='resolution',
+    )
+    return np.ascontiguousarray(tile[..., :3], dtype=np.uint8)
+
+
+def sample_tissue_tiles(wsi_reader, mask, shape, grid, tile_size, resolution, n_tiles, min_tissue=0.5, seed=0, prefetcher=None):
+    """
+    Read a random sample of tissue tiles and stack them into one image.
+    :param wsi_reader: Opened WSIReader
+    :param mask: Low resolution boolean tissue mask of the whole slide
+    :param shape: (height, width) of the slide at the output resolution
+    :param grid: List of (x, y) tile origins at the output resolution
+    :param tile_size: Tile edge in pixels
+    :param resolution: Output resolution in mpp
+    :param n_tiles: Maximum number of tiles to sample
+    :param min_tissue: Minimum tissue fraction for a tile to be sampled
+    :param seed: Random seed so reruns fit the same parameters
+    :param prefetcher: Optional RegionPrefetcher reading the sampled tiles concurrently
+    :return: uint8 RGB image of shape (k * tile_size, tile_size, 3)
+    """
+    fractions = tissue_fractions(mask, shape, grid, tile_size)
+
+    candidates = np.flatnonzero(fractions >= min_tissue)
+    if candidates.size == 0:
+        # Fall back to the most tissue-rich tiles on sparse or faint slides
+        candidates = np.argsort(fractions)[::-1][:max(n_tiles, 1)]
+    rng = np.random.default_rng(seed)
+    chosen = np.sort(rng.choice(candidates, size=min(n_tiles, candidates.size), replace=False))
+    locations = [grid[i] for i in chosen]
+    if prefetcher is not None:
+        tiles = prefetcher.map(lambda reader, location: read_tile(reader, location, tile_size, resolution), locations)
+    else:
+        tiles = (read_tile(wsi_reader, location, tile_size, resolution) for location in locations)
+    return np.concatenate(list(tiles), axis=0)
+
+
+def init_tile_worker(input_path, params, tile_size, resolution, mpp=None):
+    """
+    Pool initializer: open the slide once per worker and keep the fitted
+    parameters, so they are shipped to each worker once instead of per tile.
+    :param input_path: Path to input WSI file
+    :param params: Fitted parameters from get_target_params/fit_source_params
+    :param tile_size: Tile edge in pixels
+    :param resolution: Output resolution in mpp
+    :param mpp: (x, y) MPP overriding the slide's own, for images without one
+    """
+    from tiatoolbox.wsicore.wsireader import WSIReader
+
+    _worker.reader = WSIReader.open(input_path, mpp=mpp)
+    _worker.params = params
+    _worker.tile_size = tile_size
+    _worker.resolution = resolution
+
+
+def normalize_tile_at(location):
+    """Read and normalize the tile at location using the worker state."""
+    tile = read_tile(_worker.reader, location, _worker.tile_size, _worker.resolution)
+    return normalize_tile(tile, _worker.params)
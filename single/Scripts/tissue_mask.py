@@ -2,21 +2,25 @@
 
 import os
 import argparse
-import cv2  # OpenCV for handling regular images
-from tiatoolbox.wsicore.wsireader import WSIReader
-from PIL import Image
+from slide_metadata import SlideMetadata
+from telemetry import add_telemetry_arguments, start_telemetry
+from wsi_cache import add_cache_arguments, open_wsi
 import numpy as np
-import matplotlib.pyplot as plt
 
 # Argument parser
 parser = argparse.ArgumentParser(description="Tissue Masking for WSIs or Regular Images")
 parser.add_argument('--input', type=str, help='Path to WSI or regular image file', required=True)
 parser.add_argument('--output', type=str, help='Directory to save tissue mask', required=True)
-parser.add_argument('--resolution', type=float, default=1.25, help='Resolution for tissue mask generation')
+parser.add_argument('--resolution', type=float, default=None, help='Resolution for tissue mask generation (default: 8 mpp, never finer than the slide)')
 parser.add_argument('--units', type=str, choices=['mpp', 'power', 'level', 'baseline'], default='mpp', help='Units for resolution')
-parser.add_argument('--mpp', type=float, help="Manually provide Microns Per Pixel (MPP) if missing in metadata", default=0.5)
+parser.add_argument('--metadata', type=str, default=None, help='slide_metadata.json of the input (default: read from the slide)')
+parser.add_argument('--default_mpp', type=float, help="MPP assumed when neither the slide nor --metadata records one", default=0.5)
+parser.add_argument('--debug_visualization', action='store_true', help='Also save a matplotlib figure of the mask for debugging')
+add_cache_arguments(parser)
+add_telemetry_arguments(parser)
 
 args = parser.parse_args()
+telemetry = start_telemetry('tissue_mask', args)
 
 # Extract input filename (without extension)
 input_filename = os.path.basename(args.input).split('.')[0]
@@ -30,24 +34,34 @@ if not os.path.exists(args.input):
     raise FileNotFoundError(f"Input file {args.input} not found.")
 
 # Handle both WSI files and regular images
-if args.input.lower().endswith(('.svs', '.tiff', '.ndpi', '.vms')):
+if args.input.lower().endswith(('.svs', '.tif', '.tiff', '.ndpi', '.vms')):
     # Handle WSIs
-    wsi = WSIReader.open(args.input)
-    
+    wsi = open_wsi(args.input, args.cache_dir, args.cache_max_mb)
+
     # Extract metadata
-    metadata = wsi.info.as_dict()
-    mpp = metadata.get('mpp', (args.mpp, args.mpp))  # Use provided MPP if missing
-    
-    if not mpp:
-        print(f"Warning: MPP not found in metadata, using default MPP of {args.mpp}")
-        mpp = (args.mpp, args.mpp)
-    
-    # Generate tissue mask at the specified resolution and units
-    mask = wsi.tissue_mask(resolution=args.resolution, units=args.units)
+    if args.metadata:
+        metadata = SlideMetadata.load(args.metadata).with_mpp(args.default_mpp)
+    else:
+        metadata = SlideMetadata.from_reader(wsi.reader, default_mpp=args.default_mpp)
+    if metadata.mpp_source == 'default':
+        print(f"Warning: MPP not found in metadata, using default MPP of {args.default_mpp}")
+    # Resolve mpp units with the metadata's MPP, which the image itself may lack
+    wsi = open_wsi(args.input, args.cache_dir, args.cache_max_mb, mpp=metadata.mpp)
+
+    # A mask only needs coarse pixels; the reader picks the smallest level covering them
+    resolution = args.resolution
+    if resolution is None:
+        resolution = metadata.stage_mpp('tissue_mask') if args.units == 'mpp' else 1.25
+
+    # Generate tissue mask at the specified resolution and units (cached per slide)
+    with telemetry.step('tissue_mask'):
+        mask = wsi.tissue_mask_array(resolution=resolution, units=args.units)
     mask_thumb = mask  # Use the mask directly
 
 elif args.input.lower().endswith(('.png', '.jpg', '.jpeg')):
     # Handle regular images using OpenCV
+    import cv2
+
     img = cv2.imread(args.input)
     if img is None:
         raise ValueError(f"Failed to load image: {args.input}")
@@ -56,9 +70,6 @@ elif args.input.lower().endswith(('.png', '.jpg', '.jpeg')):
     gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     _, mask_thumb = cv2.threshold(gray_img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
-    # Dummy metadata (since regular images do not contain MPP)
-    mpp = (args.mpp, args.mpp)
-
 else:
     raise ValueError(f"Unsupported file format: {args.input}")
 
@@ -68,6 +79,8 @@ if not mask_thumb.flags.writeable:
     mask_thumb.flags.writeable = True
 
 # Convert the mask to a PIL Image and save as PNG
+from PIL import Image
+
 mask_image_pil = Image.fromarray(mask_thumb.astype(np.uint8))
 mask_filename = f"{input_filename}_tissue_mask.png"
 mask_path = os.path.join(output_dir, mask_filename)
@@ -75,16 +88,18 @@ mask_path = os.path.join(output_dir, mask_filename)
 # Save the tissue mask as a PNG image
 mask_image_pil.save(mask_path)
 
-# Optionally, visualize the results (useful for debugging)
-plt.figure(figsize=(10, 5))
-plt.imshow(mask_thumb, cmap='gray')
-plt.title("Tissue Mask")
-plt.axis("off")
-
-# Save the visualization
-visualization_path = os.path.join(output_dir, f"{input_filename}_mask_visualization.png")
-plt.savefig(visualization_path)
-# plt.show()  # Comment out if running in non-interactive environments
-
 print(f"Tissue mask saved to: {mask_path}")
-print(f"Mask visualization saved to: {visualization_path}")
+
+# Optionally, visualize the results (useful for debugging)
+if args.debug_visualization:
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10, 5))
+    plt.imshow(mask_thumb, cmap='gray')
+    plt.title("Tissue Mask")
+    plt.axis("off")
+
+    # Save the visualization
+    visualization_path = os.path.join(output_dir, f"{input_filename}_mask_visualization.png")
+    plt.savefig(visualization_path)
+    print(f"Mask visualization saved to: {visualization_path}")
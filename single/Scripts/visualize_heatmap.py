@@ -1,25 +1,147 @@
 import argparse
+import os
 import numpy as np
-import matplotlib.pyplot as plt
-from tiatoolbox.wsicore.wsireader import WSIReader
+from feature_store import FeatureReader, is_feature_store
+from heatmap import bin_boxes, bin_points, blend, colorize, mean_grid, smooth
+from slide_metadata import SlideMetadata
+from telemetry import add_telemetry_arguments, start_telemetry
+from wsi_cache import add_cache_arguments, open_wsi
 
 parser = argparse.ArgumentParser(description="Heatmap Visualization")
 parser.add_argument('--input', type=str, help='Path to WSI file')
-parser.add_argument('--prediction', type=str, help='Path to model prediction')
+parser.add_argument('--prediction', type=str, help='Path to model prediction: nuclei store, 0.dat, model_inference.py score store, or a CSV/NPZ table of per-tile or per-nucleus scores')
 parser.add_argument('--output', type=str, help='Path to save heatmap')
+parser.add_argument('--statistic', type=str, choices=['density', 'type_fraction', 'prob', 'score'], default=None, help='Value to map (default: density for nuclei, score for tables)')
+parser.add_argument('--nucleus_type', type=int, nargs='+', default=None, help='Nucleus types counted by density and type_fraction (default: all)')
+parser.add_argument('--value_column', type=str, default='score', help='Column of a prediction table holding the score')
+parser.add_argument('--prediction_mpp', type=float, default=None, help='Microns per pixel of the prediction coordinates (default: from slide_metadata.json next to the prediction, else the slide baseline)')
+parser.add_argument('--resolution', type=float, default=1.0, help='Objective power of the thumbnail the heatmap is drawn on')
+parser.add_argument('--sigma', type=float, default=2.0, help='Gaussian smoothing in thumbnail pixels, 0 to disable')
+parser.add_argument('--cmap', type=str, default='hot', help='Matplotlib colormap')
+parser.add_argument('--alpha', type=float, default=0.5, help='Opacity of the heatmap overlay')
+parser.add_argument('--overlay_tiff', type=str, default=None, help='Also write the blended overlay as a tiled pyramidal TIFF')
+parser.add_argument('--grid_output', type=str, default=None, help='Also save the heatmap values as a .npy array')
+add_cache_arguments(parser)
+add_telemetry_arguments(parser)
 
 args = parser.parse_args()
+telemetry = start_telemetry('visualize_heatmap', args)
+
+
+def load_table(path):
+    """Columns of a score store, CSV or NPZ prediction table as a dict of arrays."""
+    if is_feature_store(path):
+        # Per-item scores written by model_inference.py --scores
+        reader = FeatureReader(path)
+        data = reader.read_all()
+        table = {'centroid_x': data['centroids'][:, 0], 'centroid_y': data['centroids'][:, 1]}
+        names = reader.column_names or [f'score_{k}' for k in range(reader.dim)]
+        table.update({name: data['features'][:, k] for k, name in enumerate(names)})
+        return table
+    if path.endswith('.npz'):
+        with np.load(path) as table:
+            return {name: table[name] for name in table.files}
+    import pandas as pd
+
+    table = pd.read_csv(path)
+    return {name: table[name].to_numpy() for name in table.columns}
+
 
 # Load the WSI thumbnail
-wsi = WSIReader.open(args.input)
-thumbnail = wsi.slide_thumbnail(1.0)
+wsi = open_wsi(args.input, args.cache_dir, args.cache_max_mb)
+with telemetry.step('thumbnail'):
+    thumbnail = wsi.slide_thumbnail(args.resolution)
+grid_shape = thumbnail.shape[:2]
+
+# Map prediction coordinates onto thumbnail pixels
+slide_width, slide_height = (float(v) for v in wsi.slide_dimensions(resolution=0, units='level'))
+baseline_mpp = wsi.info.mpp
+prediction_mpp = args.prediction_mpp
+if prediction_mpp is None:
+    # Nuclei outputs carry the metadata of the image they were segmented on
+    prediction_dir = args.prediction if os.path.isdir(args.prediction) else os.path.dirname(os.path.abspath(args.prediction))
+    prediction_metadata = SlideMetadata.find(prediction_dir, os.path.dirname(os.path.abspath(prediction_dir)))
+    prediction_mpp = prediction_metadata.mpp_value if prediction_metadata is not None else None
+coordinate_scale = 1.0
+if prediction_mpp is not None and baseline_mpp is not None:
+    coordinate_scale = prediction_mpp / float(np.mean(baseline_mpp))
+scale = (grid_shape[1] / slide_width * coordinate_scale, grid_shape[0] / slide_height * coordinate_scale)
+
+# Area of one thumbnail pixel in mm², for densities
+coordinate_mpp = prediction_mpp or (None if baseline_mpp is None else float(np.mean(baseline_mpp)))
+cell_area_mm2 = None if coordinate_mpp is None else (coordinate_mpp / scale[0]) * (coordinate_mpp / scale[1]) * 1e-6
+
+# Rasterize the predictions: bincount over centroids, difference arrays over tile boxes
+with telemetry.step('rasterize') as step:
+    is_table = is_feature_store(args.prediction) or (os.path.isfile(args.prediction) and args.prediction.endswith(('.csv', '.npz')))
+    statistic = args.statistic or ('score' if is_table else 'density')
+    if is_table:
+        table = load_table(args.prediction)
+        values = None if statistic == 'density' else table[args.value_column]
+        if {'x_start', 'y_start', 'x_end', 'y_end'} <= table.keys():
+            if values is None:
+                parser.error("--statistic density needs nuclei or point predictions, not tiles")
+            boxes = np.stack([table['x_start'], table['y_start'], table['x_end'], table['y_end']], axis=1)
+            sums, counts = bin_boxes(boxes, values, grid_shape, scale)
+        else:
+            points = np.stack([table['centroid_x'], table['centroid_y']], axis=1)
+            sums, counts = bin_points(points, values, grid_shape, scale)
+        step.add_items(len(next(iter(table.values()))), 'predictions')
+    else:
+        from nuclei_store import load_nuclei
 
-# Generate a random heatmap (you can replace this with real data)
-heatmap = np.random.rand(*thumbnail.shape[:2])
+        store = load_nuclei(args.prediction)
+        centroids = store['centroid']
+        if statistic == 'density':
+            keep = store.select(types=args.nucleus_type) if args.nucleus_type else slice(None)
+            sums, counts = bin_points(centroids[keep], None, grid_shape, scale)
+        elif statistic == 'type_fraction':
+            if not args.nucleus_type:
+                parser.error("--statistic type_fraction needs --nucleus_type")
+            values = np.isin(store['type'], args.nucleus_type)
+            sums, counts = bin_points(centroids, values, grid_shape, scale)
+        elif statistic == 'prob':
+            sums, counts = bin_points(centroids, store['prob'], grid_shape, scale)
+        else:
+            parser.error("--statistic score needs a prediction table")
+        step.add_items(len(store), 'nuclei')
+
+    if statistic == 'density':
+        heatmap = smooth(counts, args.sigma)
+        label = 'Nuclei per thumbnail pixel'
+        if cell_area_mm2 is not None:
+            heatmap = heatmap / cell_area_mm2
+            label = 'Nuclei per mm²'
+        heatmap[heatmap <= 1e-6 * max(heatmap.max(), 1e-12)] = np.nan
+    else:
+        heatmap = mean_grid(sums, counts, args.sigma)
+        label = {'type_fraction': 'Fraction of selected types', 'prob': 'Mean nucleus probability'}.get(statistic, args.value_column)
+
+if args.grid_output:
+    np.save(args.grid_output, heatmap.astype(np.float32))
 
 # Overlay heatmap on the WSI
-plt.imshow(thumbnail, alpha=0.6)
-plt.imshow(heatmap, cmap='hot', alpha=0.4)
-plt.colorbar()
-plt.axis('off')
-plt.savefig(args.output)
+with telemetry.step('save'):
+    rgba, vmin, vmax = colorize(heatmap, args.cmap)
+
+    import matplotlib.pyplot as plt
+    from matplotlib.cm import ScalarMappable
+    from matplotlib.colors import Normalize
+
+    plt.imshow(thumbnail)
+    plt.imshow(np.ma.masked_invalid(heatmap), cmap=args.cmap, vmin=vmin, vmax=vmax, alpha=args.alpha)
+    plt.colorbar(ScalarMappable(Normalize(vmin, vmax), args.cmap), ax=plt.gca(), label=label)
+    plt.axis('off')
+    plt.savefig(args.output, bbox_inches='tight', dpi=200)
+
+    if args.overlay_tiff:
+        from image_conversion import iter_array_tiles, write_pyramidal_tiff
+
+        overlay = blend(thumbnail, rgba, args.alpha)
+        overlay_mpp = None
+        if baseline_mpp is not None:
+            overlay_mpp = (float(baseline_mpp[0]) * slide_width / grid_shape[1],
+                           float(baseline_mpp[1]) * slide_height / grid_shape[0])
+        write_pyramidal_tiff(args.overlay_tiff, iter_array_tiles(overlay, 512), overlay.shape, mpp=overlay_mpp)
+
+print(f"Heatmap of {statistic} saved to {args.output}")
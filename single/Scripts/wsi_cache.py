@@ -0,0 +1,122 @@
+"""Content-addressed cache of WSI reads shared by all pipeline stages.
+
+Thumbnails, tissue masks and explicit region reads are keyed by a
+fingerprint of the slide file plus the read parameters and stored in a
+DiskCache, so a second stage asking for the same low resolution view gets
+a file read instead of another SVS/JPEG2000 decode.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from disk_cache import CACHE_DIR_ENV, DiskCache, make_key
+
+FINGERPRINT_BYTES = 1 << 20
+
+
+def slide_fingerprint(path):
+    """
+    Hash a slide's size and its first and last MiB.
+    Cheap on multi-GB slides while still changing whenever the file is rewritten.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            f.seek(max(size - FINGERPRINT_BYTES, FINGERPRINT_BYTES))
+            digest.update(f.read(FINGERPRINT_BYTES))
+    return digest.hexdigest()
+
+
+def add_cache_arguments(parser):
+    """Add the --cache_dir/--cache_max_mb options shared by every stage."""
+    parser.add_argument('--cache_dir', type=str, default=os.environ.get(CACHE_DIR_ENV), help=f'Shared cache directory (default: ${CACHE_DIR_ENV}); caching is off when unset')
+    parser.add_argument('--cache_max_mb', type=float, default=2048, help='Size bound of the cache in MB')
+
+
+class CachedWSIReader:
+    """
+    WSIReader wrapper whose low resolution reads go through a DiskCache.
+    Attributes not overridden here (info, slide_dimensions, ...) are
+    forwarded to the wrapped reader.
+    """
+
+    def __init__(self, path, cache=None, mpp=None):
+        """
+        :param path: Path to the slide
+        :param cache: DiskCache, or None to read straight from the slide
+        :param mpp: (x, y) MPP overriding the slide's own, for images without one
+        """
+        self.path = str(path)
+        self.cache = cache
+        self.mpp = mpp
+        self._reader = None
+        self._fingerprint = None
+
+    @property
+    def reader(self):
+        """The underlying tiatoolbox reader, opened on first use."""
+        if self._reader is None:
+            from tiatoolbox.wsicore.wsireader import WSIReader
+
+            self._reader = WSIReader.open(self.path, mpp=self.mpp)
+        return self._reader
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = slide_fingerprint(self.path)
+        return self._fingerprint
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.reader, name)
+
+    def _cached(self, read, *key_parts):
+        if self.cache is None:
+            return read()
+        if self.mpp is not None:
+            # MPP unit reads depend on the assumed MPP
+            key_parts = ('mpp', tuple(self.mpp)) + key_parts
+        key = make_key(self.fingerprint, *key_parts)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry['image']
+        image = np.asarray(read())
+        self.cache.put(key, {'image': image})
+        return image
+
+    def slide_thumbnail(self, resolution=1.25, units='power'):
+        return self._cached(
+            lambda: self.reader.slide_thumbnail(resolution=resolution, units=units),
+            'slide_thumbnail', resolution, units,
+        )
+
+    def tissue_mask_array(self, resolution=1.25, units='power', method='otsu'):
+        """Boolean tissue mask of the whole slide at the given resolution."""
+        return self._cached(
+            lambda: np.asarray(self.reader.tissue_mask(method=method, resolution=resolution, units=units).img) > 0,
+            'tissue_mask', method, resolution, units,
+        )
+
+    def read_rect(self, location, size, resolution=0, units='level', **kwargs):
+        return self._cached(
+            lambda: self.reader.read_rect(location, size, resolution=resolution, units=units, **kwargs),
+            'read_rect', tuple(int(v) for v in location), tuple(int(v) for v in size),
+            resolution, units, sorted(kwargs.items()),
+        )
+
+    def read_bounds(self, bounds, resolution=0, units='level', **kwargs):
+        return self._cached(
+            lambda: self.reader.read_bounds(bounds, resolution=resolution, units=units, **kwargs),
+            'read_bounds', tuple(int(v) for v in bounds), resolution, units, sorted(kwargs.items()),
+        )
+
+
+def open_wsi(path, cache_dir=None, cache_max_mb=2048, mpp=None):
+    """Open a slide for reading through the shared cache when cache_dir is set."""
+    cache = DiskCache(cache_dir, int(cache_max_mb * 2**20)) if cache_dir else None
+    return CachedWSIReader(path, cache, mpp)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""Time the pipeline stages on synthetic data, CPU only.
+
+Generates a synthetic slide and synthetic 0.dat predictions (see
+synthetic.py), then times:
+
+- stain_normalization.py (tiled mode), tissue_mask.py and extract_tiles.py
+  as subprocesses, read back from their --telemetry records
+- nuclei store conversion, calculate_metrics, contour morphology and the
+  kNN cell graph with its node features at every --scales size
+- feature store write and read
+
+Results go to a JSON file; pass an earlier results file as --baseline to
+compare, which exits 1 when a step got slower than the tolerance allows.
+Stages whose dependencies are missing are recorded with their error and
+skipped in the comparison.
+
+    python benchmarks/run_benchmarks.py --output baseline.json
+    python benchmarks/run_benchmarks.py --output new.json --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(os.path.dirname(HERE), 'Scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+
+from cell_graph import build_graph, iter_node_features  # noqa: E402
+from feature_store import FeatureReader, FeatureWriter  # noqa: E402
+from morphology import shape_features  # noqa: E402
+from nuclei_store import NucleiStore, write_nuclei_store  # noqa: E402
+from segmentation_metrics import calculate_metrics  # noqa: E402
+from synthetic import make_synthetic_nuclei, make_synthetic_slide  # noqa: E402
+from telemetry import Telemetry  # noqa: E402
+
+RECORD_FIELDS = ['wall_s', 'cpu_s', 'children_cpu_s', 'peak_rss_mb', 'read_bytes', 'write_bytes', 'items']
+
+
+def summarize(record):
+    return {field: record[field] for field in RECORD_FIELDS}
+
+
+def run_script(name, script_args, workdir):
+    """
+    Run a Scripts/ entry point on CPU and return its telemetry per step.
+    :param name: Script file name
+    :param script_args: Command line arguments
+    :param workdir: Directory for the telemetry file
+    :return: Dict of step -> summary, or {'error': ...}
+    """
+    telemetry_path = os.path.join(workdir, f'{name}.telemetry.jsonl')
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    env.pop('TIA_MODEL_SERVER', None)
+    env.pop('TIA_PIPELINE_CACHE', None)
+    result = subprocess.run(
+        [sys.executable, os.path.join(SCRIPTS_DIR, name), *script_args, '--telemetry', telemetry_path],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    if result.returncode != 0:
+        # Report the exception line rather than trailing log output
+        errors = [line for line in result.stderr.splitlines() if re.match(r'^[\w.]+(Error|Exception)\b', line)]
+        return {'error': errors[-1] if errors else f'exit code {result.returncode}'}
+    with open(telemetry_path) as f:
+        records = [json.loads(line) for line in f]
+    return {record['step']: summarize(record) for record in records}
+
+
+def run_in_process(name, steps):
+    """
+    Time a sequence of (step name, callable) in this process.
+    :return: Dict of step -> summary
+    """
+    telemetry = Telemetry(name)
+    for step_name, fn in steps:
+        with telemetry.step(step_name) as step:
+            items = fn()
+            if items:
+                step.add_items(*items)
+    telemetry.close()
+    return {record['step']: summarize(record) for record in telemetry.records}
+
+
+def benchmark_metrics(count, slide_size, workdir, seed):
+    nuclei = make_synthetic_nuclei(count, slide_size, slide_size, seed=seed)
+    store_path = os.path.join(workdir, f'nuclei_store_{count}')
+
+    def write_store():
+        write_nuclei_store(nuclei, store_path)
+        return count, 'nuclei'
+
+    def metrics():
+        calculate_metrics(NucleiStore.open(store_path).columns())
+        return count, 'nuclei'
+
+    def morphology():
+        store = NucleiStore.open(store_path)
+        shape_features(store['contour'], store['contour_offsets'])
+        return count, 'nuclei'
+
+    def cell_graph():
+        store = NucleiStore.open(store_path)
+        adjacency = build_graph(store['centroid'], 'knn')
+        for _ in iter_node_features(adjacency, store['centroid'], store['type']):
+            pass
+        return count, 'nuclei'
+
+    results = run_in_process(f'metrics_{count}', [
+        ('nuclei_store', write_store), ('metrics', metrics), ('morphology', morphology), ('cell_graph', cell_graph),
+    ])
+    shutil.rmtree(store_path)
+    return results
+
+
+def benchmark_feature_io(rows, dim, workdir, seed):
+    rng = np.random.default_rng(seed)
+    path = os.path.join(workdir, 'features')
+    batch = 4096
+
+    def write():
+        with FeatureWriter(path, dtype='float16') as writer:
+            for start in range(0, rows, batch):
+                stop = min(start + batch, rows)
+                writer.write(np.arange(start, stop), rng.uniform(0, 1e5, (stop - start, 2)),
+                             rng.standard_normal((stop - start, dim), dtype=np.float32))
+        return rows, 'rows'
+
+    def read():
+        total = sum(len(part['features']) for part in FeatureReader(path).iter_batches(dtype=np.float32))
+        return total, 'rows'
+
+    results = run_in_process('feature_io', [('write', write), ('read', read)])
+    shutil.rmtree(path)
+    return results
+
+
+def compare(results, baseline, tolerance, slack):
+    """
+    Print wall time changes against a baseline.
+    :return: List of regressed "stage/step" names
+    """
+    regressions = []
+    for stage, steps in results['stages'].items():
+        base_steps = baseline.get('stages', {}).get(stage, {})
+        if 'error' in steps or 'error' in base_steps:
+            continue
+        for step, summary in steps.items():
+            if step not in base_steps:
+                continue
+            before, after = base_steps[step]['wall_s'], summary['wall_s']
+            regressed = after > before * (1 + tolerance) + slack
+            ratio = after / before if before > 0 else float('inf')
+            print(f"{stage + '/' + step:40s} {before:9.3f}s -> {after:9.3f}s  x{ratio:5.2f}{'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append(f'{stage}/{step}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic slides and nuclei (CPU only)")
+    parser.add_argument('--output', type=str, required=True, help='Path of the results JSON to write')
+    parser.add_argument('--baseline', type=str, help='Earlier results JSON to compare against')
+    parser.add_argument('--slide_size', type=int, default=8192, help='Synthetic slide width and height in pixels')
+    parser.add_argument('--mpp', type=float, default=0.5, help='Microns per pixel of the synthetic slide')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10_000, 100_000, 1_000_000], help='Nuclei counts for the metrics benchmark')
+    parser.add_argument('--feature_rows', type=int, default=100_000, help='Rows for the feature store benchmark')
+    parser.add_argument('--feature_dim', type=int, default=2048, help='Feature dimension for the feature store benchmark')
+    parser.add_argument('--workers', type=int, default=4, help='Workers for tiled stain normalization and tile encoding')
+    parser.add_argument('--skip', type=str, nargs='*', default=[], choices=['stain_normalization', 'tissue_mask', 'tile_extraction', 'metrics', 'feature_io'], help='Stages to leave out')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative wall time increase over the baseline')
+    parser.add_argument('--slack', type=float, default=0.05, help='Allowed absolute wall time increase in seconds')
+    parser.add_argument('--workdir', type=str, help='Scratch directory (default: a temporary directory)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic data')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='tia_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'workdir')},
+        'stages': {},
+    }
+    stages = results['stages']
+
+    try:
+        slide_path = os.path.join(workdir, 'synthetic_slide.tif')
+        needs_slide = {'stain_normalization', 'tissue_mask', 'tile_extraction'} - set(args.skip)
+        if needs_slide and not os.path.exists(slide_path):
+            print(f"Generating {args.slide_size}x{args.slide_size} synthetic slide")
+            try:
+                make_synthetic_slide(slide_path, args.slide_size, args.slide_size, mpp=args.mpp, seed=args.seed)
+            except ImportError as error:
+                # Without a slide the slide stages cannot run; record why and go on
+                for stage in sorted(needs_slide):
+                    stages[stage] = {'error': f'{type(error).__name__}: {error}'}
+                args.skip = [*args.skip, *needs_slide]
+
+        if 'stain_normalization' not in args.skip:
+            print("Timing stain_normalization")
+            stages['stain_normalization'] = run_script('stain_normalization.py', [
+                '--input', slide_path, '--output', os.path.join(workdir, 'normalized', 'normalized_wsi.tif'),
+                '--mode', 'tiled', '--resolution', str(args.mpp), '--workers', str(args.workers),
+            ], workdir)
+
+        mask_path = os.path.join(workdir, 'mask', 'synthetic_slide_tissue_mask.png')
+        if 'tissue_mask' not in args.skip:
+            print("Timing tissue_mask")
+            stages['tissue_mask'] = run_script('tissue_mask.py', [
+                '--input', slide_path, '--output', os.path.dirname(mask_path),
+            ], workdir)
+
+        if 'tile_extraction' not in args.skip:
+            print("Timing tile_extraction")
+            mask_args = ['--mask', mask_path] if os.path.exists(mask_path) else []
+            stages['tile_extraction'] = run_script('extract_tiles.py', [
+                '--input', slide_path, '--output', os.path.join(workdir, 'tiles'), '--workers', str(args.workers),
+                *mask_args,
+            ], workdir)
+
+        if 'metrics' not in args.skip:
+            for count in args.scales:
+                print(f"Timing metrics on {count} nuclei")
+                stages[f'metrics_{count}'] = benchmark_metrics(count, args.slide_size * 8, workdir, args.seed)
+
+        if 'feature_io' not in args.skip:
+            print(f"Timing feature I/O on {args.feature_rows}x{args.feature_dim}")
+            stages['feature_io'] = benchmark_feature_io(args.feature_rows, args.feature_dim, workdir, args.seed)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+    for stage, steps in stages.items():
+        if 'error' in steps:
+            print(f"{stage}: skipped ({steps['error']})")
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.slack)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
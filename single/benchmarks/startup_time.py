@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Startup-time budget for the Scripts/ entry points.
+
+Every pipeline stage is a separate process per slide, so module import time
+is paid thousands of times per cohort. This runs ``python Scripts/X.py --help``
+for every script with a command line, subtracts the bare interpreter startup
+and compares the remaining import overhead against startup_budget.json.
+Scripts whose --help fails, e.g. for a missing dependency, are reported as
+failed and keep their previous baseline on --update.
+
+    python benchmarks/startup_time.py            # check, exit 1 on regression
+    python benchmarks/startup_time.py --update   # record a new baseline
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(os.path.dirname(HERE), 'Scripts')
+BUDGET_PATH = os.path.join(HERE, 'startup_budget.json')
+
+
+def entry_points(scripts_dir):
+    """Scripts that define a command line and therefore answer --help."""
+    scripts = []
+    for name in sorted(os.listdir(scripts_dir)):
+        if not name.endswith('.py'):
+            continue
+        with open(os.path.join(scripts_dir, name)) as f:
+            if 'argparse.ArgumentParser(' in f.read():
+                scripts.append(name)
+    return scripts
+
+
+def time_command(command, repeats):
+    """
+    Fastest wall time of a command; noise only ever adds time, so the minimum
+    is the most stable estimate.
+    :param command: argv list
+    :param repeats: Number of runs
+    :return: Seconds
+    :raises subprocess.CalledProcessError: When the command fails
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def slowest_imports(script, count=5):
+    """The modules with the largest cumulative import time, from -X importtime."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', script, '--help'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the --help startup time of every Scripts/ entry point")
+    parser.add_argument('--repeats', type=int, default=5, help='Runs per script; the fastest is reported')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='Allowed relative increase over the baseline')
+    parser.add_argument('--slack', type=float, default=0.1, help='Allowed absolute increase in seconds, absorbs noise on fast scripts')
+    parser.add_argument('--budget', type=str, default=BUDGET_PATH, help='Baseline JSON file')
+    parser.add_argument('--update', action='store_true', help='Write the measured times as the new baseline')
+    args = parser.parse_args()
+
+    interpreter = time_command([sys.executable, '-c', 'pass'], args.repeats)
+    print(f"Interpreter startup: {interpreter * 1000:.0f} ms")
+
+    budget = {}
+    if os.path.exists(args.budget):
+        with open(args.budget) as f:
+            budget = json.load(f)['import_seconds']
+
+    measured = {}
+    regressions = []
+    failures = []
+    for name in entry_points(SCRIPTS_DIR):
+        script = os.path.join(SCRIPTS_DIR, name)
+        baseline = budget.get(name)
+        try:
+            overhead = max(time_command([sys.executable, script, '--help'], args.repeats) - interpreter, 0.0)
+        except subprocess.CalledProcessError as error:
+            if baseline is not None:
+                measured[name] = baseline
+            failures.append(name)
+            reason = error.stderr.decode(errors='replace').strip().splitlines()
+            print(f"{name:28s} {'':>8s}     FAILED ({reason[-1] if reason else f'exit {error.returncode}'})")
+            continue
+        measured[name] = round(overhead, 4)
+        if baseline is None:
+            status = 'no baseline'
+        elif overhead > baseline * (1 + args.tolerance) + args.slack:
+            status = f'REGRESSION (baseline {baseline * 1000:.0f} ms)'
+            regressions.append(name)
+        else:
+            status = 'ok'
+        print(f"{name:28s} {overhead * 1000:8.0f} ms  {status}")
+
+    if args.update:
+        with open(args.budget, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'import_seconds': measured}, f, indent=4)
+            f.write('\n')
+        print(f"Baseline written to {args.budget}")
+    elif regressions or failures:
+        for name in regressions:
+            print(f"\nSlowest imports of {name}:")
+            for microseconds, module in slowest_imports(os.path.join(SCRIPTS_DIR, name)):
+                print(f"  {microseconds / 1000:8.1f} ms  {module}")
+        if failures:
+            print(f"\n{len(failures)} script(s) failed to start: {', '.join(failures)}")
+        sys.exit(1)
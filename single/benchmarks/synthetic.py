@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""Synthetic slides and nucleus predictions for offline benchmarks.
+
+Slides are tiled pyramidal TIFFs rendered tile by tile, so they can be far
+larger than memory. Colour follows the Beer-Lambert model with standard
+haematoxylin and eosin stain vectors: eosin-stained tissue regions from a
+smoothed random field on a white background, with haematoxylin-dense nuclei
+scattered over the tissue. Everything is seeded and reproducible.
+
+    python benchmarks/synthetic.py slide --output slide.tif --size 8192
+    python benchmarks/synthetic.py nuclei --output 0.dat --count 100000
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Scripts'))
+
+# Optical density of haematoxylin and eosin (Ruifrok & Johnston), unit rows
+STAIN_OD = np.array([
+    [0.650, 0.704, 0.286],
+    [0.072, 0.990, 0.105],
+])
+STAIN_OD /= np.linalg.norm(STAIN_OD, axis=1, keepdims=True)
+BACKGROUND = np.array([242.0, 240.0, 244.0])
+
+# Coarse grid the tissue field is defined on, in pixels
+FIELD_STEP = 64
+
+
+def tissue_field(shape, tissue_fraction=0.4, seed=0):
+    """
+    Smooth random tissue indicator on a FIELD_STEP-pixel grid.
+    :param shape: (height, width) of the slide
+    :param tissue_fraction: Approximate fraction of the slide covered by tissue
+    :param seed: Random seed
+    :return: (rows, cols) float array, > 0 inside tissue
+    """
+    from scipy.ndimage import gaussian_filter
+
+    rng = np.random.default_rng(seed)
+    rows, cols = (-(-s // FIELD_STEP) + 2 for s in shape)
+    noise = gaussian_filter(rng.standard_normal((rows, cols)), sigma=max(rows, cols) / 12, mode='wrap')
+    noise /= noise.std()
+    return noise - np.quantile(noise, 1 - tissue_fraction)
+
+
+def render_tile(field, location, tile_size, nuclei_per_tile=150, seed=0):
+    """
+    Render one H&E-like RGB tile.
+    :param field: Tissue field from tissue_field
+    :param location: (x, y) of the tile's top-left pixel
+    :param tile_size: Tile edge in pixels
+    :param nuclei_per_tile: Expected nuclei in a tile fully covered by tissue
+    :param seed: Random seed; combined with the location so tiles are independent
+    :return: (tile_size, tile_size, 3) uint8 array
+    """
+    from scipy.ndimage import map_coordinates
+
+    x, y = location
+    rng = np.random.default_rng([seed, x, y])
+    yy, xx = np.mgrid[y:y + tile_size, x:x + tile_size].astype(np.float64) / FIELD_STEP
+    tissue = np.clip(map_coordinates(field, [yy, xx], order=1) * 4, 0, 1)
+
+    eosin = tissue * (0.55 + 0.15 * rng.random((tile_size, tile_size)))
+    haematoxylin = tissue * (0.10 + 0.05 * rng.random((tile_size, tile_size)))
+
+    # Elliptical nuclei, denser where the tile is fully inside tissue
+    count = rng.poisson(nuclei_per_tile * tissue.mean())
+    centres = rng.integers(0, tile_size, size=(count, 2))
+    axes = rng.uniform(3, 8, size=(count, 2))
+    for (cy, cx), (ay, ax) in zip(centres, axes):
+        if tissue[cy, cx] < 0.5:
+            continue
+        y0, y1 = max(cy - 9, 0), min(cy + 10, tile_size)
+        x0, x1 = max(cx - 9, 0), min(cx + 10, tile_size)
+        dy, dx = np.ogrid[y0 - cy:y1 - cy, x0 - cx:x1 - cx]
+        inside = (dy / ay) ** 2 + (dx / ax) ** 2 <= 1
+        haematoxylin[y0:y1, x0:x1][inside] = 0.9 + 0.2 * rng.random()
+
+    od = haematoxylin[..., None] * STAIN_OD[0] + eosin[..., None] * STAIN_OD[1]
+    rgb = BACKGROUND * np.exp(-od) + rng.normal(0, 2, (tile_size, tile_size, 3))
+    return np.clip(rgb, 0, 255).astype(np.uint8)
+
+
+def make_synthetic_slide(output_path, width, height, tile_size=512, mpp=0.5, tissue_fraction=0.4, seed=0):
+    """
+    Write a synthetic H&E slide as a tiled pyramidal TIFF.
+    :param output_path: Path of the TIFF to write
+    :param width: Slide width in pixels
+    :param height: Slide height in pixels
+    :param tile_size: Tile edge in pixels, must be a multiple of 16
+    :param mpp: Microns per pixel stored in the TIFF
+    :param tissue_fraction: Approximate fraction covered by tissue
+    :param seed: Random seed
+    :return: Path to the slide
+    """
+    from image_conversion import write_pyramidal_tiff
+
+    field = tissue_field((height, width), tissue_fraction, seed)
+    tiles = (
+        render_tile(field, (x, y), tile_size, seed=seed)
+        for y in range(0, height, tile_size)
+        for x in range(0, width, tile_size)
+    )
+    return write_pyramidal_tiff(output_path, tiles, (height, width, 3), tile_size=tile_size, mpp=(mpp, mpp))
+
+
+def make_synthetic_nuclei(count, width, height, vertices=12, seed=0):
+    """
+    Synthetic HoVerNet predictions in the 0.dat schema.
+    :param count: Number of nuclei
+    :param width: Width of the area the centroids are drawn from
+    :param height: Height of the area the centroids are drawn from
+    :param vertices: Contour points per nucleus
+    :param seed: Random seed
+    :return: Dict of id -> {'box', 'centroid', 'contour', 'prob', 'type'}
+    """
+    rng = np.random.default_rng(seed)
+    centroid = rng.uniform((0, 0), (width, height), size=(count, 2))
+    axes = rng.uniform(3, 10, size=(count, 2))
+    angle = rng.uniform(0, np.pi, size=(count, 1))
+    theta = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+
+    # Rotated ellipses, rounded to pixel contours
+    ex = axes[:, :1] * np.cos(theta)
+    ey = axes[:, 1:] * np.sin(theta)
+    contour = np.stack([
+        centroid[:, :1] + ex * np.cos(angle) - ey * np.sin(angle),
+        centroid[:, 1:] + ex * np.sin(angle) + ey * np.cos(angle),
+    ], axis=-1).round().astype(np.int32)
+    box = np.concatenate([contour.min(axis=1), contour.max(axis=1) + 1], axis=1)
+
+    nucleus_type = rng.choice(6, size=count, p=[0.05, 0.35, 0.25, 0.25, 0.05, 0.05])
+    prob = rng.uniform(0.5, 1.0, size=count)
+    return {
+        i: {
+            'box': box[i],
+            'centroid': centroid[i],
+            'contour': contour[i],
+            'prob': float(prob[i]),
+            'type': int(nucleus_type[i]),
+        }
+        for i in range(count)
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic slides and nucleus predictions")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    slide_parser = subparsers.add_parser('slide', help='Synthetic H&E slide as pyramidal TIFF')
+    slide_parser.add_argument('--output', type=str, required=True, help='Path of the TIFF to write')
+    slide_parser.add_argument('--size', type=int, default=8192, help='Slide width and height in pixels')
+    slide_parser.add_argument('--tile_size', type=int, default=512, help='TIFF tile size in pixels')
+    slide_parser.add_argument('--mpp', type=float, default=0.5, help='Microns per pixel stored in the TIFF')
+    slide_parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    nuclei_parser = subparsers.add_parser('nuclei', help='Synthetic 0.dat with HoVerNet-style nuclei')
+    nuclei_parser.add_argument('--output', type=str, required=True, help='Path of the 0.dat file to write')
+    nuclei_parser.add_argument('--count', type=int, default=100000, help='Number of nuclei')
+    nuclei_parser.add_argument('--size', type=int, default=65536, help='Width and height of the area covered by nuclei')
+    nuclei_parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    if args.command == 'slide':
+        make_synthetic_slide(args.output, args.size, args.size, args.tile_size, args.mpp, seed=args.seed)
+    else:
+        import joblib
+
+        joblib.dump(make_synthetic_nuclei(args.count, args.size, args.size, seed=args.seed), args.output)
+        print(f"Saved {args.count} synthetic nuclei to {args.output}")
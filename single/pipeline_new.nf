@@ -1,99 +1,178 @@
 #!/usr/bin/env nextflow
 
 // Define parameters
-params.input = "/home/ubuntu/bala/bala/ImpartLabs/tmp/input/sample_small.svs"
+params.input = "/home/ubuntu/bala/bala/ImpartLabs/tmp/input/sample_small.svs"  // single slide or glob, e.g. "/data/cohort/*.svs"
+params.samplesheet = null  // optional CSV with header "slide_id,path"; overrides params.input
 params.outdir = "/home/ubuntu/bala/bala/ImpartLabs/tmp/results/"
 params.scripts = "/home/ubuntu/bala/bala/ImpartLabs/TIA_Pipeline/single/Scripts"
+params.num_shards = 1  // > 1 splits nuclei segmentation into parallel shard tasks
 
 // Create the output directory if it doesn't exist
 new File(params.outdir).mkdirs()
 
-// Define the input channel for the WSI file
-Channel.fromPath(params.input).set { wsi_file }
+// Define the input channel of (slide_id, WSI file) pairs
+if (params.samplesheet) {
+    Channel.fromPath(params.samplesheet, checkIfExists: true)
+        .splitCsv(header: true)
+        .map { row -> tuple(row.slide_id, file(row.path, checkIfExists: true)) }
+        .set { wsi_files }
+} else {
+    Channel.fromPath(params.input, checkIfExists: true)
+        .map { wsi -> tuple(wsi.baseName, wsi) }
+        .set { wsi_files }
+}
 
 // Process: read_wsi
 process read_wsi {
     conda '/path/to/conda/envs/image-processing'
+    label 'cpu_small'
+    tag "$slide_id"
     input:
-        path wsi_file
+        tuple val(slide_id), path(wsi_file)
 
     output:
-        path "thumbnail.png"
+        tuple val(slide_id), path("thumbnail.png"), emit: thumbnail
+        tuple val(slide_id), path("telemetry.jsonl"), emit: telemetry
 
-    publishDir "${params.outdir}", mode: 'copy'
+    publishDir "${params.outdir}/${slide_id}", mode: 'copy', saveAs: { it == 'telemetry.jsonl' ? null : it }
 
     script:
     """
-    python ${params.scripts}/read_wsi.py --input $wsi_file --output thumbnail.png
+    python ${params.scripts}/read_wsi.py --input $wsi_file --output thumbnail.png --telemetry telemetry.jsonl
     """
 }
 
 // Process: stain_normalization
 process stain_normalization {
     conda '/path/to/conda/envs/image-processing'
+    label 'cpu_large'
+    tag "$slide_id"
     input:
-        path wsi_thumbnail // Input from previous process
+        tuple val(slide_id), path(wsi_thumbnail) // Input from previous process
 
     output:
-        path "normalized_wsi.png"
+        tuple val(slide_id), path("normalized_wsi.tif"), path("slide_metadata.json"), emit: normalized
+        tuple val(slide_id), path("telemetry.jsonl"), emit: telemetry
 
-    publishDir "${params.outdir}", mode: 'copy'
+    publishDir "${params.outdir}/${slide_id}", mode: 'copy', saveAs: { it == 'telemetry.jsonl' ? null : it }
 
     script:
     """
-    python ${params.scripts}/stain_normalization.py --input $wsi_thumbnail --output normalized_wsi.png --method vahadane
+    python ${params.scripts}/stain_normalization.py --input $wsi_thumbnail --output normalized_wsi.tif --method vahadane --telemetry telemetry.jsonl
     """
 }
 
 // Process: tissue_mask
 process tissue_mask {
     conda '/path/to/conda/envs/image-processing'
+    label 'cpu_small'
+    tag "$slide_id"
     input:
-        path normalized_wsi // Input from previous process
+        tuple val(slide_id), path(normalized_wsi) // Input from previous process
 
     output:
-        path "tissue_mask.png"
+        tuple val(slide_id), path("normalized_wsi_tissue_mask.png"), emit: mask
+        tuple val(slide_id), path("telemetry.jsonl"), emit: telemetry
 
-    publishDir "${params.outdir}", mode: 'copy'
+    publishDir "${params.outdir}/${slide_id}", mode: 'copy', saveAs: { it == 'telemetry.jsonl' ? null : it }
 
     script:
     """
-    python ${params.scripts}/tissue_mask.py --input $normalized_wsi --output tissue_mask.png --resolution 1.25
+    python ${params.scripts}/tissue_mask.py --input $normalized_wsi --output . --telemetry telemetry.jsonl
     """
 }
 
 // Process: nuclei_segmentation
 process nuclei_segmentation {
     conda '/path/to/conda/envs/image-processing'
+    label 'gpu'
+    tag "$slide_id"
     input:
-        path normalized_wsi
-        path tissue_mask
+        tuple val(slide_id), path(normalized_wsi), path(metadata), path(tissue_mask)
 
     output:
-        path "nuclei_result.pkl"
+        tuple val(slide_id), path("nuclei"), emit: nuclei
+        tuple val(slide_id), path("telemetry.jsonl"), emit: telemetry
+
+    publishDir "${params.outdir}/${slide_id}", mode: 'copy', saveAs: { it == 'telemetry.jsonl' ? null : it }
+
+    script:
+    """
+    python ${params.scripts}/nuclei_segmentation.py --input $normalized_wsi --metadata $metadata --mask $tissue_mask --mode wsi --output_dir nuclei --telemetry telemetry.jsonl
+    """
+}
+
+// Process: nuclei_segmentation_shard (one task per shard of the tissue area)
+process nuclei_segmentation_shard {
+    conda '/path/to/conda/envs/image-processing'
+    label 'gpu'
+    tag "${slide_id}:${shard_index}"
+    input:
+        tuple val(slide_id), path(normalized_wsi), path(metadata), path(tissue_mask), val(shard_index)
 
-    publishDir "${params.outdir}", mode: 'copy'
+    output:
+        tuple val(slide_id), path("shard_${shard_index}"), emit: shard
+        tuple val(slide_id), path("telemetry.jsonl"), emit: telemetry
 
     script:
     """
-    python ${params.scripts}/nuclei_segmentation.py --input $normalized_wsi --mask $tissue_mask --output nuclei_result.pkl
+    python ${params.scripts}/nuclei_segmentation.py --input $normalized_wsi --metadata $metadata --mask $tissue_mask --mode wsi --output_dir shard_${shard_index} --num_shards ${params.num_shards} --shard_index ${shard_index} --telemetry telemetry.jsonl
+    """
+}
+
+// Process: merge_shards
+process merge_shards {
+    conda '/path/to/conda/envs/image-processing'
+    label 'cpu_small'
+    tag "$slide_id"
+    input:
+        tuple val(slide_id), path(shard_dirs)
+
+    output:
+        tuple val(slide_id), path("nuclei"), emit: nuclei
+        tuple val(slide_id), path("telemetry.jsonl"), emit: telemetry
+
+    publishDir "${params.outdir}/${slide_id}", mode: 'copy', saveAs: { it == 'telemetry.jsonl' ? null : it }
+
+    script:
+    """
+    python ${params.scripts}/merge_shards.py --inputs ${shard_dirs} --output_dir nuclei --telemetry telemetry.jsonl
     """
 }
 
 // Workflow Definition
 workflow {
-    // Start with the WSI file
-    def wsi_thumbnail = read_wsi(wsi_file)
+    // Start with the WSI files, one (slide_id, file) pair per slide
+    read_wsi(wsi_files)
 
-    // Perform stain normalization on the thumbnail WSI file
-    def norm_wsi = stain_normalization(wsi_thumbnail)
+    // Perform stain normalization on the thumbnail WSI files
+    stain_normalization(read_wsi.out.thumbnail)
+    def norm_wsi = stain_normalization.out.normalized
 
     // Create tissue mask using normalized WSI
-    def tissue_mask_im = tissue_mask(norm_wsi)
-
-    // Perform nuclei segmentation
-    def nuclei_res = nuclei_segmentation(
-        norm_wsi,
-        tissue_mask_im
-    )
+    tissue_mask(norm_wsi.map { slide_id, image, metadata -> tuple(slide_id, image) })
+
+    // Pair every normalized slide with its own mask
+    def seg_inputs = norm_wsi.join(tissue_mask.out.mask)
+
+    // Perform nuclei segmentation, fanning out over shards when requested
+    def nuclei_res
+    def seg_telemetry
+    if (params.num_shards > 1) {
+        nuclei_segmentation_shard(
+            seg_inputs.combine(Channel.of(0..<params.num_shards))
+        )
+        merge_shards(nuclei_segmentation_shard.out.shard.groupTuple(size: params.num_shards))
+        nuclei_res = merge_shards.out.nuclei
+        seg_telemetry = nuclei_segmentation_shard.out.telemetry.mix(merge_shards.out.telemetry)
+    } else {
+        nuclei_segmentation(seg_inputs)
+        nuclei_res = nuclei_segmentation.out.nuclei
+        seg_telemetry = nuclei_segmentation.out.telemetry
+    }
+
+    // Gather the per-stage telemetry of every slide into one JSONL file
+    read_wsi.out.telemetry
+        .mix(stain_normalization.out.telemetry, tissue_mask.out.telemetry, seg_telemetry)
+        .collectFile(storeDir: "${params.outdir}/telemetry") { slide_id, telemetry -> ["${slide_id}.telemetry.jsonl", telemetry] }
 }